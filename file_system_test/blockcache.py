@@ -0,0 +1,240 @@
+"""
+Write-back block cache for MicroPython block devices.
+
+The cache sits between a filesystem and a block device (e.g. SDCard) and
+implements the same readblocks(), writeblocks() and ioctl() protocol.
+Repeated rewrites of the same blocks (LittleFS metadata and file tails)
+are kept in RAM and only reach the card when a block is evicted, the
+filesystem syncs (ioctl op 3) or flush() is called.
+Adjacent dirty blocks are written back with a single multi-block write.
+
+Example usage:
+
+    sd = sdcard.SDCard(spi, cs)
+    sd.init_card()
+    cache = blockcache.BlockCache(sd, num_blocks=16)
+    fs = vfs.VfsLfs2(cache, readsize=512, progsize=512, lookahead=512)
+    vfs.mount(fs, "/sd")
+"""
+
+_BLOCK_SIZE = 512
+
+
+class BlockCache:
+    """
+    LRU write-back cache of 512-byte blocks in front of a block device.
+    All memory is allocated when the object is created.
+
+    internal variables :
+        device : the underlying block device
+        num_blocks (int) : number of cached blocks
+        max_run (int) : maximum number of blocks coalesced into one device write
+        cache (bytearray) : num_blocks * 512 bytes of cached data
+        staging (bytearray) : max_run * 512 bytes to assemble multi-block writes
+        slot_block (list) : block number held by each slot, -1 if unused
+        slot_used (list) : time of last use of each slot, for LRU eviction
+        slot_dirty (bytearray) : 1 if the slot holds data not yet written to the device
+        index (dict) : block number -> slot
+
+    counters :
+        hits, misses : cache lookups
+        device_reads, device_writes : calls to the device
+        blocks_written : number of blocks written to the device
+    """
+    def __init__(self, device, num_blocks:int=16, max_run:int=8) -> None:
+        """
+        Args:
+            device : block device providing readblocks(), writeblocks() and ioctl()
+            num_blocks (int): number of blocks kept in RAM - defaults to 16 (8 kB)
+            max_run (int): maximum number of adjacent dirty blocks written at once
+        """
+        self.device = device
+        self.num_blocks = num_blocks
+        self.max_run = max_run
+        self.cache = bytearray(num_blocks * _BLOCK_SIZE)
+        self.cache_mv = memoryview(self.cache)
+        self.staging = bytearray(max_run * _BLOCK_SIZE)
+        self.staging_mv = memoryview(self.staging)
+        self.slot_block = [-1] * num_blocks
+        self.slot_used = [0] * num_blocks
+        self.slot_dirty = bytearray(num_blocks)
+        self.index = {}
+        self.clock = 0
+        self.reset_counters()
+
+    def reset_counters(self) -> None:
+        self.hits = 0
+        self.misses = 0
+        self.device_reads = 0
+        self.device_writes = 0
+        self.blocks_written = 0
+
+    def slot_mv(self, slot:int) -> memoryview:
+        """
+        Returns:
+            (memoryview): the 512 bytes of a cache slot
+        """
+        return self.cache_mv[slot * _BLOCK_SIZE : (slot + 1) * _BLOCK_SIZE]
+
+    def touch(self, slot:int) -> None:
+        self.clock += 1
+        self.slot_used[slot] = self.clock
+
+    def evict(self) -> int:
+        """
+        Free the least recently used slot, writing it back if it is dirty.
+
+        Returns:
+            (int): the free slot
+        """
+        slot = 0
+        oldest = self.slot_used[0]
+        for s in range(self.num_blocks):
+            if self.slot_block[s] < 0:
+                return s
+            if self.slot_used[s] < oldest:
+                slot = s
+                oldest = self.slot_used[s]
+        if self.slot_dirty[slot]:
+            self.write_back(self.slot_block[slot])
+        del self.index[self.slot_block[slot]]
+        self.slot_block[slot] = -1
+        return slot
+
+    def lookup(self, block_num:int, load:bool=True) -> int:
+        """
+        Find the slot holding a block, allocating one on a miss.
+
+        Args:
+            block_num (int): block number on the device
+            load (bool): read the block from the device on a miss,
+                not necessary if it is about to be completely overwritten
+
+        Returns:
+            (int): the slot
+        """
+        slot = self.index.get(block_num)
+        if slot is not None:
+            self.hits += 1
+            self.touch(slot)
+            return slot
+        self.misses += 1
+        slot = self.evict()
+        if load:
+            self.device.readblocks(block_num, self.slot_mv(slot))
+            self.device_reads += 1
+        self.slot_block[slot] = block_num
+        self.slot_dirty[slot] = 0
+        self.index[block_num] = slot
+        self.touch(slot)
+        return slot
+
+    def write_run(self, first:int, count:int) -> None:
+        """
+        Write a run of adjacent dirty cached blocks to the device with a single call.
+        """
+        if count == 1:
+            slot = self.index[first]
+            self.device.writeblocks(first, self.slot_mv(slot))
+            self.slot_dirty[slot] = 0
+        else:
+            for i in range(count):
+                slot = self.index[first + i]
+                self.staging_mv[i * _BLOCK_SIZE : (i + 1) * _BLOCK_SIZE] = self.slot_mv(slot)
+                self.slot_dirty[slot] = 0
+            self.device.writeblocks(first, self.staging_mv[: count * _BLOCK_SIZE])
+        self.device_writes += 1
+        self.blocks_written += count
+
+    def is_dirty(self, block_num:int) -> bool:
+        slot = self.index.get(block_num)
+        return slot is not None and self.slot_dirty[slot] == 1
+
+    def write_back(self, block_num:int) -> None:
+        """
+        Write a dirty block back to the device together with
+        the dirty blocks adjacent to it (up to max_run blocks).
+        """
+        first = block_num
+        while block_num - first + 1 < self.max_run and self.is_dirty(first - 1):
+            first -= 1
+        last = block_num
+        while last - first + 1 < self.max_run and self.is_dirty(last + 1):
+            last += 1
+        self.write_run(first, last - first + 1)
+
+    def flush(self) -> None:
+        """
+        Write all dirty blocks to the device.
+        Adjacent blocks are coalesced into multi-block writes.
+        """
+        dirty = sorted(self.slot_block[s] for s in range(self.num_blocks) if self.slot_dirty[s])
+        i = 0
+        while i < len(dirty):
+            count = 1
+            while (i + count < len(dirty) and count < self.max_run and
+                   dirty[i + count] == dirty[i] + count):
+                count += 1
+            self.write_run(dirty[i], count)
+            i += count
+
+    def invalidate(self, block_num:int) -> None:
+        """
+        Drop a block from the cache without writing it back.
+        """
+        slot = self.index.pop(block_num, None)
+        if slot is not None:
+            self.slot_block[slot] = -1
+            self.slot_dirty[slot] = 0
+            self.slot_used[slot] = 0
+
+    def readblocks(self, block_num:int, buf, offset:int=0) -> None:
+        nbytes = len(buf)
+        if offset == 0 and nbytes > _BLOCK_SIZE and not nbytes % _BLOCK_SIZE:
+            # large reads go directly to the device, dirty cached blocks are newer
+            self.device.readblocks(block_num, buf)
+            self.device_reads += 1
+            mv = memoryview(buf)
+            for i in range(nbytes // _BLOCK_SIZE):
+                if self.is_dirty(block_num + i):
+                    mv[i * _BLOCK_SIZE : (i + 1) * _BLOCK_SIZE] = self.slot_mv(self.index[block_num + i])
+            return
+        mv = memoryview(buf)
+        pos = 0
+        while pos < nbytes:
+            n = min(_BLOCK_SIZE - offset, nbytes - pos)
+            slot = self.lookup(block_num)
+            mv[pos : pos + n] = self.slot_mv(slot)[offset : offset + n]
+            pos += n
+            offset = 0
+            block_num += 1
+
+    def writeblocks(self, block_num:int, buf, offset:int=0) -> None:
+        nbytes = len(buf)
+        if offset == 0 and nbytes >= self.num_blocks * _BLOCK_SIZE and not nbytes % _BLOCK_SIZE:
+            # writes larger than the cache bypass it, cached copies become stale
+            for i in range(nbytes // _BLOCK_SIZE):
+                self.invalidate(block_num + i)
+            self.device.writeblocks(block_num, buf)
+            self.device_writes += 1
+            self.blocks_written += nbytes // _BLOCK_SIZE
+            return
+        mv = memoryview(buf)
+        pos = 0
+        while pos < nbytes:
+            n = min(_BLOCK_SIZE - offset, nbytes - pos)
+            slot = self.lookup(block_num, load=(n < _BLOCK_SIZE))
+            self.slot_mv(slot)[offset : offset + n] = mv[pos : pos + n]
+            self.slot_dirty[slot] = 1
+            pos += n
+            offset = 0
+            block_num += 1
+
+    def ioctl(self, op:int, arg):
+        if op == 2:  # deinit
+            self.flush()
+        if op == 3:  # sync
+            self.flush()
+        if op == 6:  # erase block - cached content becomes irrelevant
+            self.invalidate(arg)
+        return self.device.ioctl(op, arg)
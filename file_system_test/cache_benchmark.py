@@ -0,0 +1,72 @@
+"""
+Benchmark of the write-back block cache with LittleFS.
+
+A RAM-backed stand-in for the SD card counts the physical block accesses.
+The same logging workload (28-byte records like imu_log.py, flushed every
+64 records) is run with the filesystem mounted directly on the device
+and with a BlockCache in between.
+
+runs on the Pico2 (or the MicroPython unix port)
+"""
+
+import vfs
+import struct
+import time
+from blockcache import BlockCache
+
+class RAMBlockDevice:
+    ERASE_BLOCK_SIZE = 512
+
+    def __init__(self, blocks):
+        self.data = bytearray(blocks * self.ERASE_BLOCK_SIZE)
+        self.mv = memoryview(self.data)
+        self.reads = 0
+        self.writes = 0
+        self.blocks_written = 0
+
+    def readblocks(self, block, buf, off=0):
+        self.reads += 1
+        addr = block * self.ERASE_BLOCK_SIZE + off
+        buf[:] = self.mv[addr : addr + len(buf)]
+
+    def writeblocks(self, block, buf, off=0):
+        self.writes += 1
+        self.blocks_written += (len(buf) + self.ERASE_BLOCK_SIZE - 1) // self.ERASE_BLOCK_SIZE
+        addr = block * self.ERASE_BLOCK_SIZE + off
+        self.mv[addr : addr + len(buf)] = buf
+
+    def ioctl(self, op, arg):
+        if op == 4:  # block count
+            return len(self.data) // self.ERASE_BLOCK_SIZE
+        if op == 5:  # block size
+            return self.ERASE_BLOCK_SIZE
+        return 0
+
+def run(use_cache, num_records=2000):
+    bdev = RAMBlockDevice(200)
+    vfs.VfsLfs2.mkfs(bdev, readsize=512, progsize=512, lookahead=512)
+    dev = BlockCache(bdev, num_blocks=16) if use_cache else bdev
+    fs = vfs.VfsLfs2(dev, readsize=512, progsize=512, lookahead=512)
+    bdev.reads = bdev.writes = bdev.blocks_written = 0
+    record = bytearray(28)
+    start = time.ticks_us()
+    f = fs.open("log.dat", "wb")
+    for i in range(num_records):
+        struct.pack_into('iffffff', record, 0, i, 0.1, 0.2, 0.3, 1.0, 2.0, 3.0)
+        f.write(record)
+        if i % 64 == 63:
+            f.flush()
+    f.close()
+    stop = time.ticks_us()
+    # check that the data arrived on the device
+    fs = vfs.VfsLfs2(bdev, readsize=512, progsize=512, lookahead=512)
+    size = fs.stat("log.dat")[6]
+    assert size == num_records * 28, f'file size {size}'
+    return bdev.reads, bdev.writes, bdev.blocks_written, time.ticks_diff(stop, start)
+
+print('LittleFS block cache benchmark')
+print('------------------------------')
+for use_cache in (False, True):
+    reads, writes, blocks, us = run(use_cache)
+    print(f'cache={use_cache} : {reads} reads, {writes} writes ({blocks} blocks), {us} us')
+print('done.')
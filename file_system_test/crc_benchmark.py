@@ -0,0 +1,67 @@
+"""
+Cost of the CRC protection of the SDCard driver on the Pico2.
+
+The time to compute the CRC16 of a 512-byte block is measured, then the
+same sequence of multi-block writes and reads is run with CRC checking off
+and on. The blocks from FIRST_BLOCK on are overwritten.
+
+run on the Pico2 with a card connected to SPI0
+"""
+
+import machine
+import utime
+import sdcard
+
+FIRST_BLOCK = 1_000_000
+NUM_BLOCKS = 1024
+RUN = 16
+BAUDRATE = 25_000_000
+
+cs = machine.Pin(17, machine.Pin.OUT)  # GPIO 17
+cs.high()
+spi = machine.SPI(0,
+                  baudrate=BAUDRATE,
+                  polarity=0,
+                  phase=0,
+                  bits=8,
+                  firstbit=machine.SPI.MSB,
+                  sck=machine.Pin(18),   # GPIO 18
+                  mosi=machine.Pin(19),  # GPIO 19
+                  miso=machine.Pin(16, machine.Pin.PULL_UP))  # GPIO 16
+
+print('CRC benchmark')
+print('-------------')
+block = bytearray(i & 0xFF for i in range(512))
+start = utime.ticks_us()
+for i in range(1000):
+    sdcard.crc16(block)
+print(f'crc16 of 512 bytes : {utime.ticks_diff(utime.ticks_us(), start) / 1000:.1f} us')
+print()
+
+
+def run(crc):
+    sd = sdcard.SDCard(spi, cs, baudrate=BAUDRATE, crc=crc)
+    sd.init_card()
+    buf = bytearray(RUN * 512)
+    for i in range(len(buf)):
+        buf[i] = (i * 7) & 0xFF
+    start = utime.ticks_us()
+    for b in range(FIRST_BLOCK, FIRST_BLOCK + NUM_BLOCKS, RUN):
+        sd.writeblocks(b, buf)
+    sd.ioctl(3, 0)
+    write_us = utime.ticks_diff(utime.ticks_us(), start)
+    start = utime.ticks_us()
+    for b in range(FIRST_BLOCK, FIRST_BLOCK + NUM_BLOCKS, RUN):
+        sd.readblocks(b, buf)
+    read_us = utime.ticks_diff(utime.ticks_us(), start)
+    kbytes = NUM_BLOCKS * 512 / 1024
+    print(f'crc={crc} : write {kbytes / write_us * 1e6:.0f} kB/s, read {kbytes / read_us * 1e6:.0f} kB/s, '
+          f'errors {sd.io_errors}')
+    return write_us, read_us
+
+
+write_off, read_off = run(False)
+write_on, read_on = run(True)
+print()
+print(f'CRC overhead : write {100 * (write_on - write_off) / write_off:.1f} %, '
+      f'read {100 * (read_on - read_off) / read_off:.1f} %')
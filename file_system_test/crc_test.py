@@ -0,0 +1,79 @@
+"""
+Host-side test of the CRC protection of the SDCard driver.
+
+Bit errors are injected into the transfers of the emulated card
+(sd_emulator.py). Without CRC checking they corrupt the data silently.
+With SDCard(..., crc=True) the card checks commands and written blocks
+(CMD59), the driver checks the blocks read, and the retries repair them.
+
+run with : python3 crc_test.py
+"""
+
+import os
+import tempfile
+from sdcard import SDCard, crc7, crc16
+import sd_emulator
+from sd_emulator import SDEmulator
+
+
+def pattern(block, n=1):
+    return bytes((block * 11 + i) & 0xFF for i in range(512 * n))
+
+
+# the tables give the same results as the bitwise CRCs of the emulator
+for cmd, arg in ((0, 0), (8, 0x1AA), (17, 1234), (59, 1)):
+    command = bytes([0x40 | cmd]) + arg.to_bytes(4, 'big')
+    assert crc7(command, 5) == (sd_emulator.crc7(command) << 1) | 1
+assert crc7(bytes([0x40, 0, 0, 0, 0]), 5) == 0x95
+for n in (16, 64, 512):
+    data = os.urandom(n)
+    assert crc16(data) == sd_emulator.crc16(data)
+assert crc16(memoryview(bytes(1024))[512:]) == 0
+
+# without CRC checking bit errors go unnoticed
+card = SDEmulator(num_blocks=2048)
+card.data[10 * 512 : 11 * 512] = pattern(10)
+sd = SDCard(card, card.cs, baudrate=25_000_000)
+sd.init_card()
+buf = bytearray(512)
+card.inject('read_bit')
+sd.readblocks(10, buf)
+assert buf != pattern(10) and not sd.io_errors
+card.inject('write_bit')
+sd.writeblocks(20, pattern(20))
+assert card.data[20 * 512 : 21 * 512] != pattern(20)
+
+# with CRC checking every corrupted transfer is detected and repeated
+card = SDEmulator(num_blocks=2048, log_commands=True)
+card.data[10 * 512 : 18 * 512] = pattern(10, 8)
+sd = SDCard(card, card.cs, baudrate=25_000_000, crc=True)
+sd.init_card()
+assert ('CMD59', 1) in card.log and card.crc_on
+card.inject('read_bit')
+sd.readblocks(10, buf)
+assert buf == pattern(10) and sd.io_errors == {'crc': 1}
+big = bytearray(8 * 512)
+card.inject('read_bit', after=4)
+sd.readblocks(10, big)
+assert big == pattern(10, 8) and sd.io_errors['crc'] == 2
+card.inject('write_bit')
+sd.writeblocks(20, pattern(20))
+assert card.data[20 * 512 : 21 * 512] == pattern(20)
+card.inject('write_bit', after=2)
+sd.writeblocks(30, pattern(30, 4))
+assert card.data[30 * 512 : 34 * 512] == pattern(30, 4)
+card.inject('cmd_bit')
+sd.readblocks(11, buf)
+assert buf == pattern(10, 8)[512:1024]
+print(f'CRC errors detected : {sd.io_errors}, {sd.io_retries} retries')
+assert sd.io_errors == {'crc': 5} and sd.io_retries == 5
+
+# the warm start turns CRC checking on again
+state_file = os.path.join(tempfile.mkdtemp(), 'state.json')
+sd.save_state(state_file)
+card.power_up()
+sd = SDCard(card, card.cs, crc=True)
+assert sd.warm_init(state_file) and card.crc_on
+sd.readblocks(20, buf)
+assert buf == pattern(20)
+print('passed.')
@@ -0,0 +1,98 @@
+"""
+Host-side benchmark of the SDCard driver against the SD card emulator.
+
+Each access pattern is run on a freshly initialized emulated card and
+reports the simulated bus time, the throughput, the SPI calls and the bytes
+on the bus per block. The numbers are deterministic, so changes of the
+driver can be compared without hardware.
+
+run with : python3 emulator_benchmark.py
+"""
+
+from sdcard import SDCard
+from sd_emulator import SDEmulator
+
+BAUDRATE = 25_000_000
+NUM_BLOCKS = 1024
+
+
+def make_card(**kwargs):
+    card = SDEmulator(num_blocks=16384, **kwargs)
+    sd = SDCard(card, card.cs, baudrate=BAUDRATE)
+    sd.init_card()
+    card.reset_counters()
+    return card, sd
+
+
+def single_reads(sd):
+    buf = bytearray(512)
+    for block in range(NUM_BLOCKS):
+        sd.readblocks(block, buf)
+
+
+def multi_reads(sd, run=32):
+    buf = bytearray(run * 512)
+    for block in range(0, NUM_BLOCKS, run):
+        sd.readblocks(block, buf)
+
+
+def readahead_reads(sd, depth=8):
+    sd.set_readahead(depth)
+    single_reads(sd)
+
+
+def single_writes(sd):
+    buf = bytearray(512)
+    for block in range(NUM_BLOCKS):
+        sd.writeblocks(block, buf)
+
+
+def multi_writes(sd, run=32):
+    buf = bytearray(run * 512)
+    for block in range(0, NUM_BLOCKS, run):
+        sd.writeblocks(block, buf)
+
+
+def multi_writes_no_pre_erase(sd, run=32):
+    sd.pre_erase = False
+    multi_writes(sd, run)
+
+
+def stream_writes(sd):
+    buf = bytearray(512)
+    sd.stream_open(0, NUM_BLOCKS)
+    for block in range(NUM_BLOCKS):
+        sd.stream_write(buf)
+    sd.stream_close()
+
+
+def stream_writes_no_pre_erase(sd):
+    buf = bytearray(512)
+    sd.stream_open(0)
+    for block in range(NUM_BLOCKS):
+        sd.stream_write(buf)
+    sd.stream_close()
+
+
+def run(name, workload):
+    # small AU so that the lazy-erase latency shows up within the benchmark
+    card, sd = make_card(au_blocks=256)
+    workload(sd)
+    sd.ioctl(3, 0)
+    us = card.time_us
+    kbps = NUM_BLOCKS * 512 / us * 1e3
+    print(f'{name:28s} {us / NUM_BLOCKS:8.1f} us/block {kbps:8.1f} kB/s '
+          f'{card.spi_calls / NUM_BLOCKS:6.2f} calls/block {card.bytes / NUM_BLOCKS:7.1f} bytes/block')
+
+
+print(f'SD card emulator benchmark, {NUM_BLOCKS} blocks at {BAUDRATE} Hz')
+print('-------------------------------------------------------------------')
+run('single-block reads', single_reads)
+run('multi-block reads (32)', multi_reads)
+run('readahead reads (8)', readahead_reads)
+run('single-block writes', single_writes)
+run('multi-block writes (32)', multi_writes)
+run('multi-block writes, no ACMD23', multi_writes_no_pre_erase)
+run('stream writes', stream_writes)
+run('stream writes, no ACMD23', stream_writes_no_pre_erase)
+print('done.')
@@ -0,0 +1,139 @@
+"""
+Host-side test of the erase support of the SDCard driver.
+
+The driver runs against the SD card emulator (sd_emulator.py), which fills
+erased blocks with its erase value 0x00. Single-block erase requests as
+LittleFS issues them through ioctl(6) must be batched into range erases
+(CMD32/CMD33/CMD38) split at the erase groups, and the blocks must read
+back erased. By default ranges shorter than an erase group are dropped.
+Erasing a block and then programming it, as LittleFS does, must send no
+erase at all. A card without ERASE_BLK_EN only erases whole erase groups.
+
+run with : python3 erase_test.py
+"""
+
+from sdcard import SDCard
+from sd_emulator import SDEmulator, crc7
+
+ERASED = bytes(512)
+
+
+def pattern(block):
+    return bytes((block * 3 + i) & 0xFF | 0x01 for i in range(512))
+
+
+def fill(sd, first, count):
+    for block in range(first, first + count):
+        sd.writeblocks(block, pattern(block))
+
+
+def check(sd, first, count, erased):
+    buf = bytearray(512)
+    for block in range(first, first + count):
+        sd.readblocks(block, buf)
+        expected = ERASED if erased else pattern(block)
+        assert buf == expected, f'block {block} {"not erased" if erased else "erased"}'
+
+
+# card with ERASE_BLK_EN : by default only ranges of whole erase groups are erased
+card = SDEmulator(num_blocks=2048)
+sd = SDCard(card, card.cs, baudrate=25_000_000)
+sd.init_card()
+assert sd.erase_blk_en == 1 and sd.erase_group == 128 and sd.erase_min == 128
+fill(sd, 96, 240)
+card.reset_counters()
+for block in range(100, 300):
+    assert sd.ioctl(6, block) == 0
+sd.ioctl(3, 0)
+# 128..255, not the partial groups 100..127 and 256..299
+assert card.commands.get('CMD38') == 1, card.commands
+check(sd, 96, 32, False)
+check(sd, 128, 128, True)
+check(sd, 256, 80, False)
+
+
+def erase_program(sd, card, first, count):
+    """ the pattern of LittleFS : erase a block, then program it """
+    card.reset_counters()
+    for block in range(first, first + count):
+        sd.ioctl(6, block)
+        sd.writeblocks(block, pattern(block))
+    sd.ioctl(3, 0)
+    check(sd, first, count, False)
+    return card.commands
+
+
+# erase-then-program of the same block sends no erase at all
+commands = erase_program(sd, card, 400, 100)
+assert 'CMD38' not in commands and 'CMD32' not in commands, commands
+assert commands['CMD24'] == 100
+
+# with erase_min=1 every single-block request is erased, contiguous ones in one CMD38 per erase group
+card = SDEmulator(num_blocks=2048)
+sd = SDCard(card, card.cs, baudrate=25_000_000, erase_min=1)
+sd.init_card()
+assert sd.erase_min == 1
+fill(sd, 96, 240)
+card.reset_counters()
+for block in range(100, 300):
+    sd.ioctl(6, block)
+sd.ioctl(3, 0)
+# 100..127, 128..255 and 256..299
+assert card.commands.get('CMD38') == 3, card.commands
+check(sd, 96, 4, False)
+check(sd, 100, 200, True)
+check(sd, 300, 36, False)
+
+# single scattered requests are each erased when the next one arrives or on sync
+fill(sd, 500, 1)
+fill(sd, 700, 1)
+card.reset_counters()
+sd.ioctl(6, 500)
+sd.ioctl(6, 700)
+assert card.commands.get('CMD38') == 1
+sd.ioctl(3, 0)
+assert card.commands.get('CMD38') == 2
+check(sd, 500, 1, True)
+check(sd, 700, 1, True)
+
+# a write drops the pending erase of the blocks it covers, the rest is erased first
+commands = erase_program(sd, card, 400, 100)
+assert 'CMD38' not in commands, commands
+fill(sd, 800, 6)
+card.reset_counters()
+for block in range(800, 806):
+    sd.ioctl(6, block)
+sd.writeblocks(802, pattern(802) + pattern(803))
+assert card.commands.get('CMD38') == 2
+check(sd, 800, 2, True)
+check(sd, 802, 2, False)
+check(sd, 804, 2, True)
+
+# erase() directly
+fill(sd, 900, 8)
+assert sd.erase(902, 4) == 4
+check(sd, 900, 2, False)
+check(sd, 902, 4, True)
+check(sd, 906, 2, False)
+
+# card without ERASE_BLK_EN : only whole erase groups are erased
+card = SDEmulator(num_blocks=2048)
+card.csd[10] &= ~0x40
+card.csd[15] = (crc7(card.csd[:15]) << 1) | 1
+sd = SDCard(card, card.cs, baudrate=25_000_000)
+sd.init_card()
+assert sd.erase_blk_en == 0 and sd.erase_min == 128
+fill(sd, 100, 300)
+assert sd.erase(100, 300) == 256
+check(sd, 100, 28, False)
+check(sd, 128, 256, True)
+fill(sd, 128, 256)
+card.reset_counters()
+# a partial group is not erased, a batch covering a whole group is
+for block in range(120, 384):
+    sd.ioctl(6, block)
+sd.ioctl(3, 0)
+assert card.commands.get('CMD38') == 2, card.commands
+check(sd, 120, 8, False)
+check(sd, 128, 256, True)
+print('passed.')
@@ -0,0 +1,85 @@
+"""
+Host-side test of the high-speed mode switch (CMD6) in SDCard.init_card().
+
+The emulated card (sd_emulator.py) answers CMD6 with the 64-byte switch status.
+It optionally supports high-speed mode, and after a successful switch
+reports TRAN_SPEED 0x5a (50 MHz) instead of 0x32.
+The test checks the command sequence and the SPI clock selected afterwards,
+also for a warm start with the switch disabled, and the decoding of TRAN_SPEED values.
+
+run with : python3 high_speed_test.py
+"""
+
+import os
+import tempfile
+from sdcard import SDCard
+from sd_emulator import SDEmulator
+
+
+def make_card(class10=True, high_speed=True):
+    card = SDEmulator(num_blocks=2048, high_speed=high_speed, log_commands=True)
+    if not class10:
+        # CCC without class 10 (switch)
+        card.csd[4] = 0x1B
+    return card
+
+
+def run(card, high_speed=True):
+    sd = SDCard(card, card.cs, baudrate=1_000_000, high_speed=high_speed)
+    sd.init_card()
+    tune_file = os.path.join(tempfile.mkdtemp(), 'tune.json')
+    baudrate = sd.tune_baudrate(tune_file=tune_file)
+    cmd6 = [arg for cmd, arg in card.log if cmd == 'CMD6']
+    return sd, cmd6, baudrate
+
+
+# capable card : query, switch, CSD re-read, 50 MHz
+card = make_card()
+sd, cmd6, baudrate = run(card)
+print(f'high-speed card : CMD6 args {[hex(a) for a in cmd6]}, tuned to {baudrate} Hz')
+assert cmd6 == [0x00FFFFF1, 0x80FFFFF1]
+index = card.log.index(('CMD6', 0x80FFFFF1))
+assert card.log[index + 1][0] == 'CMD9', 'CSD not read again after the switch'
+assert sd.get_tran_speed() == 50_000_000
+assert baudrate == 50_000_000 and card.baudrate == 50_000_000
+
+# card without high-speed function : query only
+card = make_card(high_speed=False)
+sd, cmd6, baudrate = run(card)
+print(f'default-speed card : CMD6 args {[hex(a) for a in cmd6]}, tuned to {baudrate} Hz')
+assert cmd6 == [0x00FFFFF1]
+assert sd.get_tran_speed() == 25_000_000 and baudrate == 25_000_000
+
+# card without command class 10 : no CMD6 at all
+card = make_card(class10=False)
+sd, cmd6, baudrate = run(card)
+print(f'card without class 10 : CMD6 args {[hex(a) for a in cmd6]}, tuned to {baudrate} Hz')
+assert cmd6 == [] and baudrate == 25_000_000
+
+# switching disabled
+card = make_card()
+sd, cmd6, baudrate = run(card, high_speed=False)
+assert cmd6 == [] and baudrate == 25_000_000
+
+# warm start of a card stored in high-speed mode, switching disabled : default speed, 25 MHz
+card = make_card()
+sd, cmd6, baudrate = run(card)
+state_file = os.path.join(tempfile.mkdtemp(), 'state.json')
+sd.save_state(state_file)
+card.power_up()
+card.log.clear()
+sd = SDCard(card, card.cs, high_speed=False)
+assert sd.warm_init(state_file), 'warm start failed'
+commands = [cmd for cmd, arg in card.log]
+print(f'warm start without high-speed mode : {commands}, {sd.baudrate} Hz')
+assert 'CMD6' not in commands and not sd.hs_mode and not card.hs_mode
+assert sd.get_tran_speed() == 25_000_000
+assert sd.baudrate == 25_000_000 and card.baudrate == 25_000_000
+
+# TRAN_SPEED decoding : the rate unit has three bits, 4..7 are reserved
+for tran_speed, rate in ((0x32, 25_000_000), (0x5a, 50_000_000), (0x0b, 100_000_000),
+                         (0x2b, 200_000_000), (0x49, 4_000_000), (0x5e, 0), (0x0f, 0)):
+    sd.csd[3] = tran_speed
+    assert sd.get_tran_speed() == rate, f'TRAN_SPEED {tran_speed:#04x}'
+
+print('passed.')
@@ -0,0 +1,544 @@
+"""
+Compact log format of raw ICM-20948 samples.
+
+The samples are stored as the raw int16 counts read from the sensor,
+16 bytes per sample instead of 28 for scaled floats. A header in front of
+the records describes them, so host tools can apply the scaling without
+knowing the configuration of the logging run:
+
+    header (a multiple of 512 bytes, so the records stay block-aligned) :
+        0  magic b'IMUL'
+        4  version (uint16)
+        6  header size in bytes (uint16)
+        8  record size in bytes (uint16)
+        10 length of the description (uint16)
+        12 description as JSON text, zero padded
+
+    record (16 bytes) :
+        0  timestamp, ticks_us (uint32, little-endian)
+        4  acc_x, acc_y, acc_z, gyro_x, gyro_y, gyro_z
+           raw counts (int16, big-endian as read from the sensor)
+
+The description holds the schema (field name, NumPy dtype, scale factor,
+unit), the sensor (type, WHO_AM_I id, I2C address) and the accelerometer
+and gyro configuration with the resulting output data rate (ODR).
+
+As ticks_us() wraps around, version 2 of the format (blocks=True) groups
+the records in blocks, each starting with a 64-bit epoch from a
+MonotonicClock (monotonic.py). The records store the us since the epoch
+instead of the ticks, so long captures have one continuous time base:
+
+    block (512 bytes) :
+        0  epoch, us of the clock at the first record (uint64, little-endian)
+        8  block number since the start of the log (uint32), gaps mark dropped blocks
+        12 reserved (uint32)
+        16 31 records, the timestamp replaced by the offset from the epoch
+
+The last block of a log may be incomplete.
+
+Consecutive samples differ by little, version 3 (delta=True) stores each
+sample as its difference from the previous one, as zigzag varints (7 bits
+per byte, the high bit set if more bytes follow, the sign in the lowest
+bit). Every block starts with a keyframe, so it can be decoded on its own.
+Noise of some tens of counts needs one byte per axis, a block then holds
+about twice the samples of version 2:
+
+    block (512 bytes) :
+        0  epoch, us of the clock at the keyframe (uint64, little-endian)
+        8  block number since the start of the log (uint32)
+        12 samples in the block (uint16)
+        14 bytes used in the block (uint16)
+        16 keyframe, the raw counts of the first sample (12 bytes as read from the sensor)
+        28 the other samples, 7 varints each : the change of the time step (us)
+           and the changes of the six raw values
+
+Example usage on the Pico2:
+
+    f.write(imulog.make_header(imu))
+    packer = RecordPacker(imulog.RECORD_FORMAT, f.write)
+    while logging:
+        imu.read_AccelGyro()
+        imulog.pack_record(packer.buf, packer.fill, utime.ticks_us(), imu.acc_gyro_buf)
+        packer.commit()
+
+and with 64-bit timestamps:
+
+    f.write(imulog.make_header(imu, blocks=True))
+    number = 0
+    while logging:
+        now = utime.ticks_us()
+        if pipe.fill % 512 == 0:
+            epoch = now
+            imulog.pack_block_header(pipe.buf, pipe.fill, clock.ticks_to_us(epoch), number)
+            pipe.commit()
+            number += 1
+        imu.read_AccelGyro()
+        imulog.pack_record(pipe.buf, pipe.fill, utime.ticks_diff(now, epoch), imu.acc_gyro_buf)
+        pipe.commit()
+
+and compressed (the encoder fills 512-byte records of the pipeline):
+
+    f.write(imulog.make_header(imu, delta=True))
+    pipe = LogPipeline('512s')
+    encoder = imulog.DeltaEncoder(pipe, clock)
+    while logging:
+        now = utime.ticks_us()
+        imu.read_AccelGyro()
+        encoder.add(now, imu.acc_gyro_buf)
+    encoder.flush()
+
+Example usage on the host:
+
+    header, data = imulog.load('imu_log.dat')    # NumPy array with scaled fields
+    header, records = imulog.read_log('imu_log.dat')    # without NumPy
+"""
+
+import json
+import struct
+from array import array
+from monotonic import ticks_diff
+try:
+    import micropython
+except ImportError:
+    # running on a host computer
+    class micropython:
+        @staticmethod
+        def viper(f):
+            return f
+    def ptr8(buf):
+        return buf
+    def ptr32(buf):
+        return buf
+    def uint(value):
+        return value & 0xFFFFFFFF
+
+MAGIC = b'IMUL'
+VERSION = 1
+VERSION_BLOCKS = 2
+RECORD_SIZE = 16
+# for RecordPacker : the raw sensor data is copied, not converted
+RECORD_FORMAT = '<I12s'
+# the block header has the size of a record, it is packed and committed like one
+BLOCK_HEADER_FORMAT = '<QII'
+RECORDS_PER_BLOCK = 31
+VERSION_DELTA = 3
+DELTA_HEADER_FORMAT = '<QIHH'
+# offsets of the keyframe and of the varints in a block of version 3
+_DELTA_KEYFRAME = 16
+_DELTA_STREAM = 28
+FIELDS = ('acc_x', 'acc_y', 'acc_z', 'gyro_x', 'gyro_y', 'gyro_z')
+_PREFIX_FORMAT = '<4sHHHH'
+_PREFIX_SIZE = 12
+_BLOCK_SIZE = 512
+
+
+def describe(imu, blocks:bool=False) -> dict:
+    """
+    Description of the records written for an ICM20948 in its current configuration.
+    With blocks=True (versions 2 and 3) the timestamp field is the offset from the block epoch.
+    """
+    acc = imu.accConfig
+    gyro = imu.gyrConfig
+    schema = [['offset' if blocks else 'timestamp', '<u4', 1, 'us']]
+    schema += [[name, '>i2', imu.acc_scale, 'g'] for name in FIELDS[:3]]
+    schema += [[name, '>i2', imu.gyro_scale, 'dps'] for name in FIELDS[3:]]
+    return {
+        'schema': schema,
+        'sensor': {'type': 'ICM-20948', 'id': imu.WHO_AM_I, 'address': imu.address},
+        'accel': {'FullScale': acc['FullScale'], 'LowPass': acc['LowPass'],
+                  'SampleRateDiv': acc['SampleRateDiv'], 'odr': 1125.0 / (1 + acc['SampleRateDiv'])},
+        'gyro': {'FullScale': gyro['FullScale'], 'LowPass': gyro['LowPass'],
+                 'SampleRateDiv': gyro['SampleRateDiv'], 'odr': 1100.0 / (1 + gyro['SampleRateDiv'])},
+    }
+
+
+def make_header(imu, description=None, blocks:bool=False, delta:bool=False) -> bytearray:
+    """
+    Header block(s) of a log, written before the first record.
+
+    Args:
+        imu (ICM20948): the configured sensor
+        description (dict): used instead of describe(imu) if given
+        blocks (bool): records in blocks with a 64-bit epoch (version 2)
+        delta (bool): delta encoded blocks (version 3)
+
+    Returns:
+        (bytearray): header, a multiple of 512 bytes
+    """
+    if description is None:
+        description = describe(imu, blocks or delta)
+    if delta:
+        version = VERSION_DELTA
+    else:
+        version = VERSION_BLOCKS if blocks else VERSION
+    text = json.dumps(description, separators=(',', ':')).encode()
+    size = (_PREFIX_SIZE + len(text) + _BLOCK_SIZE - 1) // _BLOCK_SIZE * _BLOCK_SIZE
+    header = bytearray(size)
+    # the samples of version 3 have no fixed size
+    record_size = 0 if delta else RECORD_SIZE
+    struct.pack_into(_PREFIX_FORMAT, header, 0, MAGIC, version, size, record_size, len(text))
+    header[_PREFIX_SIZE : _PREFIX_SIZE + len(text)] = text
+    return header
+
+
+@micropython.viper
+def pack_record(buf, offset:int, timestamp:int, raw):
+    """
+    Store a record at buf[offset:offset+16] : the timestamp and the
+    12 bytes of raw sensor data (ICM20948.acc_gyro_buf), without allocations.
+    """
+    dst = ptr8(buf)
+    src = ptr8(raw)
+    dst[offset] = timestamp & 0xFF
+    dst[offset + 1] = (timestamp >> 8) & 0xFF
+    dst[offset + 2] = (timestamp >> 16) & 0xFF
+    dst[offset + 3] = (timestamp >> 24) & 0xFF
+    for i in range(12):
+        dst[offset + 4 + i] = src[i]
+
+
+def pack_block_header(buf, offset:int, epoch:int, number:int) -> None:
+    """
+    Store the header of a block at buf[offset:offset+16], offset must be at a block start.
+
+    Args:
+        epoch (int): us of the MonotonicClock at the first record of the block
+        number (int): blocks since the start of the log
+    """
+    struct.pack_into(BLOCK_HEADER_FORMAT, buf, offset, epoch, number, 0)
+
+
+@micropython.viper
+def _start_block(buf, block:int, state, raw):
+    # copy the keyframe, the raw values and zero time step become the reference
+    dst = ptr8(buf)
+    src = ptr8(raw)
+    ref = ptr32(state)
+    for i in range(12):
+        dst[block + 16 + i] = src[i]    # _DELTA_KEYFRAME
+    for k in range(6):
+        v = int((src[2 * k] << 8) | src[2 * k + 1])
+        if v & 0x8000:
+            v -= 0x10000
+        ref[k] = v
+    ref[6] = 0
+    ref[7] = 0
+
+
+@micropython.viper
+def _encode_sample(buf, state, raw, offset:int) -> int:
+    # append the 7 varints of a sample at state[16], returns the new position,
+    # 0 if they end after state[17] (the bytes beyond are written, the reference is kept)
+    # (viper takes at most 4 positional arguments, position and end are passed in state)
+    dst = ptr8(buf)
+    src = ptr8(raw)
+    ref = ptr32(state)
+    pos = ref[16]
+    for k in range(7):
+        if k == 0:
+            step = offset - ref[6]
+            d = step - ref[7]
+            ref[14] = offset
+            ref[15] = step
+        else:
+            v = int((src[2 * k - 2] << 8) | src[2 * k - 1])
+            if v & 0x8000:
+                v -= 0x10000
+            d = v - ref[k - 1]
+            ref[7 + k] = v
+        z = uint((d << 1) ^ (d >> 31))
+        while z >= uint(0x80):
+            dst[pos] = (z & 0x7F) | 0x80
+            pos += 1
+            z >>= 7
+        dst[pos] = z
+        pos += 1
+    if pos > ref[17]:
+        return 0
+    for k in range(6):
+        ref[k] = ref[8 + k]
+    ref[6] = ref[14]
+    ref[7] = ref[15]
+    ref[16] = pos
+    return pos
+
+
+@micropython.viper
+def _clear(buf, start:int, end:int):
+    dst = ptr8(buf)
+    for i in range(start, end):
+        dst[i] = 0
+
+
+class DeltaEncoder:
+    """
+    Delta encoding of the samples into blocks of version 3.
+
+    The blocks are built in place in the buffer of a RecordPacker or LogPipeline
+    created with 512-byte records ('512s'), a finished block is committed as one record.
+    A sample ending beyond the block is written into the room after it, then discarded
+    and stored as the keyframe of the next block.
+
+    internal variables :
+        packer : RecordPacker or LogPipeline receiving the blocks
+        clock (MonotonicClock) : source of the block epochs
+        state (array) : raw values, offset and time step of the previous sample,
+            followed by those of the sample being encoded, the offset in packer.buf
+            where the next sample is encoded and that of the end of the current block
+        block (int) : offset of the current block in packer.buf
+        epoch_ticks (int) : ticks of the keyframe
+        epoch (int) : clock us of the keyframe
+        count (int) : samples in the current block, 0 if no block is started
+
+    counters :
+        samples : number of samples encoded
+        blocks : number of blocks committed
+    """
+    def __init__(self, packer, clock) -> None:
+        if packer.size != _BLOCK_SIZE:
+            raise ValueError('[DeltaEncoder] the packer must take 512-byte records')
+        self.packer = packer
+        self.clock = clock
+        self.state = array('i', [0] * 18)
+        self.block = 0
+        self.epoch_ticks = 0
+        self.epoch = 0
+        self.count = 0
+        self.samples = 0
+        self.blocks = 0
+
+    def add(self, ticks:int, raw) -> None:
+        """
+        Encode a sample.
+
+        Args:
+            ticks (int): utime.ticks_us() of the sample
+            raw : the 12 bytes read from the sensor (ICM20948.acc_gyro_buf)
+        """
+        self.samples += 1
+        if self.count:
+            if _encode_sample(self.packer.buf, self.state, raw, ticks_diff(ticks, self.epoch_ticks)):
+                self.count += 1
+                return
+            self.finish()
+        # keyframe of a new block
+        packer = self.packer
+        self.block = packer.fill
+        self.state[16] = self.block + _DELTA_STREAM
+        self.state[17] = self.block + _BLOCK_SIZE
+        self.epoch_ticks = ticks
+        self.epoch = self.clock.ticks_to_us(ticks)
+        _start_block(packer.buf, self.block, self.state, raw)
+        self.count = 1
+
+    def finish(self) -> None:
+        """
+        Complete the current block and commit it.
+        """
+        buf = self.packer.buf
+        pos = self.state[16]
+        _clear(buf, pos, self.state[17])
+        struct.pack_into(DELTA_HEADER_FORMAT, buf, self.block, self.epoch, self.blocks,
+                         self.count, pos - self.block)
+        self.packer.commit()
+        self.blocks += 1
+        self.count = 0
+
+    def flush(self) -> None:
+        """
+        Commit the last, partly filled block.
+        """
+        if self.count:
+            self.finish()
+
+
+def parse_header(data) -> dict:
+    """
+    Decode the header at the start of a log.
+
+    Args:
+        data (bytes): at least the header, e.g. the first block of the file
+
+    Returns:
+        (dict): the description with 'version', 'header_size' and 'record_size' added
+    """
+    magic, version, header_size, record_size, length = struct.unpack_from(_PREFIX_FORMAT, data, 0)
+    if magic != MAGIC:
+        raise ValueError('[imulog] not an IMU log')
+    if version not in (VERSION, VERSION_BLOCKS, VERSION_DELTA):
+        raise ValueError(f'[imulog] log format version {version} not supported')
+    if len(data) < _PREFIX_SIZE + length:
+        raise ValueError('[imulog] header incomplete')
+    description = json.loads(bytes(data[_PREFIX_SIZE : _PREFIX_SIZE + length]))
+    description['version'] = version
+    description['header_size'] = header_size
+    description['record_size'] = record_size
+    return description
+
+
+def _struct_format(schema) -> list:
+    # '<u4' -> '<I', '>i2' -> '>h' : one struct per field, as the byte order differs
+    codes = {'u1': 'B', 'i1': 'b', 'u2': 'H', 'i2': 'h', 'u4': 'I', 'i4': 'i', 'f4': 'f'}
+    return [dtype[0] + codes[dtype[1:]] for name, dtype, scale, unit in schema]
+
+
+def _read_delta(data, start:int, schema) -> list:
+    # decode the blocks of version 3 one sample at a time
+    records = []
+    for block in range(start, len(data) - _DELTA_STREAM + 1, _BLOCK_SIZE):
+        epoch, number, count, length = struct.unpack_from(DELTA_HEADER_FORMAT, data, block)
+        values = list(struct.unpack_from('>6h', data, block + _DELTA_KEYFRAME))
+        offset = 0
+        step = 0
+        pos = block + _DELTA_STREAM
+        for n in range(count):
+            if n:
+                deltas = []
+                for k in range(7):
+                    z = 0
+                    shift = 0
+                    while True:
+                        byte = data[pos]
+                        pos += 1
+                        z |= (byte & 0x7F) << shift
+                        shift += 7
+                        if byte < 0x80:
+                            break
+                    deltas.append((z >> 1) ^ -(z & 1))
+                step += deltas[0]
+                offset += step
+                values = [v + d for v, d in zip(values, deltas[1:])]
+            records.append([epoch + offset] + [v * field[2] for v, field in zip(values, schema[1:])])
+    return records
+
+
+def read_log(path):
+    """
+    Read a log without NumPy.
+
+    Returns:
+        (tuple): the header and a list of records, each a list of the
+            timestamp and the scaled values in the order of the schema
+            (from version 2 on the timestamp is the 64-bit epoch plus the offset)
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    header = parse_header(data)
+    schema = header['schema']
+    if header['version'] == VERSION_DELTA:
+        return header, _read_delta(data, header['header_size'], schema)
+    formats = _struct_format(schema)
+    offsets = []
+    offset = 0
+    for fmt in formats:
+        offsets.append(offset)
+        offset += struct.calcsize(fmt)
+    size = header['record_size']
+    blocks = header['version'] == VERSION_BLOCKS
+    records = []
+    epoch = 0
+    for start in range(header['header_size'], len(data) - size + 1, size):
+        if blocks and (start - header['header_size']) % _BLOCK_SIZE == 0:
+            epoch = struct.unpack_from(BLOCK_HEADER_FORMAT, data, start)[0]
+            continue
+        record = [struct.unpack_from(fmt, data, start + off)[0] * field[2]
+                  for fmt, off, field in zip(formats, offsets, schema)]
+        record[0] += epoch
+        records.append(record)
+    return header, records
+
+
+def _load_delta(data):
+    """
+    Vectorized decoding of the blocks of version 3.
+
+    Returns:
+        (tuple): the timestamps (uint64) and the raw values (int64, one column per axis)
+    """
+    import numpy as np
+    blocks = data[:len(data) // _BLOCK_SIZE * _BLOCK_SIZE].reshape(-1, _BLOCK_SIZE)
+    head = np.ascontiguousarray(blocks[:, :_DELTA_KEYFRAME]).view(
+        np.dtype([('epoch', '<u8'), ('number', '<u4'), ('count', '<u2'), ('length', '<u2')])).reshape(-1)
+    # zero-filled blocks (e.g. the end of a raw image) hold no samples
+    used = head['count'] > 0
+    blocks = blocks[used]
+    head = head[used]
+    count = head['count'].astype(np.int64)
+    keyframes = np.ascontiguousarray(blocks[:, _DELTA_KEYFRAME:_DELTA_STREAM]).view('>i2').astype(np.int64)
+    # the varints of all blocks as one stream, the last byte of each has the high bit clear
+    column = np.arange(_BLOCK_SIZE)
+    stream = blocks[(column >= _DELTA_STREAM) & (column < head['length'][:, None].astype(np.int64))]
+    last = stream < 0x80
+    ends = np.flatnonzero(last)
+    starts = np.concatenate(([0], ends[:-1] + 1)) if len(ends) else ends
+    varint = np.cumsum(last) - last
+    shift = (7 * (np.arange(len(stream)) - starts[varint])).astype(np.uint64)
+    z = np.add.reduceat((stream & 0x7F).astype(np.uint64) << shift, starts) if len(starts) else \
+        np.zeros(0, dtype=np.uint64)
+    deltas = ((z >> np.uint64(1)).astype(np.int64) ^ -(z & np.uint64(1)).astype(np.int64)).reshape(-1, 7)
+    # one row per sample : the keyframes (time step 0) and the deltas in between
+    first = np.cumsum(count) - count
+    keyframe = np.zeros(count.sum(), dtype=bool)
+    keyframe[first] = True
+    rows = np.zeros((len(keyframe), 7), dtype=np.int64)
+    rows[keyframe, 1:] = keyframes
+    rows[~keyframe] = deltas
+    block_of = np.repeat(np.arange(len(count)), count)
+
+    def block_sums(x):
+        # cumulative sums restarting at every keyframe
+        total = np.cumsum(x, axis=0)
+        return total - (total[first] - x[first])[block_of]
+
+    offset = block_sums(block_sums(rows[:, 0]))
+    values = block_sums(rows[:, 1:])
+    return head['epoch'][block_of] + offset.astype(np.uint64), values
+
+
+def load(path):
+    """
+    Read a log with NumPy, scaling the raw counts in one pass.
+
+    Returns:
+        (tuple): the header and a structured array with the timestamp (uint32,
+            uint64 from version 2 on) and the scaled values (float32) named as in the schema
+    """
+    import numpy as np
+    with open(path, 'rb') as f:
+        header_size = struct.unpack(_PREFIX_FORMAT, f.read(_PREFIX_SIZE))[2]
+        f.seek(0)
+        header = parse_header(f.read(header_size))
+    schema = header['schema']
+    raw_dtype = np.dtype([(name, dtype) for name, dtype, scale, unit in schema])
+    if header['version'] == VERSION_DELTA:
+        timestamp, values = _load_delta(np.fromfile(path, dtype=np.uint8, offset=header_size))
+        raw = {field[0]: values[:, k] for k, field in enumerate(schema[1:])}
+        out = np.empty(len(timestamp), dtype=[('timestamp', 'u8')] + [(field[0], 'f4') for field in schema[1:]])
+        out['timestamp'] = timestamp
+    elif header['version'] == VERSION_BLOCKS:
+        data = np.fromfile(path, dtype=np.uint8, offset=header_size)
+        num_blocks = -(-len(data) // _BLOCK_SIZE)
+        padded = np.zeros(num_blocks * _BLOCK_SIZE, dtype=np.uint8)
+        padded[:len(data)] = data
+        block_dtype = np.dtype([('epoch', '<u8'), ('number', '<u4'), ('reserved', '<u4'),
+                                ('records', raw_dtype, RECORDS_PER_BLOCK)])
+        blocks = padded.view(block_dtype)
+        # records in the last, possibly incomplete block
+        last = (len(data) - (num_blocks - 1) * _BLOCK_SIZE) // RECORD_SIZE - 1
+        count = max(0, (num_blocks - 1) * RECORDS_PER_BLOCK + last)
+        raw = blocks['records'].reshape(-1)[:count]
+        timestamp = np.repeat(blocks['epoch'], RECORDS_PER_BLOCK)[:count] + raw[schema[0][0]]
+        out = np.empty(count, dtype=[('timestamp', 'u8')] + [(field[0], 'f4') for field in schema[1:]])
+        out['timestamp'] = timestamp
+    else:
+        raw = np.fromfile(path, dtype=raw_dtype, offset=header_size)
+        out = np.empty(len(raw), dtype=[(name, 'u4' if scale == 1 and dtype[1] == 'u' else 'f4')
+                                        for name, dtype, scale, unit in schema])
+    for name, dtype, scale, unit in schema:
+        if name not in out.dtype.names:
+            continue    # the offset, included in the timestamp
+        if out.dtype[name].kind == 'f':
+            out[name] = raw[name] * np.float32(scale)
+        else:
+            out[name] = raw[name]
+    return header, out
@@ -0,0 +1,200 @@
+"""
+Host-side test of the raw IMU log format.
+
+Samples of a simulated sensor are packed with imulog.pack_record() through
+a RecordPacker into a file behind the header, like imu_log.py does on the
+Pico2. Reading the file back, with and without NumPy, must give the
+configuration from the header and the scaled values of every sample.
+In the block format (version 2) the samples are taken across the
+wrap-around of the ticks, the timestamps read back must be continuous.
+The delta encoded format (version 3) must give the same samples back,
+also from a single block, and hold at least twice as many per block.
+
+run with : python3 imulog_test.py
+"""
+
+import os
+import random
+import struct
+import tempfile
+import imulog
+from monotonic import MonotonicClock, ticks_diff
+from recordpacker import RecordPacker
+
+NUM_SAMPLES = 1000
+
+
+class SimulatedIMU:
+    """ the attributes of an ICM20948 used by imulog, in the configuration of imu_log.py """
+    WHO_AM_I = 0xEA
+    address = 0x69
+
+    def __init__(self):
+        self.accConfig = {'SampleRateDiv': 2, 'FullScale': '4g', 'LowPass': '111.4Hz'}
+        self.gyrConfig = {'SampleRateDiv': 2, 'FullScale': '500dps', 'LowPass': '119.5Hz'}
+        self.acc_scale = 4.0 / 32768.0
+        self.gyro_scale = 500.0 / 32768.0
+        self.acc_gyro_buf = bytearray(12)
+
+    def read_AccelGyro(self, i):
+        struct.pack_into('>hhhhhh', self.acc_gyro_buf, 0, *counts(i))
+
+
+def counts(i):
+    return [((i * 37 + axis * 1000) % 65536) - 32768 for axis in range(6)]
+
+
+imu = SimulatedIMU()
+header = imulog.make_header(imu)
+assert len(header) % 512 == 0
+path = os.path.join(tempfile.mkdtemp(), 'imu_log.dat')
+with open(path, 'wb') as f:
+    f.write(header)
+    packer = RecordPacker(imulog.RECORD_FORMAT, f.write, num_blocks=4)
+    assert packer.size == imulog.RECORD_SIZE
+    for i in range(NUM_SAMPLES):
+        imu.read_AccelGyro(i)
+        imulog.pack_record(packer.buf, packer.fill, 0xFFFF0000 + i * 3000, imu.acc_gyro_buf)
+        packer.commit()
+    packer.flush()
+assert os.path.getsize(path) == len(header) + NUM_SAMPLES * 16
+print(f'{NUM_SAMPLES} samples in {os.path.getsize(path)} bytes')
+
+def check_header(h):
+    assert h['version'] == imulog.VERSION
+    assert h['record_size'] == 16
+    assert h['sensor'] == {'type': 'ICM-20948', 'id': 0xEA, 'address': 0x69}
+    assert h['accel']['FullScale'] == '4g' and h['accel']['odr'] == 375.0
+    assert h['gyro']['LowPass'] == '119.5Hz' and abs(h['gyro']['odr'] - 366.67) < 0.01
+    assert [field[0] for field in h['schema']] == ['timestamp'] + list(imulog.FIELDS)
+
+# pure Python reader
+h, records = imulog.read_log(path)
+check_header(h)
+assert len(records) == NUM_SAMPLES
+for i, record in enumerate(records):
+    assert record[0] == (0xFFFF0000 + i * 3000) & 0xFFFFFFFF
+    expected = [c * imu.acc_scale for c in counts(i)[:3]] + [c * imu.gyro_scale for c in counts(i)[3:]]
+    assert record[1:] == expected, f'sample {i} differs'
+
+# NumPy reader
+try:
+    import numpy as np
+except ImportError:
+    np = None
+if np is not None:
+    h, data = imulog.load(path)
+    check_header(h)
+    assert len(data) == NUM_SAMPLES
+    assert data['timestamp'].dtype == np.uint32
+    assert list(data['timestamp'][:3]) == [0xFFFF0000, 0xFFFF0000 + 3000, 0xFFFF0000 + 6000]
+    for name in imulog.FIELDS:
+        assert data[name].dtype == np.float32
+    assert np.allclose(data['acc_z'], [r[3] for r in records])
+    assert np.allclose(data['gyro_y'], [r[5] for r in records])
+
+# block format : 64-bit epoch per block, offsets per record
+ticks = [(1 << 30) - 400_000]
+clock = MonotonicClock(ticks=lambda: ticks[0])
+path = os.path.join(tempfile.mkdtemp(), 'imu_log.dat')
+with open(path, 'wb') as f:
+    f.write(imulog.make_header(imu, blocks=True))
+    packer = RecordPacker(imulog.RECORD_FORMAT, f.write, num_blocks=4)
+    number = 0
+    for i in range(NUM_SAMPLES):
+        now = ticks[0]
+        if packer.fill % 512 == 0:
+            epoch = now
+            imulog.pack_block_header(packer.buf, packer.fill, clock.ticks_to_us(epoch), number)
+            packer.commit()
+            number += 1
+        imu.read_AccelGyro(i)
+        imulog.pack_record(packer.buf, packer.fill, ticks_diff(now, epoch), imu.acc_gyro_buf)
+        packer.commit()
+        ticks[0] = (ticks[0] + 1000) & ((1 << 30) - 1)
+    packer.flush()
+assert number == -(-NUM_SAMPLES // imulog.RECORDS_PER_BLOCK)
+assert os.path.getsize(path) == 512 + (number - 1) * 512 + 16 + (NUM_SAMPLES % 31) * 16
+
+h, records = imulog.read_log(path)
+assert h['version'] == imulog.VERSION_BLOCKS
+assert [field[0] for field in h['schema']] == ['offset'] + list(imulog.FIELDS)
+assert [r[0] for r in records] == [i * 1000 for i in range(NUM_SAMPLES)], 'timestamps not continuous'
+assert records[-1][1:] == [c * imu.acc_scale for c in counts(NUM_SAMPLES - 1)[:3]] + \
+                          [c * imu.gyro_scale for c in counts(NUM_SAMPLES - 1)[3:]]
+if np is not None:
+    h, data = imulog.load(path)
+    assert data['timestamp'].dtype == np.uint64
+    assert np.array_equal(data['timestamp'], np.arange(NUM_SAMPLES, dtype=np.uint64) * 1000)
+    assert np.allclose(data['gyro_z'], [r[6] for r in records])
+print(f'block format : {number} blocks, timestamps continuous across the wrap-around')
+
+# delta encoded blocks : sensor noise around a slow drift, jitter of the sample times,
+# with a few jumps over the full int16 range
+rng = random.Random(7)
+samples = []
+level = [0, 0, 8192, 10, -20, 5]
+t = (1 << 30) - 2_000_000
+for i in range(5000):
+    t += 1000 + rng.randint(-3, 3)
+    level = [v + rng.choice((-1, 0, 1)) for v in level]
+    values = [min(32767, max(-32768, int(v + rng.gauss(0, 8)))) for v in level]
+    if i % 1000 == 500:
+        values = [32767, -32768, 32767, -32768, 32767, -32768]
+    samples.append((t & ((1 << 30) - 1), values))
+ticks = [samples[0][0]]
+clock = MonotonicClock(ticks=lambda: ticks[0])
+path = os.path.join(tempfile.mkdtemp(), 'imu_log.dat')
+raw = bytearray(12)
+with open(path, 'wb') as f:
+    f.write(imulog.make_header(imu, delta=True))
+    packer = RecordPacker('512s', f.write, num_blocks=4)
+    encoder = imulog.DeltaEncoder(packer, clock)
+    for now, values in samples:
+        ticks[0] = now
+        struct.pack_into('>hhhhhh', raw, 0, *values)
+        encoder.add(now, raw)
+    encoder.flush()
+    packer.flush()
+per_block = len(samples) / encoder.blocks
+print(f'delta encoding : {per_block:.1f} samples per block, {per_block / imulog.RECORDS_PER_BLOCK:.2f} times version 2')
+assert per_block >= 2 * imulog.RECORDS_PER_BLOCK
+assert os.path.getsize(path) == 512 + encoder.blocks * 512
+
+expected_t = [(now - samples[0][0]) % (1 << 30) for now, values in samples]
+scales = [imu.acc_scale] * 3 + [imu.gyro_scale] * 3
+h, records = imulog.read_log(path)
+assert h['version'] == imulog.VERSION_DELTA
+assert [r[0] for r in records] == expected_t, 'timestamps differ'
+for (now, values), record in zip(samples, records):
+    assert record[1:] == [v * scale for v, scale in zip(values, scales)]
+if np is not None:
+    h, data = imulog.load(path)
+    assert data['timestamp'].dtype == np.uint64
+    assert np.array_equal(data['timestamp'], expected_t)
+    for k, name in enumerate(imulog.FIELDS):
+        assert np.array_equal(data[name], np.float32([v[k] for t, v in samples]) * np.float32(scales[k]))
+
+# a single block decodes on its own
+with open(path, 'rb') as f:
+    header = f.read(512)
+    f.seek(512 + 40 * 512)
+    block = f.read(512)
+single = os.path.join(tempfile.mkdtemp(), 'block.dat')
+with open(single, 'wb') as f:
+    f.write(header + block)
+h, part = imulog.read_log(single)
+count = struct.unpack_from(imulog.DELTA_HEADER_FORMAT, block)[2]
+start = [r[0] for r in records].index(part[0][0])
+assert part == records[start : start + count]
+if np is not None:
+    h, data = imulog.load(single)
+    assert list(data['timestamp']) == [r[0] for r in part]
+
+# not a log
+try:
+    imulog.parse_header(bytes(512))
+    assert False, 'no error raised'
+except ValueError:
+    pass
+print('passed.')
@@ -0,0 +1,169 @@
+"""
+Dual-core logging pipeline : sampling on core 0, storage on core 1.
+
+When the sampling loop writes to the SD card itself, every busy period of
+the card (block programming, file system updates) is a gap in the samples.
+LogPipeline separates the two : the sampling loop on core 0 packs records
+into a preallocated ring of buffers, a consumer started on core 1 with
+_thread hands the complete buffers to the storage (e.g. f.write).
+
+The ring is a single-producer/single-consumer queue without locks. Only the
+producer advances head (buffers published), only the consumer advances tail
+(buffers written), a buffer is published after its contents are complete.
+The producer never waits : when it completes a buffer and the consumer has
+not yet released the next one, the records of the completed buffer are
+dropped and counted as an overrun. A record crossing the end of a buffer
+continues at the start of the next one, so the buffers written form one
+contiguous stream, also after an overrun (the records of the dropped
+buffer are missing, the stream stays aligned).
+
+Example usage:
+
+    pipe = LogPipeline('<I12s', num_slots=8, slot_blocks=4)
+    pipe.start(f.write)     # consumer on core 1
+    while logging:
+        struct.pack_into('<I12s', pipe.buf, pipe.fill, timestamp, raw)
+        pipe.commit()
+    pipe.close()            # writes the last partial buffer, waits for the consumer
+    f.close()
+"""
+
+import struct
+import _thread
+try:
+    from utime import sleep_ms
+except ImportError:
+    # running on a host computer
+    from time import sleep
+    def sleep_ms(ms):
+        sleep(ms / 1000)
+
+_BLOCK_SIZE = 512
+
+
+class LogPipeline:
+    """
+    Ring of buffers passing fixed-size records from a producer to a consumer on the other core.
+
+    internal variables :
+        size (int) : bytes per record
+        slot_size (int) : bytes per buffer, a multiple of 512
+        num_slots (int) : buffers in the ring
+        slots (list) : the buffers, each with room for the part of a record crossing its end
+        views (list) : memoryviews of the buffers, slot_size bytes each
+        lengths (list) : bytes to write from each published buffer
+        head (int) : number of buffers published by the producer
+        tail (int) : number of buffers written by the consumer
+        buf (bytearray) : buffer the producer is filling, slots[head % num_slots]
+        fill (int) : offset in buf where the next record is packed
+        first (int) : offset of the first record starting in buf
+        closed (bool) : the producer has published its last buffer
+        finished (bool) : the consumer has written all buffers and exited
+
+    counters :
+        records : number of records committed
+        overruns : number of buffers dropped because the consumer was behind
+        peak : largest number of buffers waiting for the consumer
+        written : number of buffers written by the consumer
+    """
+    def __init__(self, fmt:str, num_slots:int=8, slot_blocks:int=4) -> None:
+        """
+        Args:
+            fmt (str): struct format of the records
+            num_slots (int): buffers in the ring - defaults to 8
+            slot_blocks (int): 512-byte blocks per buffer - defaults to 4 (2 kB)
+        """
+        self.size = struct.calcsize(fmt)
+        self.slot_size = slot_blocks * _BLOCK_SIZE
+        if self.size > self.slot_size or num_slots < 2:
+            raise ValueError(f'[LogPipeline] {self.size}-byte records in {num_slots} buffers not supported')
+        self.num_slots = num_slots
+        self.slots = [bytearray(self.slot_size + self.size) for i in range(num_slots)]
+        self.views = [memoryview(slot)[:self.slot_size] for slot in self.slots]
+        self.lengths = [self.slot_size] * num_slots
+        self.head = 0
+        self.tail = 0
+        self.buf = self.slots[0]
+        self.fill = 0
+        self.first = 0
+        self.closed = False
+        self.finished = False
+        self.records = 0
+        self.overruns = 0
+        self.peak = 0
+        self.written = 0
+
+    def commit(self) -> None:
+        """
+        Account for the record just packed at offset fill (producer side).
+        A completed buffer is published, or dropped if the ring is full.
+        """
+        fill = self.fill + self.size
+        self.records += 1
+        if fill >= self.slot_size:
+            fill -= self.slot_size
+            head = self.head
+            waiting = head + 1 - self.tail
+            if waiting < self.num_slots:
+                # the next buffer is free, it receives the rest of the record
+                buf = self.buf
+                nxt = self.slots[(head + 1) % self.num_slots]
+                slot_size = self.slot_size
+                for i in range(fill):
+                    nxt[i] = buf[slot_size + i]
+                self.lengths[head % self.num_slots] = slot_size
+                self.buf = nxt
+                self.first = fill
+                # publish only after the buffer is complete
+                self.head = head + 1
+                if waiting > self.peak:
+                    self.peak = waiting
+            else:
+                # refill the buffer from the first record starting in it,
+                # the record crossing its end is dropped as well
+                self.overruns += 1
+                fill = self.first
+        self.fill = fill
+
+    def run(self, sink) -> None:
+        """
+        Consumer loop : pass the published buffers to the sink until the producer closes.
+
+        Args:
+            sink : called with a memoryview of each buffer, e.g. f.write
+        """
+        num_slots = self.num_slots
+        while True:
+            # read the flag before head, buffers published before closing are not missed
+            closed = self.closed
+            if self.tail != self.head:
+                i = self.tail % num_slots
+                length = self.lengths[i]
+                if length == self.slot_size:
+                    sink(self.views[i])
+                else:
+                    sink(self.views[i][:length])
+                self.written += 1
+                self.tail += 1
+            elif closed:
+                break
+            else:
+                sleep_ms(1)
+        self.finished = True
+
+    def start(self, sink) -> None:
+        """
+        Start the consumer on the second core (a thread on the host).
+        """
+        _thread.start_new_thread(self.run, (sink,))
+
+    def close(self) -> None:
+        """
+        Publish the last partial buffer and wait until the consumer has written everything.
+        """
+        if self.fill > 0:
+            self.lengths[self.head % self.num_slots] = self.fill
+            self.head += 1
+        self.closed = True
+        while not self.finished:
+            sleep_ms(1)
@@ -0,0 +1,173 @@
+"""
+Host-side test of the dual-core logging pipeline.
+
+A simulated sensor is sampled at 1 kHz on schedule, the raw records are
+written to the SD card emulator (sd_emulator.py) which stalls for 50 ms on
+every fourth write, like a card programming its flash. Written inline
+(single core, RecordPacker) the stalls are gaps in the timestamps. Through
+LogPipeline, with the card written from a second thread, the timestamps
+must be gap-free and every sample must arrive. With a ring too small for
+the stalls the sampler must still keep its schedule and count the overruns,
+the records written must stay aligned.
+
+run with : python3 logpipeline_test.py
+"""
+
+import struct
+import sys
+import time
+import imulog
+from logpipeline import LogPipeline
+from recordpacker import RecordPacker
+from sdcard import SDCard
+from sd_emulator import SDEmulator
+
+PERIOD_US = 1000
+NUM_SAMPLES = 1000
+STALL_MS = 50
+FIRST_BLOCK = 64
+
+# the host threads share the interpreter, switch often to let the sampler keep its schedule
+sys.setswitchinterval(0.0001)
+
+
+def ticks_us():
+    return time.perf_counter_ns() // 1000
+
+
+class SimulatedIMU:
+    """ raw buffer of an ICM20948, the sample number in the first two axes """
+    def __init__(self):
+        self.acc_gyro_buf = bytearray(12)
+        self.count = 0
+
+    def read_AccelGyro(self):
+        struct.pack_into('>HHhhhh', self.acc_gyro_buf, 0, self.count >> 16, self.count & 0xFFFF,
+                         100, -200, 300, -400)
+        self.count += 1
+
+
+class StallingCard:
+    """ sink writing consecutive blocks to the emulated card, stalling on every fourth write """
+    def __init__(self, stall_ms=STALL_MS):
+        self.stall_ms = stall_ms
+        self.card = SDEmulator(num_blocks=4096)
+        self.sd = SDCard(self.card, self.card.cs, baudrate=25_000_000)
+        self.sd.init_card()
+        self.block = FIRST_BLOCK
+        self.writes = 0
+        self.tail = bytearray()
+
+    def write(self, mv):
+        data = self.tail + bytes(mv)
+        n = len(data) // 512
+        if n:
+            self.sd.writeblocks(self.block, data[:n * 512])
+            self.block += n
+        self.tail = bytearray(data[n * 512:])
+        self.writes += 1
+        if self.writes % 4 == 0:
+            time.sleep(self.stall_ms / 1000)
+
+    def flush(self):
+        if self.tail:
+            self.sd.writeblocks(self.block, self.tail + bytes(512 - len(self.tail)))
+            self.block += 1
+
+    def samples(self):
+        """ sample numbers and timestamps of the records written """
+        data = bytearray((self.block - FIRST_BLOCK) * 512)
+        self.sd.readblocks(FIRST_BLOCK, data)
+        result = []
+        for timestamp, raw in struct.iter_unpack(imulog.RECORD_FORMAT, data):
+            high, low = struct.unpack_from('>HH', raw)
+            if timestamp == 0 and high == 0 and low == 0 and result:
+                break   # padding of the last block
+            result.append(((high << 16) | low, timestamp))
+        return result
+
+
+def sample(packer, imu, num_samples):
+    """ sampling loop of imu_log.py, returns the largest delay of a sample """
+    late = 0
+    next_sample = ticks_us()
+    for i in range(num_samples):
+        while next_sample - ticks_us() > 0:
+            pass
+        timestamp = ticks_us()
+        late = max(late, timestamp - next_sample)
+        imu.read_AccelGyro()
+        imulog.pack_record(packer.buf, packer.fill, timestamp & 0xFFFFFFFF, imu.acc_gyro_buf)
+        packer.commit()
+        next_sample += PERIOD_US
+    return late
+
+
+def max_gap(samples):
+    return max(b[1] - a[1] for a, b in zip(samples, samples[1:]))
+
+
+# single core : the stalls delay the sampling
+card = StallingCard()
+packer = RecordPacker(imulog.RECORD_FORMAT, card.write, num_blocks=8, chunk_blocks=4)
+late = sample(packer, SimulatedIMU(), NUM_SAMPLES)
+packer.flush()
+card.flush()
+samples = card.samples()
+assert [n for n, t in samples] == list(range(NUM_SAMPLES))
+print(f'single core : {late} us late, largest gap {max_gap(samples)} us')
+assert max_gap(samples) >= STALL_MS * 1000
+
+# pipeline : the card is written from the second thread
+card = StallingCard()
+pipe = LogPipeline(imulog.RECORD_FORMAT, num_slots=8, slot_blocks=1)
+pipe.start(card.write)
+late = sample(pipe, SimulatedIMU(), NUM_SAMPLES)
+pipe.close()
+card.flush()
+samples = card.samples()
+print(f'pipeline : {late} us late, largest gap {max_gap(samples)} us, '
+      f'{pipe.written} buffers written, up to {pipe.peak} waiting')
+assert pipe.overruns == 0
+assert pipe.records == NUM_SAMPLES
+assert [n for n, t in samples] == list(range(NUM_SAMPLES)), 'samples missing'
+assert max_gap(samples) < STALL_MS * 1000 // 2, 'gap in the timestamps'
+
+# ring too small for the stalls : overruns are counted, the sampler does not wait
+card = StallingCard(stall_ms=4 * STALL_MS)
+pipe = LogPipeline(imulog.RECORD_FORMAT, num_slots=2, slot_blocks=1)
+pipe.start(card.write)
+late = sample(pipe, SimulatedIMU(), NUM_SAMPLES)
+pipe.close()
+card.flush()
+samples = card.samples()
+print(f'small ring : {late} us late, {pipe.overruns} overruns, {len(samples)} samples written')
+assert pipe.overruns > 0
+assert late < STALL_MS * 1000, 'sampler blocked'
+numbers = [n for n, t in samples]
+assert numbers == sorted(numbers), 'records out of order'
+assert numbers[0] == 0 and numbers[-1] == NUM_SAMPLES - 1
+assert NUM_SAMPLES - len(samples) <= pipe.overruns * 33, 'more samples lost than dropped'
+
+# records crossing the end of the buffers (28 bytes as the 'iffffff' format) stay aligned
+stream = bytearray()
+
+
+def slow_sink(mv):
+    stream.extend(mv)
+    time.sleep(0.005)
+
+
+pipe = LogPipeline('<II20s', num_slots=3, slot_blocks=1)
+pipe.start(slow_sink)
+for n in range(5000):
+    struct.pack_into('<II20s', pipe.buf, pipe.fill, n, 0xA5A5A5A5, bytes(20))
+    pipe.commit()
+pipe.close()
+assert len(stream) % 28 == 0
+numbers = [n for n, marker, pad in struct.iter_unpack('<II20s', stream) if marker == 0xA5A5A5A5]
+assert len(numbers) == len(stream) // 28, 'records misaligned'
+assert numbers == sorted(numbers) and numbers[-1] == 4999
+print(f'28-byte records : {pipe.overruns} overruns, {len(numbers)} of 5000 records written')
+assert pipe.overruns > 0
+print('passed.')
@@ -0,0 +1,150 @@
+"""
+64-bit monotonic microsecond clock extending utime.ticks_us().
+
+utime.ticks_us() wraps around (on the rp2 after 2**30 us, about 18 minutes),
+differences of two readings are only valid with ticks_diff() and only
+within half of that period. MonotonicClock counts the microseconds since
+it was created : it keeps a pair of a ticks_us() reading and the clock value
+at that moment, a later reading is converted by adding its ticks_diff() to
+the pair. The clock value is kept split into high and low part (us >> 29 and
+the lower 29 bits), both stay small ints.
+
+The pair is stored as one tuple and replaced as a whole, so readers on
+either core always see a consistent pair without any lock. Every pair is
+exact, several writers replacing it at the same time just store equally
+valid pairs. It is refreshed when a reading is more than 2**26 us (about a
+minute) after it. Readings more than 2**29 us after the pair would be
+ambiguous, the clock therefore has to be read at least every 7 minutes -
+start_timer() does that with a machine.Timer.
+
+ticks_to_us(), now() and refresh() allocate (a tuple on refresh, and the
+64-bit value once it exceeds the small int range after 2**30 us), they are
+safe in soft (scheduled) callbacks but raise MemoryError in a hard interrupt
+handler. There ticks_to_split() stores the two parts into a buffer created
+beforehand without allocating:
+
+    split = array('i', [0, 0])
+    def handler(pin):                           # hard=True
+        clock.ticks_to_split(utime.ticks_us(), split)
+    ...
+    us = (split[0] << 29) + split[1]            # later, outside the handler
+
+Per sample only ticks are stored relative to an epoch taken from the clock
+now and then, e.g. once per log block:
+
+    clock = MonotonicClock()
+    clock.start_timer()
+    epoch_ticks = utime.ticks_us()
+    epoch_us = clock.ticks_to_us(epoch_ticks)    # 64-bit
+    ...
+    offset = utime.ticks_diff(utime.ticks_us(), epoch_ticks)    # small int
+"""
+
+try:
+    from utime import ticks_us, ticks_diff
+except ImportError:
+    # running on a host computer, ticks wrap as on the rp2
+    import time
+    _TICKS_PERIOD = 1 << 30
+    def ticks_us():
+        return (time.perf_counter_ns() // 1000) & (_TICKS_PERIOD - 1)
+    def ticks_diff(ticks1, ticks2):
+        return ((ticks1 - ticks2 + _TICKS_PERIOD // 2) & (_TICKS_PERIOD - 1)) - _TICKS_PERIOD // 2
+
+# a reading this far after the stored pair replaces it
+_REFRESH_US = 1 << 26
+# the clock value is split into us >> _LOW_BITS and us & _LOW_MASK
+_LOW_BITS = 29
+_LOW_MASK = (1 << _LOW_BITS) - 1
+# interval of the timer refreshing the pair
+_TIMER_MS = 60_000
+
+
+class MonotonicClock:
+    """
+    Microseconds since creation as a 64-bit counter.
+
+    internal variables :
+        ticks : function returning the current ticks, utime.ticks_us by default
+        state (tuple) : a ticks reading and the clock value in us at that reading (high, low part)
+        timer : machine.Timer refreshing the state, None if not started
+
+    counters :
+        refreshes : number of times the state was replaced
+    """
+    def __init__(self, ticks=ticks_us) -> None:
+        """
+        Args:
+            ticks : function returning the current ticks (for tests), defaults to utime.ticks_us
+        """
+        self.ticks = ticks
+        self.state = (ticks(), 0, 0)
+        self.timer = None
+        self.refreshes = 0
+
+    def ticks_to_us(self, ticks:int) -> int:
+        """
+        Convert a ticks reading taken within the last 7 minutes to the clock.
+        Allocates, not for hard interrupt handlers.
+        """
+        state = self.state
+        delta = ticks_diff(ticks, state[0])
+        us = (state[1] << _LOW_BITS) + state[2] + delta
+        if delta > _REFRESH_US:
+            self.state = (ticks, us >> _LOW_BITS, us & _LOW_MASK)
+            self.refreshes += 1
+        return us
+
+    def ticks_to_split(self, ticks:int, out) -> None:
+        """
+        Convert a ticks reading taken within the last 7 minutes to the clock
+        without allocating, also in a hard interrupt handler. The stored pair
+        is not refreshed.
+
+        Args:
+            ticks (int): ticks_us() reading
+            out : buffer of two ints (e.g. array('i', [0, 0])) receiving
+                the clock value as out[0] * 2**29 + out[1], 0 <= out[1] < 2**29
+        """
+        state = self.state
+        high = state[1]
+        # below 2**30 : state[2] < 2**29 and |ticks_diff()| <= 2**29
+        low = state[2] + ticks_diff(ticks, state[0])
+        if low > _LOW_MASK:
+            low -= _LOW_MASK + 1
+            high += 1
+        elif low < 0:
+            low += _LOW_MASK + 1
+            high -= 1
+        out[0] = high
+        out[1] = low
+
+    def now(self) -> int:
+        """
+        Current value of the clock in us.
+        """
+        return self.ticks_to_us(self.ticks())
+
+    def refresh(self, timer=None) -> None:
+        """
+        Replace the stored pair by the current reading (the timer callback).
+        """
+        ticks = self.ticks()
+        state = self.state
+        us = (state[1] << _LOW_BITS) + state[2] + ticks_diff(ticks, state[0])
+        self.state = (ticks, us >> _LOW_BITS, us & _LOW_MASK)
+        self.refreshes += 1
+
+    def start_timer(self, period_ms:int=_TIMER_MS) -> None:
+        """
+        Refresh the pair from a periodic machine.Timer, so the clock stays valid
+        however long it is not read. The callback allocates, it is scheduled
+        as a soft interrupt (the default of hard is port-specific).
+        """
+        from machine import Timer
+        self.timer = Timer(mode=Timer.PERIODIC, period=period_ms, callback=self.refresh, hard=False)
+
+    def stop_timer(self) -> None:
+        if self.timer is not None:
+            self.timer.deinit()
+            self.timer = None
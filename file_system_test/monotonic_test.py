@@ -0,0 +1,110 @@
+"""
+Host-side test of the 64-bit monotonic clock.
+
+The ticks are simulated, wrapping after 2**30 us as utime.ticks_us() does
+on the rp2. Over hours of simulated time, read at irregular intervals
+shorter than 7 minutes, the clock must give the true elapsed time.
+Read from several threads while another one refreshes it (as the timer
+callback does), every thread must see exact, non-decreasing values.
+The non-allocating ticks_to_split() must agree with ticks_to_us().
+
+run with : python3 monotonic_test.py
+"""
+
+import _thread
+import random
+import time
+from array import array
+from monotonic import MonotonicClock
+
+TICKS_PERIOD = 1 << 30
+
+
+class SimulatedTicks:
+    """ a ticks_us() source starting shortly before the wrap-around """
+    def __init__(self):
+        self.us = TICKS_PERIOD - 5_000_000
+
+    def __call__(self):
+        return self.us & (TICKS_PERIOD - 1)
+
+
+ticks = SimulatedTicks()
+start = ticks.us
+clock = MonotonicClock(ticks=ticks)
+assert clock.now() == 0
+
+
+def split_us(reading):
+    split = array('i', [0, 0])
+    clock.ticks_to_split(reading, split)
+    assert 0 <= split[1] < 1 << 29
+    return (split[0] << 29) + split[1]
+
+
+# 6 hours, read every 0.1 to 420 seconds
+rng = random.Random(1)
+last = 0
+while ticks.us - start < 6 * 3600 * 1_000_000:
+    ticks.us += rng.randint(100_000, 420_000_000)
+    assert split_us(ticks()) == ticks.us - start
+    now = clock.now()
+    assert now == ticks.us - start, f'clock {now} us, elapsed {ticks.us - start} us'
+    assert now > last
+    last = now
+print(f'{last / 3.6e9:.1f} h over {(ticks.us - start) // TICKS_PERIOD} wrap-arounds, {clock.refreshes} refreshes')
+assert last > 1 << 32
+
+# ticks read before a refresh by another reader are still converted exactly
+before = ticks()
+ticks.us += 300_000_000
+clock.refresh()
+assert clock.ticks_to_us(before) == ticks.us - start - 300_000_000
+assert split_us(before) == ticks.us - start - 300_000_000
+
+# carry and borrow of the split parts, readings up to 7 minutes before and after the pair
+now = clock.now()
+for delta in range(-420_000_000, 420_000_000, 999_983):
+    assert split_us((ticks() + delta) % TICKS_PERIOD) == now + delta
+
+# concurrent readers and a refreshing thread, the ticks advance from another thread
+errors = []
+done = []
+
+
+def advance():
+    while len(done) < 3:
+        ticks.us += 54_321
+        time.sleep(0.0001)
+    done.append(1)
+
+
+def refresher():
+    while len(done) < 3:
+        clock.refresh()
+        time.sleep(0.0001)
+    done.append(1)
+
+
+def reader():
+    last = clock.now()
+    for i in range(20000):
+        reading = ticks()
+        now = clock.ticks_to_us(reading)
+        if (start + now - reading) % TICKS_PERIOD:
+            errors.append(f'{now} does not match ticks {reading}')
+        if now < last:
+            errors.append(f'clock went back from {last} to {now}')
+        last = now
+    done.append(1)
+
+
+_thread.start_new_thread(advance, ())
+_thread.start_new_thread(refresher, ())
+for i in range(3):
+    _thread.start_new_thread(reader, ())
+while len(done) < 5:
+    time.sleep(0.01)
+assert not errors, errors[:3]
+print(f'{(ticks.us - start) / 3.6e9:.1f} h after the concurrent readers, {clock.refreshes} refreshes')
+print('passed.')
@@ -0,0 +1,86 @@
+"""
+Host-side test of the non-blocking write path of the SDCard driver.
+
+The emulated card (sd_emulator.py) holds MISO low
+for a fixed programming time after each block. A sampler running on the same
+simulated clock takes one sample per millisecond and hands a block to the card
+whenever 512 bytes are collected and the card is not busy.
+With blocking writes samples are lost during the programming time,
+with non-blocking writes sampling continues while the card is busy.
+
+run with : python3 nonblocking_test.py
+"""
+
+import struct
+from sdcard import SDCard
+from sd_emulator import SDEmulator
+
+BAUDRATE = 10_000_000 # 0.8 us per byte
+CALL_US = 5.0         # overhead of one SPI call
+LOOP_US = 50.0        # overhead of one pass of the sampling loop
+PROGRAM_US = 4000.0   # card busy time after each block
+SAMPLE_US = 1000.0    # 1 kHz sampling
+RECORD = 8            # bytes per sample record
+NUM_BLOCKS = 8192
+
+
+def run(nonblocking, duration_us=2_000_000):
+    """
+    Run the sampling loop for the given simulated time.
+    Returns the number of samples taken, the number lost and the number of blocks written.
+    """
+    card = SDEmulator(num_blocks=NUM_BLOCKS, call_us=CALL_US, program_us=PROGRAM_US)
+    sd = SDCard(card, card.cs, baudrate=BAUDRATE, nonblocking=nonblocking)
+    sd.init_card()
+    # the emulator time is the clock of the sampling loop
+    card.reset_counters()
+    # two block buffers : one being filled, one waiting for the card
+    buffers = [bytearray(512), bytearray(512)]
+    active = 0
+    fill = 0
+    waiting = False
+    block_num = 0
+    next_sample = 0.0
+    samples = 0
+    lost = 0
+    while card.time_us < duration_us:
+        card.time_us += LOOP_US
+        if card.time_us >= next_sample:
+            # the sensor has no FIFO, a sample not read in time is overwritten
+            missed = int((card.time_us - next_sample) // SAMPLE_US)
+            lost += missed
+            next_sample += (missed + 1) * SAMPLE_US
+            if fill < 512:
+                struct.pack_into('<Ii', buffers[active], fill, int(card.time_us), samples + lost)
+                fill += RECORD
+                samples += 1
+            else:
+                lost += 1
+            if fill == 512 and not waiting:
+                active ^= 1
+                fill = 0
+                waiting = True
+        if waiting and not sd.busy():
+            sd.writeblocks(block_num, buffers[active ^ 1])
+            block_num += 1
+            waiting = False
+    if sd.busy_pending:
+        sd.wait_ready()
+    return samples, lost, block_num, card
+
+
+for nonblocking in (False, True):
+    samples, lost, blocks, card = run(nonblocking)
+    print(f'nonblocking={nonblocking} : {samples} samples, {lost} lost, {blocks} blocks written')
+
+samples, lost, blocks, card = run(True)
+assert lost == 0, f'{lost} samples lost with non-blocking writes'
+# all samples on the card are consecutive
+index = 0
+for block_num in range(blocks):
+    for offset in range(0, 512, RECORD):
+        t, n = struct.unpack_from('<Ii', card.data, block_num * 512 + offset)
+        assert n == index, f'sample {index} missing'
+        index += 1
+print(f'{index} consecutive samples found on the card.')
+print('passed.')
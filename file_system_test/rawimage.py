@@ -0,0 +1,374 @@
+"""
+Host-side reader of raw SD card images and block devices.
+
+The card (or an image copied with dd) is memory-mapped and decoded with
+NumPy structured dtypes, a chunk of blocks at a time, so the memory used
+does not depend on the size of the capture.
+
+Two layouts are supported:
+    RawLog regions (rawlog.py) : superblock, ring of data blocks with a 16-byte
+        header (magic, record count, sequence number, timestamp, CRC32) and records
+    plain blocks (raw_write_test.py) : one fixed structure at the start of every block,
+        e.g. the int32 timestamp written by the test
+
+Example usage:
+
+    import rawimage
+    img = rawimage.RawImage('/dev/mmcblk0', first_block=first_block)
+    for headers, records in img.chunks():
+        print(records['timestamp'][:10])
+
+    timestamps = rawimage.block_fields('/dev/mmcblk0', '<i', first_block=1, num_blocks=3000)
+
+Command line:
+
+    python3 rawimage.py /dev/mmcblk0 --first-block 8192 --csv imu.csv
+    python3 rawimage.py card.img --plain --first-block 1 --num-blocks 40000
+
+Reading the device requires access rights (sudo chmod 777 /dev/mmcblk0).
+"""
+
+import sys
+import struct
+import zlib
+import argparse
+import numpy as np
+
+# layout of rawlog.py
+BLOCK_SIZE = 512
+HEADER_SIZE = 16
+BLOCK_MAGIC = 0x4C52
+SUPER_MAGIC = b'RLOG'
+SUPER_FORMAT = '<4sHHIIIIII'
+# period of time.ticks_us() on the RP2350
+TICKS_PERIOD = 1 << 30
+
+HEADER_DTYPE = np.dtype([('magic', '<u2'), ('count', '<u2'), ('seq', '<u4'),
+                         ('timestamp', '<u4'), ('crc', '<u4')])
+
+# records written by imu_log.py : struct 'iffffff'
+IMU_RECORD_DTYPE = np.dtype([('timestamp', '<i4'), ('acc_x', '<f4'), ('acc_y', '<f4'), ('acc_z', '<f4'),
+                             ('gyro_x', '<f4'), ('gyro_y', '<f4'), ('gyro_z', '<f4')])
+
+# struct format characters (MicroPython sizes, 'l' is 32 bit) -> NumPy types
+_STRUCT_TYPES = {'b': 'i1', 'B': 'u1', 'h': 'i2', 'H': 'u2', 'i': 'i4', 'I': 'u4',
+                 'l': 'i4', 'L': 'u4', 'q': 'i8', 'Q': 'u8', 'e': 'f2', 'f': 'f4', 'd': 'f8'}
+
+
+def record_dtype(fmt, names=None):
+    """
+    Structured dtype of a record packed with struct.pack(fmt, ...).
+
+    Args:
+        fmt (str): struct format, byte order prefix '<' or '>' (default little-endian)
+        names (list): field names, defaults to f0, f1, ...
+
+    Returns:
+        (np.dtype): packed dtype with the size of the struct
+    """
+    order = '>' if fmt[:1] in ('>', '!') else '<'
+    fmt = fmt.lstrip('<>!=@')
+    types = []
+    count = ''
+    for c in fmt:
+        if c.isdigit():
+            count += c
+        elif c == 'x':
+            types.append(('V', int(count or 1)))
+            count = ''
+        elif c == 's':
+            types.append(('S', int(count or 1)))
+            count = ''
+        else:
+            types += [(order + _STRUCT_TYPES[c], 0)] * int(count or 1)
+            count = ''
+    if names is None:
+        names = [f'f{i}' for i in range(len(types))]
+    if len(names) != len(types):
+        raise ValueError(f'{len(names)} names for {len(types)} fields of {fmt!r}')
+    return np.dtype([(name, t + str(n) if n else t) for name, (t, n) in zip(names, types)])
+
+
+def open_image(path):
+    """
+    Memory-map an image file or block device read-only.
+
+    Returns:
+        (np.memmap): the bytes of the image
+    """
+    return np.memmap(path, dtype=np.uint8, mode='r')
+
+
+def block_fields(image, dtype, first_block=0, num_blocks=None):
+    """
+    Decode a structure at the start of every block, without copying.
+
+    Args:
+        image : path or array returned by open_image()
+        dtype : np.dtype or struct format of the structure
+        first_block (int): first block to decode
+        num_blocks (int): number of blocks, defaults to the end of the image
+
+    Returns:
+        (np.ndarray): strided view, one element per block
+    """
+    if isinstance(image, str):
+        image = open_image(image)
+    if isinstance(dtype, str):
+        dtype = record_dtype(dtype)
+        if len(dtype) == 1:
+            dtype = dtype[0]
+    available = len(image) // BLOCK_SIZE - first_block
+    if num_blocks is None or num_blocks > available:
+        num_blocks = available
+    padded = np.dtype({'names': ['value'], 'formats': [dtype], 'offsets': [0], 'itemsize': BLOCK_SIZE})
+    blocks = image[first_block * BLOCK_SIZE : (first_block + num_blocks) * BLOCK_SIZE].view(padded)
+    return blocks['value']
+
+
+class RawImage:
+    """
+    A RawLog region in a memory-mapped image.
+
+    internal variables :
+        data (np.memmap) : the bytes of the image
+        num_data (int) : number of data blocks in the ring
+        record_dtype (np.dtype) : dtype of the records
+        records_per_block (int) : records per block
+        blocks (np.ndarray) : structured view of the data blocks ('header', 'records')
+        log_id (int) : seed of the block CRCs
+    """
+    def __init__(self, path, first_block=0, record_dtype=None):
+        """
+        Args:
+            path (str): image file or block device
+            first_block (int): block holding the superblock of the log
+            record_dtype (np.dtype): dtype of the records, defaults to IMU_RECORD_DTYPE
+                for 28-byte records and to raw bytes otherwise
+        """
+        self.data = open_image(path)
+        self.first_block = first_block
+        offset = first_block * BLOCK_SIZE
+        superblock = self.data[offset : offset + 32].tobytes()
+        if len(superblock) < 32:
+            raise ValueError(f'block {first_block} is beyond the end of {path}')
+        magic, version, header_size, first_data, num_data, record_size, log_id, created, crc = \
+            struct.unpack(SUPER_FORMAT, superblock)
+        if magic != SUPER_MAGIC or crc != zlib.crc32(superblock[:28]):
+            raise ValueError(f'no log at block {first_block} of {path}')
+        if version != 1 or header_size != HEADER_SIZE:
+            raise ValueError(f'log format version {version} not supported')
+        if record_dtype is None:
+            record_dtype = IMU_RECORD_DTYPE if record_size == IMU_RECORD_DTYPE.itemsize else np.dtype(f'V{record_size}')
+        if record_dtype.itemsize != record_size:
+            raise ValueError(f'record dtype of {record_dtype.itemsize} bytes, the log has {record_size}')
+        self.first_data = first_data
+        self.num_data = num_data
+        self.log_id = log_id
+        self.created = created
+        self.record_dtype = record_dtype
+        self.records_per_block = (BLOCK_SIZE - HEADER_SIZE) // record_size
+        self.block_dtype = np.dtype({
+            'names': ['header', 'records'],
+            'formats': [HEADER_DTYPE, (record_dtype, (self.records_per_block,))],
+            'offsets': [0, HEADER_SIZE],
+            'itemsize': BLOCK_SIZE})
+        end = (first_data + num_data) * BLOCK_SIZE
+        if end > len(self.data):
+            raise ValueError(f'log of {num_data} blocks exceeds the image')
+        self.raw = self.data[first_data * BLOCK_SIZE : end].reshape(num_data, BLOCK_SIZE)
+        self.blocks = self.data[first_data * BLOCK_SIZE : end].view(self.block_dtype)
+
+    def valid(self, first, last, check_crc=True):
+        """
+        Check the headers of a range of blocks. The magic and the record count are
+        compared for all blocks at once, the CRCs (check_crc) block by block with
+        zlib : this is the deliberate slow path of reading a log, about 1.3 us per
+        block. A table-driven CRC over a 2-D view of all blocks in NumPy measured
+        5 times slower, as it needs one gather per byte against zlib's per-block
+        call overhead. Skip the check with check_crc=False (--no-crc) for speed.
+
+        Returns:
+            (np.ndarray): bool per block of the slots first..last-1, True for valid blocks of this log
+        """
+        headers = self.blocks['header'][first:last]
+        ok = (headers['magic'] == BLOCK_MAGIC) & (headers['count'] <= self.records_per_block)
+        if check_crc:
+            raw = self.raw
+            crc = headers['crc']
+            log_id = self.log_id
+            for i in np.flatnonzero(ok):
+                block = raw[first + i]
+                ok[i] = zlib.crc32(block[HEADER_SIZE:], zlib.crc32(block[:12], log_id)) == crc[i]
+        return ok
+
+    def find_head(self):
+        """
+        Binary search for the last block written, as RawLog.find_head().
+
+        Returns:
+            (int): slot of the last block, -1 if the log is empty
+        """
+        seq = self.blocks['header']['seq']
+        if not self.valid(0, 1)[0]:
+            last = self.num_data - 1
+            return last if self.valid(last, last + 1)[0] else -1
+        low = 0
+        high = self.num_data - 1
+        while low < high:
+            mid = (low + high + 1) // 2
+            if self.valid(mid, mid + 1)[0] and seq[mid] == seq[0] + mid:
+                low = mid
+            else:
+                high = mid - 1
+        return low
+
+    def slot_ranges(self):
+        """
+        Returns:
+            (list): (first, last) slot ranges holding the log from the oldest to the newest block
+        """
+        head = self.find_head()
+        if head < 0:
+            return []
+        last = self.num_data - 1
+        seq = self.blocks['header']['seq']
+        if head < last and self.valid(last, last + 1)[0] and \
+                int(seq[last]) == int(seq[head]) - head - 1:
+            # the ring has wrapped, the oldest blocks follow the head
+            return [(head + 1, self.num_data), (0, head + 1)]
+        return [(0, head + 1)]
+
+    def chunks(self, chunk_blocks=65536, check_crc=True):
+        """
+        Iterate over the log from the oldest to the newest block.
+        Yields (headers, records) per chunk of at most chunk_blocks blocks :
+        the headers of the valid blocks and their records as one flat array.
+        Invalid blocks (never written, torn or of another log) are skipped.
+        """
+        rpb = self.records_per_block
+        for first, last in self.slot_ranges():
+            for start in range(first, last, chunk_blocks):
+                stop = min(start + chunk_blocks, last)
+                blocks = self.blocks[start:stop][self.valid(start, stop, check_crc)]
+                headers = blocks['header']
+                used = np.arange(rpb) < headers['count'][:, None]
+                yield headers, blocks['records'][used]
+
+    def headers(self, check_crc=True):
+        """
+        Returns:
+            (np.ndarray): headers of all valid blocks from the oldest to the newest
+        """
+        parts = [h.copy() for h, r in self.chunks(check_crc=check_crc)]
+        return np.concatenate(parts) if parts else np.zeros(0, HEADER_DTYPE)
+
+
+def intervals(timestamps):
+    """ time differences of ticks_us() values, taking the wraparound into account """
+    return np.diff(timestamps.astype(np.int64)) % TICKS_PERIOD
+
+
+def summarize_log(img, args):
+    print(f'log at block {img.first_block} : {img.num_data} data blocks, '
+          f'{img.records_per_block} records of {img.record_dtype.itemsize} bytes per block')
+    num_blocks = 0
+    num_records = 0
+    gaps = 0
+    last_seq = None
+    last_time = None
+    max_interval = 0
+    names = img.record_dtype.names
+    out = open(args.csv, 'w') if args.csv else None
+    if out and names:
+        out.write(','.join(names) + '\n')
+    binary = open(args.bin, 'wb') if args.bin else None
+    for headers, records in img.chunks(args.chunk, not args.no_crc):
+        if not len(headers):
+            continue
+        seq = headers['seq'].astype(np.int64)
+        if last_seq is not None:
+            seq = np.concatenate(([last_seq], seq))
+            times = np.concatenate(([last_time], headers['timestamp']))
+        else:
+            first_seq = seq[0]
+            times = headers['timestamp']
+        gaps += int(np.count_nonzero(np.diff(seq) != 1))
+        if len(times) > 1:
+            max_interval = max(max_interval, int(intervals(times).max()))
+        last_seq = int(seq[-1])
+        last_time = headers['timestamp'][-1]
+        num_blocks += len(headers)
+        num_records += len(records)
+        if out:
+            np.savetxt(out, records, delimiter=',', fmt='%.9g' if names else '%s')
+        if binary:
+            records.tofile(binary)
+    if out:
+        out.close()
+    if binary:
+        binary.close()
+    if not num_blocks:
+        print('the log is empty')
+        return
+    print(f'blocks {first_seq} ... {last_seq} : {num_blocks} valid, {gaps} gaps, {num_records} records')
+    print(f'longest interval between blocks : {max_interval} us')
+
+
+def summarize_plain(args, dtype):
+    image = open_image(args.image)
+    values = block_fields(image, dtype, args.first_block, args.num_blocks)
+    print(f'{len(values)} blocks from block {args.first_block}, fields {dtype.names}')
+    field = values[dtype.names[0]]
+    total = 0
+    longest = 0
+    for start in range(0, len(values), args.chunk):
+        # include the last value of the previous chunk for the intervals
+        t = field[max(start - 1, 0) : start + args.chunk]
+        if len(t) > 1:
+            dt = intervals(t)
+            total += int(dt.sum())
+            longest = max(longest, int(dt.max()))
+    if len(values) > 1:
+        print(f'{dtype.names[0]} : mean interval {total / (len(values) - 1):.1f}, longest {longest}')
+    if args.csv:
+        with open(args.csv, 'w') as out:
+            out.write(','.join(dtype.names) + '\n')
+            for start in range(0, len(values), args.chunk):
+                np.savetxt(out, values[start : start + args.chunk], delimiter=',', fmt='%.9g')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='decode raw SD card images and RawLog regions')
+    parser.add_argument('image', help='image file or block device, e.g. /dev/mmcblk0')
+    parser.add_argument('--first-block', type=int, default=0,
+                        help='superblock of the log, or first block with --plain')
+    parser.add_argument('--format', default='<iffffff',
+                        help='struct format of the records (default %(default)s, the IMU records)')
+    parser.add_argument('--names', help='comma-separated field names of the records')
+    parser.add_argument('--plain', action='store_true',
+                        help='no RawLog, decode --format at the start of every block')
+    parser.add_argument('--num-blocks', type=int, help='number of blocks with --plain')
+    parser.add_argument('--chunk', type=int, default=65536, help='blocks decoded at once')
+    parser.add_argument('--no-crc', action='store_true', help='do not check the block CRCs')
+    parser.add_argument('--csv', help='write the records to a CSV file')
+    parser.add_argument('--bin', help='write the records to a binary file (np.fromfile with the record dtype)')
+    args = parser.parse_args(argv)
+    if args.names:
+        dtype = record_dtype(args.format, args.names.split(','))
+    elif args.format == '<iffffff':
+        dtype = IMU_RECORD_DTYPE
+    else:
+        dtype = record_dtype(args.format)
+    if args.plain:
+        summarize_plain(args, dtype)
+        return
+    try:
+        img = RawImage(args.image, args.first_block, dtype)
+    except ValueError as e:
+        sys.exit(str(e))
+    summarize_log(img, args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+"""
+Host-side test of the raw image reader (requires NumPy).
+
+A RawLog is written to a RAM block device, the device content is saved as
+an image file and decoded again with rawimage.RawImage, also after the ring
+has wrapped around and in chunks smaller than the log. Blocks with a
+corrupted header or record must be rejected by their CRC.
+
+run with : python3 rawimage_test.py
+"""
+
+import os
+import struct
+import tempfile
+import numpy as np
+import rawimage
+from rawlog import RawLog
+
+FIRST_BLOCK = 8
+NUM_BLOCKS = 101      # superblock + 100 data blocks
+RECORD = struct.Struct('<iffffff')
+
+
+class RAMBlockDevice:
+    def __init__(self, blocks):
+        self.data = bytearray(blocks * 512)
+
+    def readblocks(self, block, buf, off=0):
+        buf[:] = self.data[block * 512 + off : block * 512 + off + len(buf)]
+
+    def writeblocks(self, block, buf, off=0):
+        self.data[block * 512 + off : block * 512 + off + len(buf)] = buf
+
+    def ioctl(self, op, arg):
+        return 0
+
+
+def write_image(dev):
+    path = os.path.join(tempfile.mkdtemp(), 'card.img')
+    with open(path, 'wb') as f:
+        f.write(dev.data)
+    return path
+
+
+def read_all(path, chunk_blocks):
+    img = rawimage.RawImage(path, FIRST_BLOCK)
+    parts = [r.copy() for h, r in img.chunks(chunk_blocks)]
+    return np.concatenate(parts)
+
+
+dev = RAMBlockDevice(256)
+log = RawLog(dev, FIRST_BLOCK, NUM_BLOCKS, record_size=RECORD.size)
+log.format()
+per_block = log.records_per_block
+n = 30 * per_block + 3
+for i in range(n):
+    log.append(RECORD.pack(i, i * 0.5, 0.2, 0.3, 1.0, 2.0, 3.0))
+log.flush()
+records = read_all(write_image(dev), 7)
+print(f'{len(records)} records in {log.seq} blocks')
+assert records.dtype == rawimage.IMU_RECORD_DTYPE
+assert np.array_equal(records['timestamp'], np.arange(n))
+assert np.allclose(records['acc_x'], np.arange(n) * 0.5)
+
+# after the wraparound the oldest blocks come first
+for i in range(n, n + 120 * per_block):
+    log.append(RECORD.pack(i, i * 0.5, 0.2, 0.3, 1.0, 2.0, 3.0))
+log.flush()
+path = write_image(dev)
+records = read_all(path, 16)
+end = n + 120 * per_block
+print(f'after wraparound : {len(records)} records from {records["timestamp"][0]} to {records["timestamp"][-1]}')
+assert records['timestamp'][-1] == end - 1
+assert np.array_equal(np.diff(records['timestamp']), np.ones(len(records) - 1))
+assert len(records) == 100 * per_block
+
+# a corrupted block is skipped
+img = rawimage.RawImage(path, FIRST_BLOCK)
+headers = img.headers()
+assert np.array_equal(np.diff(headers['seq'].astype(int)), np.ones(99))
+data = bytearray(dev.data)
+data[(FIRST_BLOCK + 1 + 50) * 512 + 200] ^= 0xFF
+with open(path, 'wb') as f:
+    f.write(data)
+assert len(rawimage.RawImage(path, FIRST_BLOCK).headers()) == 99
+
+# the CRC covers the header as well
+data[(FIRST_BLOCK + 1 + 60) * 512 + 5] ^= 0x01
+with open(path, 'wb') as f:
+    f.write(data)
+valid = rawimage.RawImage(path, FIRST_BLOCK).valid(0, NUM_BLOCKS - 1)
+assert list(np.flatnonzero(~valid)) == [50, 60]
+
+# plain blocks : a timestamp at the start of every block
+plain = RAMBlockDevice(64)
+for block in range(64):
+    struct.pack_into('<ii', plain.data, block * 512, 1000 * block, block)
+path = write_image(plain)
+values = rawimage.block_fields(path, '<ii', first_block=1)
+assert len(values) == 63 and values['f1'][0] == 1 and values['f0'][-1] == 63000
+timestamps = rawimage.block_fields(path, '<i', first_block=1, num_blocks=10)
+assert np.array_equal(timestamps, np.arange(1, 11) * 1000)
+rawimage.main([path, '--plain', '--first-block', '1', '--format', '<ii', '--names', 'time,index', '--chunk', '5'])
+print('passed.')
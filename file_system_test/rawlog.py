@@ -0,0 +1,273 @@
+"""
+Raw ring-buffer log store on a block device, bypassing the filesystem.
+
+A region of the card holds a superblock followed by a ring of data blocks.
+Every data block carries a self-describing header, so the log can be read
+back (and the write head recovered) without any filesystem metadata:
+
+    superblock (first block of the region) :
+        0  magic b'RLOG'
+        4  version (uint16)
+        6  header size (uint16)
+        8  first data block (uint32)
+        12 number of data blocks (uint32)
+        16 record size in bytes (uint32)
+        20 log id (uint32)
+        24 creation timestamp (uint32)
+        28 CRC32 of bytes 0..27
+
+    data block header (little-endian) :
+        0  magic 0x4C52 'RL' (uint16)
+        2  number of records in the block (uint16)
+        4  sequence number (uint32), starting at 1
+        8  timestamp (uint32, ticks_us when the block was completed)
+        12 CRC32 of the rest of the block, seeded with the log id
+    followed by the records, packed without gaps
+
+The block with sequence number seq lives in slot (seq-1) % num_data, so the
+ring is written in order and wraps around, overwriting the oldest blocks.
+Seeding the CRC with the log id makes blocks of an earlier log in the same
+region invalid after format(). When the log is opened the write head is found
+by a binary search over the slots: starting from slot 0 the sequence numbers
+increase by one up to the head, behind it they belong to the previous round
+(or the blocks are invalid). This takes log2(num_data) block reads.
+
+On an SDCard the blocks are written in multi-block mode (stream_open()),
+the stream is only interrupted at the end of the ring.
+
+Example usage:
+
+    log = RawLog(sd, first_block, num_blocks, record_size=28)
+    log.format()            # once, or log.open() to continue an existing log
+    log.append(record)
+    ...
+    log.flush()             # writes the last partial block and syncs the card
+"""
+
+import time
+import struct
+from binascii import crc32
+try:
+    from time import ticks_us
+except ImportError:
+    def ticks_us():
+        return (time.perf_counter_ns() // 1000) & 0x3FFFFFFF
+
+_BLOCK_SIZE = 512
+_HEADER_SIZE = 16
+_PAYLOAD_SIZE = _BLOCK_SIZE - _HEADER_SIZE
+_VERSION = 1
+_SUPER_MAGIC = b'RLOG'
+_SUPER_FORMAT = '<4sHHIIIIII'
+_BLOCK_MAGIC = 0x4C52
+_HEADER_FORMAT = '<HHIII'
+
+
+class RawLog:
+    """
+    Ring-buffer log of fixed-size records in a region of a block device.
+
+    internal variables :
+        device : the block device (SDCard or anything with readblocks/writeblocks/ioctl)
+        first_block (int) : superblock, the data blocks follow it
+        num_data (int) : number of data blocks in the ring
+        record_size (int) : bytes per record
+        records_per_block (int) : records fitting into one block
+        log_id (int) : random id of the log, seeds the block CRCs
+        seq (int) : sequence number of the last block written, 0 if the log is empty
+        block (bytearray) : the block being filled
+        count (int) : number of records in it
+    """
+    def __init__(self, device, first_block:int, num_blocks:int, record_size:int=0) -> None:
+        """
+        Args:
+            device : block device providing readblocks(), writeblocks() and ioctl()
+            first_block (int): first block of the region (the superblock)
+            num_blocks (int): size of the region including the superblock
+            record_size (int): bytes per record, read from the superblock by open()
+        """
+        self.device = device
+        self.first_block = first_block
+        self.num_data = num_blocks - 1
+        self.record_size = record_size
+        self.records_per_block = _PAYLOAD_SIZE // record_size if record_size else 0
+        self.log_id = 0
+        self.seq = 0
+        self.block = bytearray(_BLOCK_SIZE)
+        self.block_mv = memoryview(self.block)
+        self.count = 0
+        self.streaming = hasattr(device, 'stream_open')
+
+    # ------------------------------------------------------------------
+    # superblock and block headers
+
+    def format(self, log_id:int=None) -> None:
+        """
+        Create a new empty log in the region by writing the superblock.
+        Data blocks of a previous log become invalid through the new log id.
+        """
+        if not self.records_per_block or self.record_size > _PAYLOAD_SIZE:
+            raise ValueError(f'[RawLog] record size {self.record_size} not supported')
+        if log_id is None:
+            log_id = (ticks_us() * 2654435761 + self.first_block) & 0xFFFFFFFF
+        self.log_id = log_id
+        buf = bytearray(_BLOCK_SIZE)
+        struct.pack_into(_SUPER_FORMAT, buf, 0, _SUPER_MAGIC, _VERSION, _HEADER_SIZE,
+                         self.first_block + 1, self.num_data, self.record_size, log_id, ticks_us(), 0)
+        struct.pack_into('<I', buf, 28, crc32(buf[:28]))
+        self.device.writeblocks(self.first_block, buf)
+        self.device.ioctl(3, 0)
+        self.seq = 0
+        self.count = 0
+
+    def open(self) -> int:
+        """
+        Read the superblock and find the write head of an existing log.
+        New records are appended behind the last block found.
+
+        Returns:
+            (int): sequence number of the last block, 0 if the log is empty
+        """
+        buf = self.block
+        self.device.readblocks(self.first_block, buf)
+        magic, version, header_size, first_data, num_data, record_size, log_id, created, crc = \
+            struct.unpack_from(_SUPER_FORMAT, buf, 0)
+        if magic != _SUPER_MAGIC or crc != crc32(buf[:28]):
+            raise OSError(f'[RawLog] no log at block {self.first_block}')
+        if version != _VERSION or header_size != _HEADER_SIZE or first_data != self.first_block + 1:
+            raise OSError(f'[RawLog] log format version {version} not supported')
+        self.num_data = num_data
+        self.record_size = record_size
+        self.records_per_block = _PAYLOAD_SIZE // record_size
+        self.log_id = log_id
+        self.seq = self.find_head()
+        self.count = 0
+        return self.seq
+
+    def read_header(self, slot:int, buf):
+        """
+        Read a data block and check its header.
+
+        Args:
+            slot (int): index of the block in the ring
+            buf (bytearray): 512 bytes receiving the block
+
+        Returns:
+            (tuple): (seq, timestamp, count) or None if the block is not a valid block of this log
+        """
+        self.device.readblocks(self.first_block + 1 + slot, buf)
+        magic, count, seq, timestamp, crc = struct.unpack_from(_HEADER_FORMAT, buf, 0)
+        if magic != _BLOCK_MAGIC or count > self.records_per_block:
+            return None
+        mv = memoryview(buf)
+        if crc != crc32(mv[_HEADER_SIZE:], crc32(mv[:12], self.log_id)):
+            return None
+        return seq, timestamp, count
+
+    def find_head(self) -> int:
+        """
+        Binary search for the last block written.
+        Slots 0..head hold consecutive sequence numbers,
+        the slots behind the head are older or invalid.
+        A block torn by a power loss during writing is invalid,
+        the head is then the block written before it.
+
+        Returns:
+            (int): sequence number of the last block, 0 if the log is empty
+        """
+        buf = self.block
+        header = self.read_header(0, buf)
+        if header is None:
+            # empty, or the ring has wrapped and the block written last (slot 0) is torn
+            header = self.read_header(self.num_data - 1, buf)
+            return 0 if header is None else header[0]
+        seq0 = header[0]
+        low = 0
+        high = self.num_data - 1
+        while low < high:
+            mid = (low + high + 1) // 2
+            header = self.read_header(mid, buf)
+            if header is not None and header[0] == seq0 + mid:
+                low = mid
+            else:
+                high = mid - 1
+        return seq0 + low
+
+    # ------------------------------------------------------------------
+    # writing
+
+    def slot_block(self, seq:int) -> int:
+        """
+        Returns:
+            (int): device block holding the block with sequence number seq
+        """
+        return self.first_block + 1 + (seq - 1) % self.num_data
+
+    def append(self, record) -> None:
+        """
+        Append one record (record_size bytes) to the log.
+        The block is written to the device as soon as it is full.
+        """
+        offset = _HEADER_SIZE + self.count * self.record_size
+        self.block_mv[offset : offset + self.record_size] = record
+        self.count += 1
+        if self.count == self.records_per_block:
+            self.write_block()
+
+    def write_block(self, timestamp:int=None) -> None:
+        """
+        Complete the header of the current block and write it to the next slot of the ring.
+        """
+        if not self.count:
+            return
+        seq = self.seq + 1
+        if timestamp is None:
+            timestamp = ticks_us()
+        buf = self.block
+        mv = self.block_mv
+        # unused record space is cleared, so a block is independent of earlier content
+        end = _HEADER_SIZE + self.count * self.record_size
+        for i in range(end, _BLOCK_SIZE):
+            buf[i] = 0
+        struct.pack_into('<HHII', buf, 0, _BLOCK_MAGIC, self.count, seq, timestamp)
+        struct.pack_into('<I', buf, 12, crc32(mv[_HEADER_SIZE:], crc32(mv[:12], self.log_id)))
+        block_num = self.slot_block(seq)
+        device = self.device
+        if self.streaming and device.stream_block != block_num:
+            # (re)start the multi-block write, at the beginning or after a wrap of the ring
+            device.stream_open(block_num)
+        device.writeblocks(block_num, buf)
+        self.seq = seq
+        self.count = 0
+
+    def flush(self) -> None:
+        """
+        Write the current partial block (if any) and sync the device.
+        Appending continues in the next block.
+        """
+        self.write_block()
+        self.device.ioctl(3, 0)
+
+    # ------------------------------------------------------------------
+    # reading
+
+    def first_seq(self) -> int:
+        """
+        Returns:
+            (int): sequence number of the oldest block still in the ring
+        """
+        return max(1, self.seq - self.num_data + 1)
+
+    def blocks(self, buf=None):
+        """
+        Iterate over the valid blocks from the oldest to the newest.
+        Yields (seq, timestamp, count, payload) with the payload as memoryview
+        into buf (512 bytes, defaults to an internal buffer), valid until the next block.
+        """
+        if buf is None:
+            buf = bytearray(_BLOCK_SIZE)
+        payload = memoryview(buf)[_HEADER_SIZE:]
+        for seq in range(self.first_seq(), self.seq + 1):
+            header = self.read_header((seq - 1) % self.num_data, buf)
+            if header is not None and header[0] == seq:
+                yield seq, header[1], header[2], payload[: header[2] * self.record_size]
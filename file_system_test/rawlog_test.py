@@ -0,0 +1,84 @@
+"""
+Host-side test of the raw ring-buffer log store.
+
+The log is written through the SDCard driver to the SD card emulator
+(sd_emulator.py). The test fills the ring more than once, reopens the log
+as after a reboot and checks that the write head is found and that the
+blocks read back hold consecutive records, also after a torn last block.
+
+run with : python3 rawlog_test.py
+"""
+
+import struct
+from sdcard import SDCard
+from sd_emulator import SDEmulator
+from rawlog import RawLog
+
+FIRST_BLOCK = 100
+NUM_BLOCKS = 41       # superblock + 40 data blocks
+RECORD = struct.Struct('<Iffffff')
+
+card = SDEmulator(num_blocks=1024)
+sd = SDCard(card, card.cs, baudrate=25_000_000)
+sd.init_card()
+
+
+def write_records(log, first, count):
+    for i in range(first, first + count):
+        log.append(RECORD.pack(i, 0.1, 0.2, 0.3, 1.0, 2.0, 3.0))
+
+
+def check(log):
+    """ all records in the log are consecutive, returns the first and the number of records """
+    first = None
+    n = 0
+    for seq, timestamp, count, payload in log.blocks():
+        for i in range(count):
+            index = RECORD.unpack_from(payload, i * RECORD.size)[0]
+            if first is None:
+                first = index
+            assert index == first + n, f'block {seq} : record {index}, expected {first + n}'
+            n += 1
+    return first, n
+
+
+log = RawLog(sd, FIRST_BLOCK, NUM_BLOCKS, record_size=RECORD.size)
+log.format(log_id=0x1234)
+per_block = log.records_per_block
+assert log.open() == 0
+
+# part of the ring, the card stays in one multi-block write
+card.reset_counters()
+write_records(log, 0, 10 * per_block + 5)
+log.flush()
+print(f'{log.seq} blocks written with {card.commands}')
+assert card.commands.get('CMD25') == 1 and 'CMD24' not in card.commands
+assert RawLog(sd, FIRST_BLOCK, NUM_BLOCKS).open() == 11
+assert check(log) == (0, 10 * per_block + 5)
+
+# wrap around : the oldest blocks are overwritten
+write_records(log, 10 * per_block + 5, 70 * per_block)
+log.flush()
+log2 = RawLog(sd, FIRST_BLOCK, NUM_BLOCKS)
+assert log2.open() == log.seq == 81
+first, n = check(log2)
+print(f'after wraparound : head at block {log2.seq}, {n} records from {first}')
+assert n == 40 * per_block and first + n == 80 * per_block + 5
+
+# a torn last block is dropped, appending continues behind the valid blocks
+slot = (log2.seq - 1) % log2.num_data
+card.data[(FIRST_BLOCK + 1 + slot) * 512 + 100] ^= 0xFF
+log3 = RawLog(sd, FIRST_BLOCK, NUM_BLOCKS)
+assert log3.open() == 80
+write_records(log3, 0, per_block)
+log3.flush()
+assert RawLog(sd, FIRST_BLOCK, NUM_BLOCKS).open() == 81
+write_records(log3, 0, 5 * per_block)
+slot = (log3.seq - 1) % log3.num_data
+card.data[(FIRST_BLOCK + 1 + slot) * 512 + 20] ^= 0x01
+assert RawLog(sd, FIRST_BLOCK, NUM_BLOCKS).open() == 85
+
+# a new log in the same region starts empty
+log.format()
+assert RawLog(sd, FIRST_BLOCK, NUM_BLOCKS).open() == 0
+print('passed.')
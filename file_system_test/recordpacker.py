@@ -0,0 +1,134 @@
+"""
+Block-aligned packing of fixed-size records without allocations.
+
+Records are packed with struct.pack_into() directly into a preallocated ring
+of 512-byte blocks. Only complete blocks are handed to the storage layer
+(a file or block device write), as memoryviews prepared when the packer
+is created, so the sampling loop allocates nothing. A record crossing the
+end of the ring continues at its start, records are therefore stored
+without gaps and the blocks handed over form one contiguous stream.
+
+Complete blocks are handed over when chunk_blocks of them are waiting, or
+earlier as soon as ready() returns True (e.g. when the card is not busy).
+If the ring runs full they are handed over regardless.
+
+Example usage:
+
+    packer = RecordPacker('<iffffff', f.write, num_blocks=8, ready=lambda: not sd.busy())
+    while logging:
+        struct.pack_into('<iffffff', packer.buf, packer.fill, timestamp, ax, ay, az, gx, gy, gz)
+        packer.commit()
+    packer.flush()      # hands over the last partial block
+"""
+
+import struct
+
+_BLOCK_SIZE = 512
+
+
+class RecordPacker:
+    """
+    Ring of 512-byte blocks collecting fixed-size records.
+
+    internal variables :
+        buf (bytearray) : the ring plus room for the part of a record crossing its end
+        fill (int) : offset in buf where the next record is packed
+        size (int) : bytes per record
+        num_blocks (int) : blocks in the ring
+        head (int) : first block not yet handed over
+        wrapped (bool) : the records waiting continue from the end of the ring at its start
+        views (list) : views[first][count-1] is the memoryview of count blocks from block first
+
+    counters :
+        records : number of records committed
+        handovers : number of calls of the sink
+        blocks : number of blocks handed over
+    """
+    def __init__(self, fmt:str, sink, num_blocks:int=8, chunk_blocks:int=None, ready=None) -> None:
+        """
+        Args:
+            fmt (str): struct format of the records
+            sink : called with a memoryview of complete blocks, e.g. f.write or a stream write
+            num_blocks (int): blocks in the ring - defaults to 8 (4 kB)
+            chunk_blocks (int): blocks collected before they are handed over - defaults to half the ring
+            ready : optional function, complete blocks are handed over early when it returns True
+        """
+        self.size = struct.calcsize(fmt)
+        if self.size > _BLOCK_SIZE or num_blocks < 2:
+            raise ValueError(f'[RecordPacker] {self.size}-byte records in {num_blocks} blocks not supported')
+        self.sink = sink
+        self.ready = ready
+        self.num_blocks = num_blocks
+        self.chunk_blocks = chunk_blocks or num_blocks // 2
+        self.capacity = num_blocks * _BLOCK_SIZE
+        self.buf = bytearray(self.capacity + self.size)
+        self.mv = memoryview(self.buf)
+        self.views = [[self.mv[first * _BLOCK_SIZE : (first + count) * _BLOCK_SIZE]
+                       for count in range(1, num_blocks - first + 1)]
+                      for first in range(num_blocks)]
+        self.fill = 0
+        self.head = 0
+        self.wrapped = False
+        self.records = 0
+        self.handovers = 0
+        self.blocks = 0
+
+    def commit(self) -> None:
+        """
+        Account for the record just packed at offset fill and hand over complete blocks if due.
+        """
+        fill = self.fill + self.size
+        self.records += 1
+        if fill >= self.capacity:
+            # the blocks up to the end of the ring are complete now,
+            # block 0 receives the rest of the record and must have been handed over
+            if self.head == 0:
+                self.handover(self.num_blocks)
+            else:
+                self.wrapped = True
+            buf = self.buf
+            capacity = self.capacity
+            fill -= capacity
+            for i in range(fill):
+                buf[i] = buf[capacity + i]
+        self.fill = fill
+        # complete blocks waiting in one contiguous run from the head
+        if self.wrapped:
+            waiting = self.num_blocks - self.head
+        else:
+            waiting = fill // _BLOCK_SIZE - self.head
+        if not waiting:
+            return
+        if waiting >= self.chunk_blocks or (self.ready is not None and self.ready()):
+            self.handover(waiting)
+        elif self.wrapped and fill + self.size > self.head * _BLOCK_SIZE:
+            # the next record would overwrite blocks not handed over
+            self.handover(waiting)
+
+    def handover(self, count:int) -> None:
+        """
+        Pass count complete blocks from the head to the sink.
+        """
+        self.sink(self.views[self.head][count - 1])
+        self.handovers += 1
+        self.blocks += count
+        self.head += count
+        if self.head == self.num_blocks:
+            self.head = 0
+            self.wrapped = False
+
+    def flush(self) -> None:
+        """
+        Hand over all records collected, including the last partial block.
+        Packing continues at the start of the ring.
+        """
+        if self.wrapped:
+            self.handover(self.num_blocks - self.head)
+        waiting = self.fill // _BLOCK_SIZE - self.head
+        if waiting:
+            self.handover(waiting)
+        if self.fill > self.head * _BLOCK_SIZE:
+            self.sink(self.mv[self.head * _BLOCK_SIZE : self.fill])
+            self.handovers += 1
+        self.fill = 0
+        self.head = 0
@@ -0,0 +1,69 @@
+"""
+Host-side test of the block-aligned record packer.
+
+Records are packed into rings of different sizes, with and without early
+hand-over. Every hand-over except the final flush must consist of complete
+512-byte blocks, and the concatenated stream must hold all records in order.
+
+run with : python3 recordpacker_test.py
+"""
+
+import random
+import struct
+from recordpacker import RecordPacker
+
+FMT = '<iffffff'
+RECORD = struct.Struct(FMT)
+
+
+def run(num_records, num_blocks, chunk_blocks=None, ready=None):
+    chunks = []
+    packer = RecordPacker(FMT, lambda mv: chunks.append(bytes(mv)), num_blocks, chunk_blocks, ready)
+    for i in range(num_records):
+        struct.pack_into(FMT, packer.buf, packer.fill, i, i * 0.5, 0.0, 1.0, 2.0, 3.0, 4.0)
+        packer.commit()
+    complete = len(chunks)
+    packer.flush()
+    for chunk in chunks[:complete]:
+        assert len(chunk) % 512 == 0 and len(chunk) <= num_blocks * 512, f'chunk of {len(chunk)} bytes'
+    data = b''.join(chunks)
+    assert len(data) == num_records * RECORD.size
+    for i in range(num_records):
+        index, half = RECORD.unpack_from(data, i * RECORD.size)[:2]
+        assert index == i and half == i * 0.5, f'record {i} : {index}'
+    return packer, chunks
+
+
+packer, chunks = run(1000, 8)
+print(f'8 blocks : {len(chunks)} hand-overs of {[len(c) // 512 for c in chunks[:4]]} ... blocks')
+assert packer.records == 1000 and all(len(c) == 4 * 512 for c in chunks[:13])
+
+# a ring of two blocks, hand-over of single blocks
+packer, chunks = run(500, 2, chunk_blocks=1)
+assert all(len(c) == 512 for c in chunks[:-1])
+
+# early hand-over whenever the storage is ready
+rng = random.Random(1)
+
+
+def ready():
+    return rng.random() < 0.03
+
+
+packer, chunks = run(3000, 8, chunk_blocks=8, ready=ready)
+sizes = sorted(set(len(c) // 512 for c in chunks[:-1]))
+print(f'early hand-over : {len(chunks)} hand-overs, sizes {sizes} blocks')
+assert len(sizes) > 1
+
+# records not dividing the block size, flush in the middle
+chunks = []
+packer = RecordPacker('<iiii', lambda mv: chunks.append(bytes(mv)), 4)
+for i in range(100):
+    struct.pack_into('<iiii', packer.buf, packer.fill, i, 0, 0, 0)
+    packer.commit()
+    if i == 40:
+        packer.flush()
+packer.flush()
+data = b''.join(chunks)
+assert [struct.unpack_from('<i', data, 16 * i)[0] for i in range(100)] == list(range(100))
+print('passed.')
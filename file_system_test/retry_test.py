@@ -0,0 +1,162 @@
+"""
+Host-side test of the error handling of the SDCard block I/O.
+
+Faults are injected into the emulated card (sd_emulator.py): rejected data
+blocks, data error tokens on reads and a power loss of the card. The driver
+must retry the transfers, continue multi-block transfers behind the blocks
+already done, re-initialize the card only after a reset and count the errors.
+A card locked up with MISO held low must not hang the driver.
+Requests outside the card are not retried. The baudrate sweep must reject
+a clock at which writes fail instead of retrying them.
+
+run with : python3 retry_test.py
+"""
+
+import os
+import tempfile
+import time
+from sdcard import SDCard, SDError
+from sd_emulator import SDEmulator
+
+
+def pattern(block, n=1):
+    return bytes((block * 3 + i) & 0xFF for i in range(512 * n))
+
+
+card = SDEmulator(num_blocks=2048, log_commands=True)
+sd = SDCard(card, card.cs, baudrate=25_000_000)
+sd.init_card()
+
+# a rejected single block is written again
+card.reset_counters()
+card.inject('write_crc')
+sd.writeblocks(10, pattern(10))
+assert card.data[10 * 512 : 11 * 512] == pattern(10)
+assert sd.io_errors == {'crc': 1} and sd.io_retries == 1
+assert card.commands['CMD24'] == 2 and card.commands['CMD13'] == 1
+
+# a multi-block write continues with the rejected block
+card.reset_counters()
+card.inject('write_error', after=3)
+sd.writeblocks(100, pattern(100, 8))
+assert card.data[100 * 512 : 108 * 512] == pattern(100, 8)
+assert sd.io_errors['write'] == 1
+assert [arg for cmd, arg in card.log if cmd == 'CMD25'] == [100, 103]
+
+# read errors : single block and in the middle of a multi-block read
+card.reset_counters()
+buf = bytearray(512)
+card.inject('read_ecc')
+sd.readblocks(10, buf)
+assert buf == pattern(10)
+big = bytearray(8 * 512)
+card.reset_counters()
+card.inject('read_ecc', 3, after=5)
+sd.readblocks(100, big)
+assert big == pattern(100, 8)
+assert [arg for cmd, arg in card.log if cmd == 'CMD18'] == [100, 105, 105, 105]
+print(f'errors {sd.io_errors}, {sd.io_retries} retries, {sd.io_reinits} re-inits')
+assert sd.io_errors['ecc'] == 4 and sd.io_reinits == 0
+
+# the card lost its power : re-initialization
+card.inject('power_loss')
+sd.writeblocks(200, pattern(200))
+assert card.data[200 * 512 : 201 * 512] == pattern(200)
+assert sd.io_errors['idle'] == 1 and sd.io_reinits == 1
+
+# persistent errors exhaust the retries
+sd.reinit = False
+retries = sd.io_retries
+card.inject('write_error', 10)
+try:
+    sd.writeblocks(300, pattern(300))
+except SDError as e:
+    print(f'persistent error : {e} ({e.kind})')
+    assert e.kind == 'write' and e.block == 300
+else:
+    raise AssertionError('no error raised')
+assert sd.io_retries - retries == sd.retries
+card.faults.clear()
+
+# an address outside the card is not retried
+retries = sd.io_retries
+try:
+    sd.readblocks(5000, buf)
+except SDError as e:
+    assert e.kind == 'address'
+else:
+    raise AssertionError('no error raised')
+assert sd.io_retries == retries
+sd.readblocks(10, buf)
+assert buf == pattern(10)
+print(f'errors {sd.io_errors}, {sd.io_retries} retries, {sd.io_reinits} re-inits')
+
+
+class LockingCard(SDEmulator):
+    """ card whose controller locks up after accepting a block : MISO stays low for ever """
+    lock_on_write = False
+    lock_at = None
+
+    def receive_block(self):
+        super().receive_block()
+        if self.lock_on_write and self.lock_at is None:
+            # the data response still goes out
+            self.lock_at = self.bytes + 1
+
+    def xfer(self, mosi):
+        miso = super().xfer(mosi)
+        if self.lock_at is not None and self.bytes > self.lock_at and self.selected:
+            return 0x00
+        return miso
+
+
+# a card busy for ever fails the write, recover() gives up and the card is re-initialized
+for stats in (False, True):
+    card = LockingCard(num_blocks=2048)
+    sd = SDCard(card, card.cs, baudrate=25_000_000)
+    sd.init_card()
+    if stats:
+        sd.enable_stats()
+    card.lock_on_write = True
+    start = time.monotonic()
+    try:
+        sd.writeblocks(10, pattern(10))
+    except OSError as e:
+        print(f'locked card : {e}, errors {sd.io_errors}, {sd.io_reinits} re-inits, '
+              f'{time.monotonic() - start:.1f} s')
+    else:
+        raise AssertionError('no error raised')
+    assert time.monotonic() - start < 10
+    assert sd.io_errors == {'timeout': 1} and sd.io_reinits == 1
+    assert not sd.recover()
+
+
+class FastWriteFailingCard(SDEmulator):
+    """ card rejecting or corrupting every block written above a clock threshold """
+    def __init__(self, fault, threshold=20_000_000, **kwargs):
+        super().__init__(**kwargs)
+        self.fault_kind = fault
+        self.threshold = threshold
+
+    def fault(self, fault):
+        if fault == self.fault_kind and self.baudrate > self.threshold:
+            return True
+        return super().fault(fault)
+
+
+# the baudrate sweep must not retry its writes : a re-initialization
+# would continue at the safe clock and accept the failing rate
+for fault in ('write_error', 'write_bit'):
+    card = FastWriteFailingCard(fault, num_blocks=2048)
+    sd = SDCard(card, card.cs, baudrate=1_000_000)
+    sd.init_card()
+    tune_file = os.path.join(tempfile.mkdtemp(), 'tune.json')
+    baudrate = sd.tune_baudrate(max_baudrate=50_000_000, write_block=1000, tune_file=tune_file)
+    print(f'writes failing above 20 MHz ({fault}) : tuned to {baudrate} Hz, '
+          f'{sd.io_reinits} re-inits, errors {sd.io_errors}')
+    assert baudrate == 20_000_000 and card.baudrate == 20_000_000
+    assert sd.io_reinits == 0 and sd.io_retries == 0
+    sd.writeblocks(1001, pattern(1001))
+    sd.readblocks(1001, buf)
+    assert buf == pattern(1001)
+print('passed.')
@@ -0,0 +1,574 @@
+"""
+SD card emulator for host-side testing and benchmarking of the SDCard driver.
+
+The emulator implements the SPI-mode protocol of an SDHC card at byte level.
+It acts as the SPI bus object and provides a chip-select pin object, so the
+unmodified driver runs against it on a Linux box:
+
+    from sd_emulator import SDEmulator
+    from sdcard import SDCard
+
+    emu = SDEmulator(num_blocks=8192, read_latency_us=200, program_us=800)
+    sd = SDCard(emu, emu.cs, baudrate=25_000_000)
+    sd.init_card()
+    emu.reset_counters()
+    sd.readblocks(0, buf)
+    print(emu.time_us, emu.spi_calls, emu.bytes)
+
+Supported commands:
+    CMD0, CMD6, CMD8, CMD9, CMD10, CMD12, CMD13, CMD16, CMD17, CMD18, CMD24, CMD25,
+    CMD32, CMD33, CMD38, CMD55, CMD58, CMD59, ACMD13, ACMD23, ACMD41
+
+Timing model (all times in microseconds of simulated time):
+    every byte takes 8 bit periods of the SPI clock set with init(),
+    every SPI call costs call_us and every CS change pin_us of Python overhead,
+    the first data token of a read follows read_latency_us after the command,
+    the blocks of a multi-block read follow each other with a gap of block_gap_us,
+    the card is busy for program_us after a single-block write,
+    multi_program_us after each block of a multi-block write and stop_us after STOP_TRAN,
+    a multi-block write entering a new allocation unit (AU) that was not pre-erased
+    with ACMD23 is busy for erase_us in addition (the lazy-erase latency spike),
+    an erase (CMD38) is busy for erase_us per AU.
+Time advances only through bus activity, advance() lets a test spend time elsewhere.
+
+Faults are injected with inject() : 'write_crc' and 'write_error' reject
+blocks written with the corresponding data response, 'read_ecc' sends a
+data error token instead of the next block read, 'power_loss' resets the card
+to the idle state before the next command. Transmission errors flip a bit:
+'read_bit' in a data block sent by the card, 'write_bit' in a data block and
+'cmd_bit' in the argument of a command received by the card (detected by the
+card only with CRC checking turned on by CMD59).
+"""
+
+_R1_IDLE_STATE = 0x01
+_R1_ILLEGAL_COMMAND = 0x04
+_R1_COM_CRC_ERROR = 0x08
+_R1_ADDRESS_ERROR = 0x20
+
+_TOKEN_CMD25 = 0xFC
+_TOKEN_STOP_TRAN = 0xFD
+_TOKEN_DATA = 0xFE
+
+_DATA_ACCEPTED = 0x05
+_DATA_CRC_ERROR = 0x0B
+_DATA_WRITE_ERROR = 0x0D
+
+# AU_SIZE codes of the SD status, in blocks
+_AU_BLOCKS = (0, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384,
+              24576, 32768, 49152, 65536, 131072)
+
+
+def _make_crc16_table():
+    table = []
+    for i in range(256):
+        crc = i << 8
+        for j in range(8):
+            crc = ((crc << 1) ^ 0x1021) if crc & 0x8000 else (crc << 1)
+        table.append(crc & 0xFFFF)
+    return table
+
+_CRC16_TABLE = _make_crc16_table()
+
+
+def crc16(data):
+    """ CRC16-CCITT (polynomial 0x1021, initial value 0) of SD data blocks """
+    crc = 0
+    for b in data:
+        crc = ((crc << 8) & 0xFFFF) ^ _CRC16_TABLE[(crc >> 8) ^ b]
+    return crc
+
+
+def crc7(data):
+    """ CRC7 (polynomial 0x09) of SD commands and registers """
+    crc = 0
+    for b in data:
+        for i in range(8):
+            crc <<= 1
+            if ((b << i) & 0x80) ^ (crc & 0x80):
+                crc ^= 0x09
+    return crc & 0x7F
+
+
+class EmulatorPin:
+    """
+    Chip-select pin of the emulated card.
+    """
+    OUT = 1
+
+    def __init__(self, card):
+        self.card = card
+
+    def init(self, mode=None, value=1):
+        self.card.select(value == 0)
+
+    def __call__(self, value):
+        self.card.select(value == 0)
+
+    def high(self):
+        self.card.select(False)
+
+    def low(self):
+        self.card.select(True)
+
+
+class SDEmulator:
+    """
+    Emulated SDHC card behind an SPI bus.
+
+    counters :
+        bytes : bytes transferred over the bus
+        spi_calls : calls of write(), read(), readinto() and write_readinto()
+        time_us : simulated time
+        commands : dict command name -> number of times received
+        log : list of (command name, argument) if log_commands is set
+    """
+    def __init__(self, num_blocks=8192, baudrate=100_000, call_us=10.0, pin_us=2.0,
+                 read_latency_us=200.0, block_gap_us=20.0, program_us=800.0, multi_program_us=150.0,
+                 stop_us=100.0, erase_us=5000.0, au_blocks=8192, high_speed=True,
+                 init_tries=2, serial=0x12345678, log_commands=False):
+        """
+        Args:
+            num_blocks (int): capacity in 512-byte blocks, a multiple of 1024
+            baudrate (int): initial SPI clock, changed by init()
+            call_us (float): overhead of one SPI call
+            pin_us (float): overhead of one change of the CS signal
+            read_latency_us (float): time from a read command to the first data token
+            block_gap_us (float): time between the blocks of a multi-block read
+            program_us (float): busy time after a single-block write
+            multi_program_us (float): busy time after each block of a multi-block write
+            stop_us (float): busy time after STOP_TRAN and CMD12
+            erase_us (float): busy time for erasing one allocation unit
+            au_blocks (int): size of the allocation unit in blocks
+            high_speed (bool): card supports the high-speed function (CMD6)
+            init_tries (int): number of ACMD41 needed before the card is ready
+            serial (int): product serial number reported in the CID
+            log_commands (bool): keep a log of all commands received
+        """
+        self.num_blocks = num_blocks
+        self.data = bytearray(num_blocks * 512)
+        self.baudrate = baudrate
+        self.call_us = call_us
+        self.pin_us = pin_us
+        self.read_latency_us = read_latency_us
+        self.block_gap_us = block_gap_us
+        self.program_us = program_us
+        self.multi_program_us = multi_program_us
+        self.stop_us = stop_us
+        self.erase_us = erase_us
+        self.au_blocks = au_blocks
+        self.high_speed = high_speed
+        self.init_tries = init_tries
+        self.log_commands = log_commands
+        self.cs = EmulatorPin(self)
+        self.csd = self.make_csd()
+        self.cid = self.make_cid(serial)
+        self.faults = {}
+        self.power_up()
+        self.reset_counters()
+
+    def make_csd(self):
+        """ CSD version 2.0 with command classes including class 10 (switch) """
+        csd = bytearray(16)
+        c_size = self.num_blocks // 1024 - 1
+        csd[0] = 0x40
+        csd[1] = 0x0E
+        csd[3] = 0x32
+        csd[4] = 0x5B
+        csd[5] = 0x59
+        csd[7] = (c_size >> 16) & 0x3F
+        csd[8] = (c_size >> 8) & 0xFF
+        csd[9] = c_size & 0xFF
+        # ERASE_BLK_EN=1, SECTOR_SIZE=127 (64 kB)
+        csd[10] = 0x7F
+        csd[11] = 0x80
+        csd[12] = 0x0A
+        csd[13] = 0x40
+        csd[15] = (crc7(csd[:15]) << 1) | 1
+        return csd
+
+    def make_cid(self, serial):
+        cid = bytearray(16)
+        cid[0] = 0x03
+        cid[1:3] = b'SD'
+        cid[3:8] = b'EMU01'
+        cid[8] = 0x10
+        cid[9:13] = serial.to_bytes(4, 'big')
+        cid[13] = 0x01
+        cid[14] = 0x91
+        cid[15] = (crc7(cid[:15]) << 1) | 1
+        return cid
+
+    def power_up(self):
+        """ state after power up : idle, default speed """
+        self.selected = False
+        self.idle = True
+        self.acmd41_count = 0
+        self.hs_mode = False
+        self.crc_on = False
+        self.app_cmd = False
+        self.cmdbuf = bytearray()
+        self.out = bytearray()
+        self.out_pos = 0
+        self.state = 'idle'
+        self.busy_until = 0.0
+        self.read_block = 0
+        self.read_remaining = 0
+        self.ready_at = 0.0
+        self.write_block = 0
+        self.multi = False
+        self.rxbuf = bytearray()
+        self.erase_start = 0
+        self.erase_end = 0
+        self.pre_erase_count = 0
+        self.pre_erased_end = 0
+        self.csd[3] = 0x32
+        self.csd[15] = (crc7(self.csd[:15]) << 1) | 1
+
+    def reset_counters(self):
+        # the simulated time restarts at 0, pending busy and read latencies are kept
+        if hasattr(self, 'time_us'):
+            self.busy_until -= self.time_us
+            self.ready_at -= self.time_us
+        self.bytes = 0
+        self.spi_calls = 0
+        self.time_us = 0.0
+        self.commands = {}
+        self.log = []
+
+    def inject(self, fault, count=1, after=0):
+        """ let count operations fail with the given fault, after the next ones succeeded """
+        self.faults[fault] = [after, count]
+
+    def fault(self, fault):
+        """ consume an injected fault, returns True if it is due """
+        pending = self.faults.get(fault)
+        if not pending or not pending[1]:
+            return False
+        if pending[0]:
+            pending[0] -= 1
+            return False
+        pending[1] -= 1
+        return True
+
+    def advance(self, us):
+        """ let simulated time pass without bus activity """
+        self.time_us += us
+
+    def select(self, selected):
+        self.time_us += self.pin_us
+        if not selected:
+            # a partially received command is discarded
+            self.cmdbuf = bytearray()
+        self.selected = selected
+
+    def busy(self):
+        return self.time_us < self.busy_until
+
+    # ------------------------------------------------------------------
+    # byte level protocol
+
+    def queue(self, data):
+        self.out = bytearray(data)
+        self.out_pos = 0
+
+    def data_block(self, data):
+        """ token, data and CRC16 of a block sent by the card """
+        crc = crc16(data)
+        return bytes([_TOKEN_DATA]) + bytes(data) + bytes([crc >> 8, crc & 0xFF])
+
+    def xfer(self, mosi):
+        self.time_us += 8_000_000 / self.baudrate
+        self.bytes += 1
+        if not self.selected:
+            return 0xFF
+        # receiving a data block from the host
+        if self.state == 'receive':
+            self.rxbuf.append(mosi)
+            if len(self.rxbuf) == 514:
+                self.receive_block()
+            return 0xFF
+        # a command may arrive in any other state (CMD12 stops a running read)
+        if self.cmdbuf or mosi & 0xC0 == 0x40:
+            miso = self.next_out()
+            self.cmdbuf.append(mosi)
+            if len(self.cmdbuf) == 6:
+                self.command()
+            return miso
+        # data tokens of a write, other bytes only clock out pending output
+        if self.state == 'write' and mosi == _TOKEN_DATA and not self.busy():
+            self.start_receive(False)
+            return 0xFF
+        if self.state == 'write_multi' and not self.busy():
+            if mosi == _TOKEN_CMD25:
+                self.start_receive(True)
+                return 0xFF
+            if mosi == _TOKEN_STOP_TRAN:
+                self.state = 'idle'
+                self.queue(b'\xff')
+                self.busy_until = self.time_us + self.stop_us
+                return 0xFF
+        return self.next_out()
+
+    def next_out(self):
+        if self.out_pos < len(self.out):
+            b = self.out[self.out_pos]
+            self.out_pos += 1
+            return b
+        if self.state == 'read':
+            if self.read_remaining == 0:
+                self.state = 'idle'
+            elif self.time_us >= self.ready_at:
+                if self.fault('read_ecc'):
+                    # data error token : ECC failed, the transfer ends
+                    self.state = 'idle'
+                    self.read_remaining = 0
+                    self.queue(b'\x04')
+                    return self.next_out()
+                block = self.read_block
+                self.queue(self.data_block(self.data[block * 512 : (block + 1) * 512]))
+                if self.fault('read_bit'):
+                    self.out[1 + (block * 37) % 512] ^= 0x10
+                self.read_block += 1
+                self.read_remaining -= 1
+                if self.read_block >= self.num_blocks:
+                    self.read_remaining = 0
+                byte_us = 8_000_000 / self.baudrate
+                self.ready_at = self.time_us + 514 * byte_us + self.block_gap_us
+                return self.next_out()
+            return 0xFF
+        if self.busy():
+            return 0x00
+        return 0xFF
+
+    def start_receive(self, multi):
+        self.queue(b'')
+        self.rxbuf = bytearray()
+        self.multi = multi
+        self.state = 'receive'
+
+    def receive_block(self):
+        """ a complete data block (512 bytes + CRC) was received """
+        if self.fault('write_bit'):
+            self.rxbuf[(self.write_block * 37) % 512] ^= 0x04
+        data = self.rxbuf[:512]
+        multi = self.multi
+        if self.crc_on and crc16(data) != (self.rxbuf[512] << 8 | self.rxbuf[513]):
+            self.queue(bytes([_DATA_CRC_ERROR]))
+            self.state = 'write_multi' if multi else 'idle'
+            return
+        for fault, response in (('write_crc', _DATA_CRC_ERROR), ('write_error', _DATA_WRITE_ERROR)):
+            if self.fault(fault):
+                self.queue(bytes([response]))
+                self.state = 'write_multi' if multi else 'idle'
+                return
+        block = self.write_block
+        if block >= self.num_blocks:
+            self.queue(bytes([_DATA_WRITE_ERROR]))
+            self.state = 'write_multi' if multi else 'idle'
+            return
+        self.data[block * 512 : (block + 1) * 512] = data
+        self.write_block += 1
+        self.queue(bytes([_DATA_ACCEPTED]))
+        if multi:
+            busy = self.multi_program_us
+            if block % self.au_blocks == 0 and block >= self.pre_erased_end:
+                busy += self.erase_us
+            self.state = 'write_multi'
+        else:
+            busy = self.program_us
+            self.state = 'idle'
+        self.busy_until = self.time_us + busy
+
+    # ------------------------------------------------------------------
+    # commands
+
+    def command(self):
+        buf = self.cmdbuf
+        self.cmdbuf = bytearray()
+        if self.fault('cmd_bit'):
+            buf[4] ^= 0x01
+        cmd = buf[0] & 0x3F
+        arg = int.from_bytes(buf[1:5], 'big')
+        app = self.app_cmd
+        self.app_cmd = False
+        name = ('ACMD' if app else 'CMD') + str(cmd)
+        self.commands[name] = self.commands.get(name, 0) + 1
+        if self.log_commands:
+            self.log.append((name, arg))
+        if self.fault('power_loss'):
+            self.power_up()
+            self.selected = True
+        if self.crc_on or cmd in (0, 8):
+            if crc7(buf[:5]) != buf[5] >> 1:
+                self.queue(bytes([0xFF, self.r1() | _R1_COM_CRC_ERROR]))
+                return
+        if cmd == 12:
+            # stop transmission : stuff byte, R1, then busy
+            self.state = 'idle'
+            self.read_remaining = 0
+            self.queue(bytes([0x3F, 0xFF, self.r1()]))
+            self.busy_until = self.time_us + self.stop_us
+            return
+        if self.state != 'idle' and cmd != 13:
+            # commands are only accepted after the end of a transfer
+            self.state = 'idle'
+        handler = getattr(self, ('acmd' if app else 'cmd') + str(cmd), None)
+        if handler is None:
+            self.queue(bytes([0xFF, self.r1() | _R1_ILLEGAL_COMMAND]))
+            return
+        self.queue(bytes([0xFF]) + handler(arg))
+
+    def r1(self):
+        return _R1_IDLE_STATE if self.idle else 0x00
+
+    def cmd0(self, arg):
+        self.power_up()
+        self.selected = True
+        return bytes([_R1_IDLE_STATE])
+
+    def cmd8(self, arg):
+        # R7 : echo voltage and check pattern
+        return bytes([self.r1(), 0x00, 0x00, (arg >> 8) & 0x0F, arg & 0xFF])
+
+    def cmd58(self, arg):
+        ocr = 0xC0FF8000 if not self.idle else 0x00FF8000
+        return bytes([self.r1()]) + ocr.to_bytes(4, 'big')
+
+    def cmd55(self, arg):
+        self.app_cmd = True
+        return bytes([self.r1()])
+
+    def acmd41(self, arg):
+        self.acmd41_count += 1
+        if self.acmd41_count >= self.init_tries:
+            self.idle = False
+        return bytes([self.r1()])
+
+    def cmd59(self, arg):
+        self.crc_on = bool(arg & 1)
+        return bytes([self.r1()])
+
+    def cmd9(self, arg):
+        return bytes([self.r1(), 0xFF]) + self.data_block(self.csd)
+
+    def cmd10(self, arg):
+        return bytes([self.r1(), 0xFF]) + self.data_block(self.cid)
+
+    def cmd13(self, arg):
+        # R2 : R1 followed by the second status byte
+        return bytes([self.r1(), 0x00])
+
+    def cmd16(self, arg):
+        if arg != 512:
+            return bytes([self.r1() | 0x40])
+        return bytes([self.r1()])
+
+    def cmd6(self, arg):
+        status = bytearray(64)
+        # maximum current 200 mA, support bits of group 1
+        status[1] = 200
+        status[13] = 0x03 if self.high_speed else 0x01
+        function = arg & 0x0F
+        if function == 0x0F:
+            function = 1 if self.hs_mode else 0
+        elif function == 1 and not self.high_speed:
+            function = 0x0F
+        status[16] = function
+        if arg & 0x80000000 and function == 1:
+            self.hs_mode = True
+            self.csd[3] = 0x5A
+            self.csd[15] = (crc7(self.csd[:15]) << 1) | 1
+        return bytes([self.r1(), 0xFF]) + self.data_block(status)
+
+    def acmd13(self, arg):
+        status = bytearray(64)
+        # speed class 10, AU size, erase size 1 AU, erase timeout 1 s, offset 1 s
+        status[8] = 0x04
+        code = _AU_BLOCKS.index(self.au_blocks) if self.au_blocks in _AU_BLOCKS else 0
+        status[10] = code << 4
+        status[12] = 0x01
+        status[13] = (1 << 2) | 1
+        return bytes([self.r1(), 0x00, 0xFF]) + self.data_block(status)
+
+    def acmd23(self, arg):
+        self.pre_erase_count = arg & 0x7FFFFF
+        return bytes([self.r1()])
+
+    def start_read(self, arg, count):
+        if arg >= self.num_blocks:
+            return bytes([self.r1() | _R1_ADDRESS_ERROR])
+        self.state = 'read'
+        self.read_block = arg
+        self.read_remaining = count
+        self.ready_at = self.time_us + self.read_latency_us
+        return bytes([self.r1()])
+
+    def cmd17(self, arg):
+        return self.start_read(arg, 1)
+
+    def cmd18(self, arg):
+        return self.start_read(arg, self.num_blocks)
+
+    def cmd24(self, arg):
+        if arg >= self.num_blocks:
+            return bytes([self.r1() | _R1_ADDRESS_ERROR])
+        self.state = 'write'
+        self.write_block = arg
+        return bytes([self.r1()])
+
+    def cmd25(self, arg):
+        if arg >= self.num_blocks:
+            return bytes([self.r1() | _R1_ADDRESS_ERROR])
+        self.state = 'write_multi'
+        self.write_block = arg
+        self.pre_erased_end = arg + self.pre_erase_count
+        self.pre_erase_count = 0
+        return bytes([self.r1()])
+
+    def cmd32(self, arg):
+        self.erase_start = arg
+        return bytes([self.r1()])
+
+    def cmd33(self, arg):
+        self.erase_end = arg
+        return bytes([self.r1()])
+
+    def cmd38(self, arg):
+        start = self.erase_start
+        end = min(self.erase_end, self.num_blocks - 1)
+        if end < start:
+            return bytes([self.r1() | 0x10])
+        self.data[start * 512 : (end + 1) * 512] = bytes((end + 1 - start) * 512)
+        num_au = end // self.au_blocks - start // self.au_blocks + 1
+        self.busy_until = self.time_us + self.erase_us * num_au
+        return bytes([self.r1()])
+
+    # ------------------------------------------------------------------
+    # SPI bus interface
+
+    def init(self, baudrate=None, **kwargs):
+        if baudrate:
+            self.baudrate = baudrate
+
+    def write(self, buf):
+        self.spi_calls += 1
+        self.time_us += self.call_us
+        for b in buf:
+            self.xfer(b)
+
+    def read(self, nbytes, write=0x00):
+        self.spi_calls += 1
+        self.time_us += self.call_us
+        return bytes(self.xfer(write) for i in range(nbytes))
+
+    def readinto(self, buf, write=0x00):
+        self.spi_calls += 1
+        self.time_us += self.call_us
+        for i in range(len(buf)):
+            buf[i] = self.xfer(write)
+
+    def write_readinto(self, wbuf, rbuf):
+        self.spi_calls += 1
+        self.time_us += self.call_us
+        for i in range(len(wbuf)):
+            rbuf[i] = self.xfer(wbuf[i])
@@ -0,0 +1,90 @@
+"""
+Host-side test of the SD status decoding in the SDCard driver.
+
+The emulated card (sd_emulator.py) answers ACMD13 with a fixed 64-byte SD
+status : speed class 2, AU size 1 MB (2048 blocks), erase size 16 AUs,
+erase timeout 10 s and erase offset 2 s, with the neighbouring fields set
+so that decoding the wrong bits shows. The test checks the decoded fields,
+the erase timeouts derived from them and the AU-aligned regions returned
+by au_region(), and the fallbacks of a card reporting no values.
+
+run with : python3 sd_status_test.py
+"""
+
+from sdcard import SDCard
+from sd_emulator import SDEmulator
+
+NUM_BLOCKS = 16384
+
+SD_STATUS = bytes.fromhex(
+    '80000000'      # DAT_BUS_WIDTH 4 bit, SECURED_MODE, SD_CARD_TYPE
+    '00080000'      # SIZE_OF_PROTECTED_AREA
+    '01'            # SPEED_CLASS 2
+    '05'            # PERFORMANCE_MOVE 5 MB/s
+    '7f'            # AU_SIZE 7 (1 MB), reserved bits set
+    '0010'          # ERASE_SIZE 16 AUs
+    '2a'            # ERASE_TIMEOUT 10 s, ERASE_OFFSET 2 s
+    '11'            # UHS_SPEED_GRADE, UHS_AU_SIZE
+    '1e') + bytes(48)   # VIDEO_SPEED_CLASS 30
+
+
+class StatusEmulator(SDEmulator):
+    """ card answering ACMD13 with a given SD status """
+    def __init__(self, status, **kwargs):
+        super().__init__(**kwargs)
+        self.status = status
+
+    def acmd13(self, arg):
+        return bytes([self.r1(), 0x00, 0xFF]) + self.data_block(self.status)
+
+
+def make_card(status):
+    card = StatusEmulator(status, num_blocks=NUM_BLOCKS, au_blocks=2048)
+    sd = SDCard(card, card.cs, baudrate=25_000_000)
+    sd.init_card()
+    card.reset_counters()
+    return card, sd
+
+
+card, sd = make_card(SD_STATUS)
+assert len(SD_STATUS) == 64
+
+# the SD status is read on the first use of au_region()
+assert sd.au_region(100, 3000) == (2048, 4096)
+assert card.commands.get('ACMD13') == 1
+assert sd.au_blocks == 2048
+assert sd.au_region(4096, 1) == (4096, 2048)
+assert card.commands.get('ACMD13') == 1, 'SD status read again'
+
+status = sd.read_sd_status()
+print(f'SD status : {dict((k, v) for k, v in status.items() if k != "raw_data")}')
+assert status['raw_data'] == SD_STATUS
+assert status['speed_class'] == 2
+assert status['au_size'] == 1024 * 1024
+assert status['erase_size'] == 16
+assert status['erase_timeout'] == 10
+assert status['erase_offset'] == 2
+
+# ERASE_TIMEOUT / ERASE_SIZE per AU plus ERASE_OFFSET
+assert sd.erase_timeout_ms(1) == 10_000 // 16 + 2000
+assert sd.erase_timeout_ms(2048) == 10_000 // 16 + 2000
+assert sd.erase_timeout_ms(5000) == 3 * 10_000 // 16 + 2000
+assert sd.erase_timeout_ms(16 * 2048) == 10_000 + 2000
+
+# regions are clipped to whole AUs of the card
+assert sd.au_region(0, 2048) == (0, 2048)
+assert sd.au_region(2049, 2048) == (4096, 2048)
+assert sd.au_region(10000, 8000) == (10240, 6144)
+try:
+    sd.au_region(15000, 10)
+    assert False, 'region beyond the end of the card'
+except OSError:
+    pass
+
+# a card without AU size and erase values
+card, sd = make_card(bytes(64))
+status = sd.read_sd_status()
+assert status['speed_class'] == 0 and status['au_size'] == 0
+assert sd.erase_timeout_ms(5000) == 250
+assert sd.au_region(100, 3000) == (100, 3000)
+print('passed.')
@@ -24,9 +24,18 @@ Example usage on ESP8266:
 
 """
 
-from micropython import const
-from machine import SPI, Pin
 import time
+try:
+    from micropython import const
+    from machine import SPI, Pin
+    sleep_ms = time.sleep_ms
+except ImportError:
+    # running on a host computer against a simulated card
+    def const(x):
+        return x
+    SPI = Pin = object
+    def sleep_ms(ms):
+        time.sleep(ms / 1000)
 
 # R1 command responses
 _R1_IDLE_STATE = const(1 << 0)
@@ -44,8 +53,10 @@ _TOKEN_DATA = const(0xFE)
 class SDCard:
     """
     Representation of an SD card accessed via SPI bus.
-    The object can be used as a regular block device.
-    It provides readblocks(), writeblocks() and ioctl(op) with opcodes 4 and 5.
+    The object can be used as an extended block device.
+    It provides readblocks(), writeblocks() with byte offsets and ioctl(op) with opcodes 4 and 5.
+    A filesystem can therefore use read and program sizes smaller than 512 bytes,
+    e.g. vfs.VfsLfs2(sd, readsize=64, progsize=64).
     After creating the object init_card() must be called separately, when the card is present.
 
     internal variables :
@@ -53,13 +64,16 @@ class SDCard:
         cs (Pin): the pin used to drive the chip-select signal of the card
         baudrate (int): bus frequency - defaults to 1 MHz
         cmdbuf (6 bytes) : buffer for commands to be sent to the card
-        block (512 bytes) : buffer for data blocks
+        block (512 bytes) : one-block cache used for read-modify-write of partial blocks
         block_memoryview : a memory view of block that allows slicing without creating copies
+        cache_block (int) : number of the block held in block, -1 if none
+        fill (514 bytes) : all 0xFF, clocked out to skip unneeded bytes
         tokenbuf (1 byte) : buffer for tokens returned by card commands
         ocr (4 bytes) : operation conditions register (read by CMD 58)
         csd (16 bytes) : card specific data (read by CMD 9)
         cid (16 bytes) : card identification (read by CMD 10)
         sectors (int) : capacity of the card in 512-byte sectors
+        cdv (int) : address multiplier, 512 for byte-addressed (SDSC) cards, 1 for SDHC/SDXC
     """
     def __init__(self, spi: SPI, cs: Pin, baudrate:int=25_000_000, debug_level:int=0) -> None:
         """
@@ -86,10 +100,13 @@ class SDCard:
         for i in range(512):
             self.block[i] = 0xFF
         self.block_memoryview = memoryview(self.block)
+        self.cache_block = -1
+        self.fill = memoryview(b"\xff" * 514)
         self.ocr = bytearray(4)
         self.csd = bytearray(16)
         self.cid = bytearray(16)
         self.sectors = 0
+        self.cdv = 1
 
     def init_spi(self, freq:int) -> None:
         """
@@ -106,14 +123,14 @@ class SDCard:
         """
         # init CS pin and deselect
         self.cs.init(self.cs.OUT, value=1)
-        time.sleep_ms(10)
+        sleep_ms(10)
         # init SPI bus; use low data rate for initialisation
         self.init_spi(100000)
         # clock card at least 74 cycles (here 80) with cs high
         for i in range(10):
             self.spi.write(b"\xff")
 
-    def cmd(self, cmd:int, arg:int, crc:int) -> int:
+    def cmd(self, cmd:int, arg:int, crc:int, release:bool=True, skip1:bool=False) -> int:
         """
         Execute a command on the SD card expecting an R1 response.
 
@@ -123,12 +140,14 @@ class SDCard:
         by trying to read one byte while keeping MOSI=1 (writing 0xff).
         A valid response is assumed if we get a value with MSB=0. (Before the card has processed the command
         we typically get 0xff). This response value is returned.
-        The CS signal is released afterwards.
+        The CS signal is released afterwards, unless a data transfer follows.
 
         Args:
             cmd (int): Command number (6-bit)
             arg (int): 32-bit arguments for the command
             crc (int): 7-bit check sum + LSB=1
+            release (bool): release the CS signal after the response
+            skip1 (bool): discard the first byte (stuff byte after CMD12)
 
         Returns:
             (int): the response value
@@ -139,12 +158,14 @@ class SDCard:
         # create and send the command
         buf = self.cmdbuf
         buf[0] = 0x40 | cmd
-        buf[1] = arg >> 24
-        buf[2] = arg >> 16
-        buf[3] = arg >> 8
-        buf[4] = arg
+        buf[1] = (arg >> 24) & 0xFF
+        buf[2] = (arg >> 16) & 0xFF
+        buf[3] = (arg >> 8) & 0xFF
+        buf[4] = arg & 0xFF
         buf[5] = crc
         self.spi.write(buf)
+        if skip1:
+            self.spi.readinto(self.tokenbuf, 0xFF)
         # wait for the response (response[7] == 0)
         # try at maximum 10 times
         for i in range(10):
@@ -155,8 +176,9 @@ class SDCard:
                 if self.debug_level >= 2:
                     print(f'[SDCard] CMD({cmd}) response {response}')
                 # release bus
-                self.cs(1)
-                self.spi.write(b"\xff")
+                if release:
+                    self.cs(1)
+                    self.spi.write(b"\xff")
                 return response
         # timeout
         if self.debug_level >= 1:
@@ -187,10 +209,10 @@ class SDCard:
         # create and send the command
         cbuf = self.cmdbuf
         cbuf[0] = 0x40 | cmd
-        cbuf[1] = arg >> 24
-        cbuf[2] = arg >> 16
-        cbuf[3] = arg >> 8
-        cbuf[4] = arg
+        cbuf[1] = (arg >> 24) & 0xFF
+        cbuf[2] = (arg >> 16) & 0xFF
+        cbuf[3] = (arg >> 8) & 0xFF
+        cbuf[4] = arg & 0xFF
         cbuf[5] = crc
         self.spi.write(cbuf)
 
@@ -220,7 +242,7 @@ class SDCard:
 
     def init_card(self):
         """
-        intialization sequence for SD cards (presently only V2.x type)
+        intialization sequence for SD cards (V1.x and V2.x type)
 
         Raises:
             OSError: on initalization failure
@@ -234,31 +256,53 @@ class SDCard:
                 break
         else:
             raise OSError("no SD card (no R1_IDLE_STAT)")
+        # CMD8: SEND_IF_COND - check voltage range (2.7-3.6V) with echo pattern 0xaa
+        # Response R7 : R1 followed by 4 bytes, V1.x cards reject the command
+        response = self.cmd_buf(8, 0x01AA, 0x87, self.ocr)
+        if response == _R1_IDLE_STATE | _R1_ILLEGAL_COMMAND:
+            # V1.x card : standard capacity only, the HCS bit must not be set in ACMD41
+            version = 1
+        elif response == _R1_IDLE_STATE and self.ocr[3] == 0xAA:
+            version = 2
+        else:
+            raise OSError(f"couldn't determine SD card version (CMD8 response={response})")
+        if self.debug_level >= 1:
+            print(f'[SDCard] V{version}.x card')
         # CMD58: READ_OCR -> Response R3
         # The first byte sent is R1. The following four bytes are the contents of the OCR register.
-        # TODO: check voltage range
         response = self.cmd_buf(58, 0, 0, self.ocr)
         # MSB first
         if not self.ocr[1] & 0x7c:
             raise OSError("no voltage between 3.0V and 3.5V supported")
-        if not self.ocr[0] & 0x80:
-            if self.debug_level >= 1:
-                print(f'[SDCard] card does not show power-up status bit - ignored')
-        for _ in range(10):
+        for _ in range(20):
             # CMD55 defines that the next command is an application specific command
             self.cmd(55, 0, 0)
-            # ACMD41 activates the card intialization process
-            response = self.cmd(41, 0x40000000, 0)
-            if response == _R1_IDLE_STATE:
+            # ACMD41 activates the card intialization process (HCS bit set for V2.x cards)
+            # the card leaves the idle state when the initialization is finished
+            response = self.cmd(41, 0x40000000 if version == 2 else 0, 0)
+            if response == 0:
                 break
-            time.sleep_ms(50)
-        if response != _R1_IDLE_STATE:
+            sleep_ms(50)
+        if response != 0:
             raise OSError(f"timeout waiting for ACMD41 initialization (response={response})")
+        # CMD58 again : now the card capacity status bit (CCS) is valid
+        self.cmd_buf(58, 0, 0, self.ocr)
+        if not self.ocr[0] & 0x80:
+            if self.debug_level >= 1:
+                print(f'[SDCard] card does not show power-up status bit - ignored')
+        if version == 2 and self.ocr[0] & 0x40:
+            # SDHC/SDXC card, uses block addressing in read/write commands
+            self.cdv = 1
+        else:
+            # SDSC card, uses byte addressing in read/write commands
+            self.cdv = 512
+            # CMD16: set block length to 512 bytes
+            if self.cmd(16, 512, 0) != 0:
+                raise OSError("can't set 512 block size")
         # get the number of sectors
         # CMD9: read card-specific data
         # CMD9: response R2 (R1 byte + 16-byte block read)
-        if self.cmd_buf(9, 0, 0, self.csd) != _R1_IDLE_STATE:
-            raise OSError("no response from SD card")       
+        self.read_register(9, self.csd)
         if self.csd[0] & 0xC0 == 0x40:  # CSD version 2.0
             self.sectors = ((self.csd[8] << 8 | self.csd[9]) + 1) * 1024
             print(f'V2 : {self.sectors} sectors')
@@ -271,6 +315,11 @@ class SDCard:
             print(f'V1 : {self.sectors} sectors')
         else:
             raise OSError("SD card CSD format not supported")
+        # CMD10: read card identification
+        self.read_register(10, self.cid)
+        # set to high data rate now that it's initialised
+        self.init_spi(self.baudrate)
+        self.cache_block = -1
         if self.debug_level >= 1:
             print('[SDCard] init_card done.')
 
@@ -357,11 +406,250 @@ class SDCard:
         print('[SDCard] init_card done.')
         e"""
 
-    def readblocks(self, block_num, buf, off=None):
-        pass
+    def release(self) -> None:
+        """
+        Release the CS signal and clock one more byte, so the card frees MISO.
+        """
+        self.cs(1)
+        self.spi.write(b"\xff")
+
+    def wait_token(self) -> None:
+        """
+        Wait for the start token of a data block sent by the card.
+        The CS signal stays active.
+
+        Raises:
+            OSError: on timeout
+        """
+        for i in range(1000):
+            self.spi.readinto(self.tokenbuf, 0xFF)
+            if self.tokenbuf[0] == _TOKEN_DATA:
+                return
+            if i > 100:
+                sleep_ms(1)
+        self.release()
+        raise OSError("timeout waiting for DATA token")
+
+    def wait_ready(self) -> None:
+        """
+        Wait while the card signals busy (MISO held low).
+        """
+        self.spi.readinto(self.tokenbuf, 0xFF)
+        while self.tokenbuf[0] == 0:
+            self.spi.readinto(self.tokenbuf, 0xFF)
+
+    def read_data(self, buf, skip:int=0, size:int=512) -> None:
+        """
+        Receive a data block sent by the card after a read command.
+        Only the bytes from skip to skip+len(buf) are stored, the remaining bytes
+        of the block and the 2-byte checksum are clocked out and discarded.
+        The CS signal stays active.
+
+        Args:
+            buf : buffer receiving the data
+            skip (int): number of bytes to discard before the data
+            size (int): size of the data block sent by the card
+        """
+        self.wait_token()
+        if skip:
+            self.spi.write(self.fill[:skip])
+        self.spi.readinto(buf, 0xFF)
+        self.spi.write(self.fill[: size - skip - len(buf) + 2])
+
+    def read_register(self, cmd:int, buf) -> None:
+        """
+        Read a 16-byte register (CSD or CID), which is sent as a data block.
+
+        Args:
+            cmd (int): 9 for CSD, 10 for CID
+            buf : 16-byte buffer receiving the register
+
+        Raises:
+            OSError: if the card does not accept the command
+        """
+        response = self.cmd(cmd, 0, 0, release=False)
+        if response != 0:
+            self.release()
+            raise OSError(f"CMD({cmd}) responds {response}")
+        self.read_data(buf, 0, 16)
+        self.release()
+
+    def read_block(self, block_num:int, buf, offset:int=0) -> None:
+        """
+        Read part of a single block (CMD17).
+
+        Args:
+            block_num (int): block number
+            buf : buffer receiving len(buf) bytes
+            offset (int): position of the first byte within the block
+        """
+        response = self.cmd(17, block_num * self.cdv, 0, release=False)
+        if response != 0:
+            self.release()
+            raise OSError(f"[SDCard] readblocks() CMD(17) responds {response}")
+        self.read_data(buf, offset)
+        self.release()
+
+    def read_multi(self, block_num:int, buf) -> None:
+        """
+        Read a number of whole blocks with a single CMD18.
+
+        Args:
+            block_num (int): first block number
+            buf : buffer receiving the blocks, a multiple of 512 bytes
+        """
+        response = self.cmd(18, block_num * self.cdv, 0, release=False)
+        if response != 0:
+            self.release()
+            raise OSError(f"[SDCard] readblocks() CMD(18) responds {response}")
+        mv = memoryview(buf)
+        for pos in range(0, len(buf), 512):
+            self.read_data(mv[pos : pos + 512])
+        # CMD12: stop transmission, response R1b
+        response = self.cmd(12, 0, 0, release=False, skip1=True)
+        self.wait_ready()
+        self.release()
+        if response != 0:
+            raise OSError(f"[SDCard] readblocks() CMD(12) responds {response}")
+
+    def write_data(self, token:int, buf) -> None:
+        """
+        Send a data block to the card and wait until it is programmed.
+
+        Args:
+            token (int): start token (single block or multi-block write)
+            buf : 512 bytes of data
+
+        Raises:
+            OSError: if the card rejects the data
+        """
+        self.cs(0)
+        self.spi.read(1, token)
+        self.spi.write(buf)
+        self.spi.write(self.fill[:2])
+        # data response token xxx0sss1, sss=010 : accepted
+        self.spi.readinto(self.tokenbuf, 0xFF)
+        response = self.tokenbuf[0] & 0x1F
+        if response != 0x05:
+            self.release()
+            raise OSError(f"[SDCard] writeblocks() data rejected ({response:#04x})")
+        self.wait_ready()
+        self.release()
+
+    def write_block(self, block_num:int, buf) -> None:
+        """
+        Write a single whole block (CMD24).
+        """
+        response = self.cmd(24, block_num * self.cdv, 0)
+        if response != 0:
+            raise OSError(f"[SDCard] writeblocks() CMD(24) responds {response}")
+        self.write_data(_TOKEN_DATA, buf)
+
+    def write_multi(self, block_num:int, buf) -> None:
+        """
+        Write a number of whole blocks with a single CMD25.
+        """
+        response = self.cmd(25, block_num * self.cdv, 0)
+        if response != 0:
+            raise OSError(f"[SDCard] writeblocks() CMD(25) responds {response}")
+        mv = memoryview(buf)
+        for pos in range(0, len(buf), 512):
+            try:
+                self.write_data(_TOKEN_CMD25, mv[pos : pos + 512])
+            except OSError:
+                # the card keeps waiting for data blocks until the transfer is stopped
+                self.stop_transfer()
+                raise
+        self.stop_transfer()
+
+    def stop_transfer(self) -> None:
+        """
+        End a multi-block write with the STOP_TRAN token and wait until the card is done.
+        """
+        self.cs(0)
+        self.spi.read(1, _TOKEN_STOP_TRAN)
+        self.spi.write(b"\xff")
+        self.wait_ready()
+        self.release()
 
-    def writeblocks(self, block_num, buf, off=False):
-        pass
+    def readblocks(self, block_num:int, buf, offset:int=0) -> None:
+        """
+        Read data from the card (extended block device protocol).
+        The data start at byte offset within block block_num and may extend over several blocks.
+        Only the requested bytes of partial blocks are stored, runs of whole blocks are read with CMD18.
+        The block held in the one-block cache is copied without accessing the card.
+
+        Args:
+            block_num (int): block number
+            buf : buffer receiving the data
+            offset (int): position of the first byte within the block
+        """
+        if self.debug_level >= 1:
+            print(f'[SDCard] readblocks(block={block_num},size={len(buf)},offset={offset})')
+        mv = memoryview(buf)
+        nbytes = len(buf)
+        pos = 0
+        while pos < nbytes:
+            n = min(512 - offset, nbytes - pos)
+            if block_num == self.cache_block:
+                mv[pos : pos + n] = self.block_memoryview[offset : offset + n]
+            elif n == 512 and nbytes - pos >= 1024:
+                # the cache is written through, so the card holds the same data
+                count = (nbytes - pos) // 512
+                n = count * 512
+                self.read_multi(block_num, mv[pos : pos + n])
+                block_num += count - 1
+            else:
+                self.read_block(block_num, mv[pos : pos + n], offset)
+            pos += n
+            offset = 0
+            block_num += 1
+
+    def writeblocks(self, block_num:int, buf, offset:int=0) -> None:
+        """
+        Write data to the card (extended block device protocol).
+        The data start at byte offset within block block_num and may extend over several blocks.
+        Partial blocks are read into the one-block cache (unless already there),
+        modified and written back. Runs of whole blocks are written directly.
+
+        Args:
+            block_num (int): block number
+            buf : data to be written
+            offset (int): position of the first byte within the block
+        """
+        if self.debug_level >= 1:
+            print(f'[SDCard] writeblocks(block={block_num},size={len(buf)},offset={offset})')
+        mv = memoryview(buf)
+        nbytes = len(buf)
+        pos = 0
+        while pos < nbytes:
+            n = min(512 - offset, nbytes - pos)
+            if n == 512:
+                count = (nbytes - pos) // 512
+                n = count * 512
+                if self.cache_block >= block_num and self.cache_block < block_num + count:
+                    self.cache_block = -1
+                if count == 1:
+                    self.write_block(block_num, mv[pos : pos + n])
+                else:
+                    self.write_multi(block_num, mv[pos : pos + n])
+                block_num += count - 1
+            else:
+                # read-modify-write through the one-block cache
+                if block_num != self.cache_block:
+                    self.cache_block = -1
+                    self.read_block(block_num, self.block_memoryview)
+                    self.cache_block = block_num
+                self.block_memoryview[offset : offset + n] = mv[pos : pos + n]
+                try:
+                    self.write_block(block_num, self.block_memoryview)
+                except OSError:
+                    # the cached block no longer matches the card
+                    self.cache_block = -1
+                    raise
+            pos += n
+            offset = 0
+            block_num += 1
 
     def ioctl(self, op, arg):
         if self.debug_level >= 1:
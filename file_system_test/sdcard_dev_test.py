@@ -0,0 +1,172 @@
+"""
+Host-side test of the extended block device protocol of sdcard_dev.py.
+
+The driver runs against the SD card emulator (sd_emulator.py). Reads and
+writes at unaligned byte offsets, within one block and across block
+boundaries, must return and store exactly the bytes of a reference image.
+Partial writes go through the one-block write-through cache : repeated
+small programs of the same block must read the block from the card only
+once and every write must reach the card, whole-block writes over the
+cached block must not leave stale data in the cache. A data block rejected
+in the middle of a multi-block write must end the transfer with STOP_TRAN,
+a card still waiting for data ignores the next command. A V1.x card, which
+rejects CMD8 and uses byte addresses, must be initialized as well.
+
+run with : python3 sdcard_dev_test.py
+"""
+
+import random
+from sdcard_dev import SDCard
+from sd_emulator import SDEmulator
+
+NUM_BLOCKS = 1024
+
+
+def make_card(card):
+    sd = SDCard(card, card.cs)
+    sd.init_card()
+    return sd
+
+
+def check(sd, card, image, block_num, offset, nbytes):
+    """ read through the driver and compare with the reference image and the card contents """
+    buf = bytearray(nbytes)
+    sd.readblocks(block_num, buf, offset)
+    start = block_num * 512 + offset
+    assert buf == image[start : start + nbytes], f'read {block_num}+{offset} ({nbytes} bytes)'
+    assert card.data[start : start + nbytes] == image[start : start + nbytes], 'card not written'
+
+
+card = SDEmulator(num_blocks=NUM_BLOCKS)
+sd = make_card(card)
+assert sd.cdv == 1 and sd.sectors == NUM_BLOCKS
+image = bytearray(random.Random(1).randbytes(NUM_BLOCKS * 512))
+sd.writeblocks(0, image)
+card.reset_counters()
+
+# reads at unaligned offsets : inside a block, across one and several block boundaries
+for block_num, offset, nbytes in ((3, 17, 64), (3, 500, 24), (5, 511, 2), (7, 100, 1000),
+                                  (9, 1, 3 * 512), (20, 0, 700), (30, 256, 4 * 512 + 100)):
+    check(sd, card, image, block_num, offset, nbytes)
+assert card.commands.get('CMD24', 0) == card.commands.get('CMD25', 0) == 0
+
+# read-after-write through the cache : 64-byte programs of one block
+rng = random.Random(2)
+card.reset_counters()
+for offset in range(0, 512, 64):
+    data = rng.randbytes(64)
+    sd.writeblocks(40, data, offset)
+    image[40 * 512 + offset : 40 * 512 + offset + 64] = data
+    check(sd, card, image, 40, offset, 64)
+    check(sd, card, image, 40, 0, 512)
+assert sd.cache_block == 40
+assert card.commands['CMD17'] == 1, 'cached block read again'
+assert card.commands['CMD24'] == 8, 'write not passed through'
+
+# unaligned writes across block boundaries, partial blocks at both ends
+for block_num, offset, nbytes in ((50, 300, 400), (60, 10, 3 * 512), (70, 511, 2),
+                                  (80, 0, 2 * 512 + 1)):
+    data = rng.randbytes(nbytes)
+    sd.writeblocks(block_num, data, offset)
+    start = block_num * 512 + offset
+    image[start : start + nbytes] = data
+    check(sd, card, image, block_num, offset, nbytes)
+    check(sd, card, image, block_num - 1, 0, 512 * (nbytes // 512 + 3))
+
+# whole-block writes over the cached block replace the cache contents
+sd.writeblocks(90, b'\x11' * 8, 100)
+assert sd.cache_block == 90
+data = rng.randbytes(3 * 512)
+sd.writeblocks(89, data)
+image[89 * 512 : 92 * 512] = data
+assert sd.cache_block == -1
+check(sd, card, image, 90, 100, 8)
+sd.writeblocks(90, b'\x22' * 8, 200)
+image[90 * 512 + 200 : 90 * 512 + 208] = b'\x22' * 8
+check(sd, card, image, 89, 0, 3 * 512)
+
+# a failed write leaves no stale block in the cache
+card.inject('write_error')
+try:
+    sd.writeblocks(90, b'\x33' * 8, 300)
+    assert False, 'write error not raised'
+except OSError:
+    pass
+assert sd.cache_block == -1
+check(sd, card, image, 90, 0, 512)
+print(f'SDHC card : {card.commands}')
+
+
+class StrictEmulator(SDEmulator):
+    """ card ignoring commands while a multi-block write has not been stopped """
+    def command(self):
+        if self.state == 'write_multi':
+            self.cmdbuf = bytearray()
+            return
+        super().command()
+
+
+# a rejected data block inside a CMD25 transfer
+card = StrictEmulator(num_blocks=NUM_BLOCKS)
+sd = make_card(card)
+image = bytearray(random.Random(4).randbytes(NUM_BLOCKS * 512))
+sd.writeblocks(0, image)
+data = rng.randbytes(5 * 512)
+card.reset_counters()
+card.inject('write_error', after=2)
+try:
+    sd.writeblocks(200, data)
+    assert False, 'write error not raised'
+except OSError:
+    pass
+assert card.commands == {'CMD25': 1}
+assert card.state == 'idle', 'transfer not stopped'
+image[200 * 512 : 202 * 512] = data[: 2 * 512]
+check(sd, card, image, 199, 0, 8 * 512)
+sd.writeblocks(200, data)
+image[200 * 512 : 205 * 512] = data
+check(sd, card, image, 199, 0, 8 * 512)
+print(f'rejected multi-block write : {card.commands}')
+
+
+class V1Emulator(SDEmulator):
+    """ standard capacity V1.x card : no CMD8, no CCS bit, byte addresses """
+    cmd8 = None
+
+    def cmd58(self, arg):
+        ocr = 0x80FF8000 if not self.idle else 0x00FF8000
+        return bytes([self.r1()]) + ocr.to_bytes(4, 'big')
+
+    def acmd41(self, arg):
+        assert not arg & 0x40000000, 'HCS set for a V1.x card'
+        return super().acmd41(arg)
+
+    def cmd17(self, arg):
+        assert arg % 512 == 0
+        return super().cmd17(arg // 512)
+
+    def cmd18(self, arg):
+        assert arg % 512 == 0
+        return super().cmd18(arg // 512)
+
+    def cmd24(self, arg):
+        assert arg % 512 == 0
+        return super().cmd24(arg // 512)
+
+    def cmd25(self, arg):
+        assert arg % 512 == 0
+        return super().cmd25(arg // 512)
+
+
+card = V1Emulator(num_blocks=NUM_BLOCKS)
+sd = make_card(card)
+assert sd.cdv == 512
+assert card.commands['CMD16'] == 1
+image = bytearray(random.Random(3).randbytes(NUM_BLOCKS * 512))
+sd.writeblocks(0, image)
+check(sd, card, image, 0, 0, NUM_BLOCKS * 512)
+sd.writeblocks(100, b'\x44' * 100, 450)
+image[100 * 512 + 450 : 100 * 512 + 550] = b'\x44' * 100
+check(sd, card, image, 99, 3, 3 * 512)
+print(f'V1.x card : {card.commands}')
+print('passed.')
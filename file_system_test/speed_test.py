@@ -24,7 +24,8 @@ spi = SPI(0,
           sck=Pin(18),   # GPIO 18
           mosi=Pin(19),  # GPIO 19
           miso=Pin(16))  # GPIO 16
-sd = sdcard.SDCard(spi, cs, baudrate=8_000_000, debug=True)
+# baudrate=None : the SPI clock is tuned for the card (stored in sdcard_tune.json)
+sd = sdcard.SDCard(spi, cs, baudrate=None, debug=True)
 # initialize and mount the card
 card_try_counter = 0
 good = False
@@ -0,0 +1,257 @@
+"""
+Shared SPI bus with per-device handles.
+
+Several devices on one SPI peripheral (e.g. the SD card and the SSD1331
+display on SPI0, sharing SCK and MOSI) need different clock rates and must
+not interleave their transfers. SPIBus owns the peripheral and hands out an
+SPIDevice per device. A handle behaves like the SPI object the drivers
+expect (init, write, read, readinto, write_readinto), its chip-select pin
+is wrapped by handle.cs:
+
+    cs(0)   acquires the bus for the device and configures the peripheral
+    cs(1)   releases the bus
+
+The peripheral is only re-initialized when the device holding the bus has
+other settings than the one before, handle.init() just stores the settings.
+Transfers made while the device is not selected (e.g. the dummy byte clocked
+out after deselecting an SD card) acquire and release the bus by themselves.
+Transactions are serialized with a _thread lock, so devices can be driven
+from both cores. A single handle must not be used by both cores at once.
+
+Example usage:
+
+    spi = SPI(0, sck=Pin(18), mosi=Pin(19), miso=Pin(16))
+    bus = spibus.SPIBus(spi)
+    sd_spi = bus.device(Pin(17, Pin.OUT, value=1), baudrate=25_000_000)
+    sd = sdcard.SDCard(sd_spi, sd_spi.cs, baudrate=25_000_000)
+    oled_spi = bus.device(Pin(22, Pin.OUT, value=1), baudrate=24_000_000)
+    oled = SSD1331(oled_spi, oled_spi.cs, pin_dc, pin_rst)
+
+A sequence of transfers without chip-select (or with a pin not passed to the
+bus) can hold the bus with a context:
+
+    with oled_spi:
+        oled_spi.write(buf1)
+        oled_spi.write(buf2)
+
+The bus stays locked from cs(0) until cs(1), a driver raising in between
+without deselecting blocks the other devices for good. SDCard deselects
+the card on any exception, other drivers can select with a context,
+which deselects also on an exception:
+
+    with oled_spi.cs:
+        oled_spi.write(buf)
+"""
+
+try:
+    from _thread import allocate_lock
+except ImportError:
+    from threading import Lock as allocate_lock
+
+
+class SPIBus:
+    """
+    Owner of an SPI peripheral shared by several devices.
+
+    internal variables :
+        spi : the SPI peripheral
+        lock : serializes the transactions of the devices
+        owner (SPIDevice) : device holding the bus, None if the bus is free
+        depth (int) : nesting depth of the owner's acquire() calls
+        config (tuple) : settings the peripheral is currently initialized with
+
+    counters :
+        transactions : number of times the bus was acquired
+        reinits : number of times the peripheral was re-initialized
+    """
+    def __init__(self, spi) -> None:
+        """
+        Args:
+            spi : SPI peripheral with the pins set up, e.g. machine.SPI(0, sck=..., mosi=..., miso=...)
+        """
+        self.spi = spi
+        self.lock = allocate_lock()
+        self.owner = None
+        self.depth = 0
+        self.config = None
+        self.transactions = 0
+        self.reinits = 0
+
+    def device(self, cs=None, baudrate:int=1_000_000, polarity:int=0, phase:int=0,
+               bits:int=8, firstbit=None):
+        """
+        Create a handle for a device on the bus.
+
+        Args:
+            cs : chip-select pin of the device (wrapped as handle.cs), None if selected otherwise
+            baudrate, polarity, phase, bits, firstbit : SPI settings of the device
+
+        Returns:
+            (SPIDevice): the handle
+        """
+        return SPIDevice(self, cs, baudrate, polarity, phase, bits, firstbit)
+
+    def acquire(self, device) -> None:
+        """
+        Wait until the bus is free, then configure it for the device.
+        Nested calls by the owner only count the depth.
+        """
+        if self.owner is device:
+            self.depth += 1
+            return
+        self.lock.acquire()
+        self.owner = device
+        self.depth = 1
+        self.transactions += 1
+        if self.config != device.config:
+            self.spi.init(**device.settings)
+            self.config = device.config
+            self.reinits += 1
+
+    def release(self, device) -> None:
+        """
+        Release one level of acquire(), the bus is free when the outermost level is released.
+        """
+        if self.owner is not device:
+            return
+        self.depth -= 1
+        if self.depth == 0:
+            self.owner = None
+            self.lock.release()
+
+
+class SPIDevice:
+    """
+    Handle of one device on a shared SPI bus, used in place of the SPI object.
+
+    internal variables :
+        bus (SPIBus) : the shared bus
+        cs (ChipSelect) : the wrapped chip-select pin, None if none was given
+        settings (dict) : keyword arguments of spi.init() for this device
+        config (tuple) : the settings in comparable form
+    """
+    def __init__(self, bus, cs, baudrate, polarity, phase, bits, firstbit) -> None:
+        self.bus = bus
+        self.settings = {}
+        self.config = None
+        self.init(baudrate=baudrate, polarity=polarity, phase=phase, bits=bits, firstbit=firstbit)
+        self.cs = ChipSelect(self, cs) if cs is not None else None
+
+    def init(self, baudrate:int=None, polarity:int=None, phase:int=None, bits:int=None,
+             firstbit=None, **kwargs) -> None:
+        """
+        Change the settings of the device (same arguments as SPI.init()).
+        They are applied when the device next acquires the bus,
+        pins (sck, mosi, miso) belong to the bus and are ignored.
+        """
+        for key, value in (('baudrate', baudrate), ('polarity', polarity), ('phase', phase),
+                           ('bits', bits), ('firstbit', firstbit)):
+            if value is not None:
+                self.settings[key] = value
+        self.config = tuple(sorted(self.settings.items()))
+        if self.bus.owner is self and self.bus.config != self.config:
+            # changed during a transaction, e.g. SDCard.init_spi() with the card selected
+            self.bus.spi.init(**self.settings)
+            self.bus.config = self.config
+            self.bus.reinits += 1
+
+    def __enter__(self):
+        self.bus.acquire(self)
+        return self
+
+    def __exit__(self, *args):
+        self.bus.release(self)
+
+    def write(self, buf):
+        bus = self.bus
+        if bus.owner is self:
+            return bus.spi.write(buf)
+        bus.acquire(self)
+        try:
+            return bus.spi.write(buf)
+        finally:
+            bus.release(self)
+
+    def read(self, nbytes, write=0x00):
+        bus = self.bus
+        if bus.owner is self:
+            return bus.spi.read(nbytes, write)
+        bus.acquire(self)
+        try:
+            return bus.spi.read(nbytes, write)
+        finally:
+            bus.release(self)
+
+    def readinto(self, buf, write=0x00):
+        bus = self.bus
+        if bus.owner is self:
+            return bus.spi.readinto(buf, write)
+        bus.acquire(self)
+        try:
+            return bus.spi.readinto(buf, write)
+        finally:
+            bus.release(self)
+
+    def write_readinto(self, wbuf, rbuf):
+        bus = self.bus
+        if bus.owner is self:
+            return bus.spi.write_readinto(wbuf, rbuf)
+        bus.acquire(self)
+        try:
+            return bus.spi.write_readinto(wbuf, rbuf)
+        finally:
+            bus.release(self)
+
+
+class ChipSelect:
+    """
+    Chip-select pin of a device on a shared bus, used in place of the Pin object.
+    Driving it low acquires the bus, driving it high releases it.
+    Repeated selects without deselect (as done by SDCard) hold the bus only once.
+    Used as a context it selects the device and deselects it on exit, also on an exception.
+    """
+    def __init__(self, device, pin) -> None:
+        self.device = device
+        self.pin = pin
+        self.OUT = pin.OUT
+        self.selected = False
+
+    def init(self, mode=None, value=1) -> None:
+        self(value)
+        self.pin.init(self.pin.OUT if mode is None else mode, value=value)
+
+    def __call__(self, value=None):
+        if value is None:
+            return self.pin()
+        if value:
+            self.pin(1)
+            if self.selected:
+                self.selected = False
+                self.device.bus.release(self.device)
+        else:
+            if not self.selected:
+                self.device.bus.acquire(self.device)
+                self.selected = True
+            self.pin(0)
+
+    def __enter__(self):
+        self(0)
+        return self
+
+    def __exit__(self, *args):
+        self(1)
+
+    def value(self, value=None):
+        return self(value)
+
+    def high(self) -> None:
+        self(1)
+
+    def low(self) -> None:
+        self(0)
+
+    def on(self) -> None:
+        self(1)
+
+    def off(self) -> None:
+        self(0)
@@ -0,0 +1,171 @@
+"""
+Host-side test of the shared SPI bus.
+
+The SD card emulator (sd_emulator.py) and a recording display share one bus.
+Blocks are written to the card in a multi-block stream while display frames
+are pushed in between, first alternating, then from a second thread.
+The card must hold the written data, every display frame must be received
+complete, and the bus is only re-initialized when the device changes.
+An exception between select and deselect, in the SD card driver or in a
+display transfer selected with a context, must not leave the bus locked.
+
+run with : python3 spibus_test.py
+"""
+
+import _thread
+import time
+from sdcard import SDCard
+from sd_emulator import SDEmulator
+from spibus import SPIBus
+
+FIRST_BLOCK = 64
+NUM_BLOCKS = 40
+FRAME = bytes(range(96)) * 8
+
+
+class InterruptedCard(SDEmulator):
+    """ card whose transfers raise (like a KeyboardInterrupt) once a given byte count is reached """
+    interrupt_at = None
+
+    def xfer(self, mosi):
+        if self.selected and self.interrupt_at is not None and self.bytes >= self.interrupt_at:
+            self.interrupt_at = None
+            raise RuntimeError('interrupted')
+        return super().xfer(mosi)
+
+
+class RecordingPin:
+    OUT = 1
+
+    def __init__(self, value=1):
+        self.state = value
+
+    def init(self, mode=None, value=1):
+        self.state = value
+
+    def __call__(self, value=None):
+        if value is None:
+            return self.state
+        self.state = value
+
+
+class Display:
+    """ writes frames like the nanogui SSD1331 driver, counts the bytes seen while selected """
+    def __init__(self, spi, cs, card):
+        self.spi = spi
+        self.cs = cs
+        self.card = card
+        self.frames = 0
+
+    def show(self):
+        bytes_before = self.card.bytes
+        self.cs(1)
+        self.cs(0)
+        assert self.card.baudrate == 24_000_000
+        self.spi.write(FRAME)
+        self.cs(1)
+        assert self.card.bytes - bytes_before == len(FRAME), 'frame interrupted'
+        self.frames += 1
+
+
+def pattern(block):
+    return bytes((block * 5 + i) & 0xFF for i in range(512))
+
+
+card = InterruptedCard(num_blocks=1024)
+bus = SPIBus(card)
+sd_spi = bus.device(card.cs, baudrate=25_000_000)
+oled_spi = bus.device(RecordingPin(), baudrate=24_000_000)
+sd = SDCard(sd_spi, sd_spi.cs, baudrate=25_000_000)
+sd.init_card()
+display = Display(oled_spi, oled_spi.cs, card)
+
+# alternating : one re-init per change of device
+reinits = bus.reinits
+sd.stream_open(FIRST_BLOCK)
+for block in range(NUM_BLOCKS // 2):
+    sd.stream_write(pattern(block))
+    display.show()
+print(f'{bus.transactions} transactions, {bus.reinits - reinits} re-inits')
+assert bus.reinits - reinits <= NUM_BLOCKS + 1
+assert card.baudrate == 24_000_000
+
+# no re-init while the same device keeps the bus
+reinits = bus.reinits
+for i in range(5):
+    display.show()
+assert bus.reinits == reinits
+
+# the display runs in a second thread while the card is written
+done = []
+
+
+def display_thread():
+    while not done:
+        display.show()
+        time.sleep(0.0005)
+    done.append(1)
+
+
+_thread.start_new_thread(display_thread, ())
+for block in range(NUM_BLOCKS // 2, NUM_BLOCKS):
+    sd.stream_write(pattern(block))
+    time.sleep(0.0002)
+sd.stream_close()
+done.append(1)
+while len(done) < 2:
+    time.sleep(0.001)
+assert bus.owner is None
+
+buf = bytearray(512)
+for block in range(NUM_BLOCKS):
+    sd.readblocks(FIRST_BLOCK + block, buf)
+    assert buf == pattern(block), f'block {block} differs'
+print(f'{NUM_BLOCKS} blocks and {display.frames} frames transferred, {bus.reinits} re-inits')
+
+
+def bus_free():
+    """ the bus is neither owned nor locked, the display can still take it """
+    if bus.owner is not None or not bus.lock.acquire(False):
+        return False
+    bus.lock.release()
+    frames = display.frames
+    display.show()
+    return display.frames == frames + 1
+
+
+# an exception inside the SD card driver, in a command and in a data block
+for delay in (3, 300):
+    card.interrupt_at = card.bytes + delay
+    try:
+        sd.readblocks(FIRST_BLOCK, buf)
+        assert False, 'exception not raised'
+    except RuntimeError:
+        pass
+    assert not sd_spi.cs.selected and not card.selected
+    assert bus_free(), f'bus locked after an exception {delay} bytes into a read'
+card.interrupt_at = card.bytes + 100
+try:
+    sd.stream_open(FIRST_BLOCK)
+    sd.stream_write(pattern(0))
+    assert False, 'exception not raised'
+except RuntimeError:
+    pass
+assert bus_free(), 'bus locked after an exception in a write stream'
+# the interrupted block has undefined content, the card is usable after recover()
+sd.recover()
+sd.readblocks(FIRST_BLOCK + 1, buf)
+assert buf == pattern(1)
+
+# an exception in a display transfer selected with a context
+try:
+    with oled_spi.cs:
+        oled_spi.write(FRAME[:100])
+        raise RuntimeError('interrupted')
+except RuntimeError:
+    pass
+assert not oled_spi.cs.selected
+assert bus_free(), 'bus locked after an exception in a display transfer'
+sd.readblocks(FIRST_BLOCK + 2, buf)
+assert buf == pattern(2)
+print('passed.')
@@ -0,0 +1,45 @@
+"""
+Host-side test of the latency instrumentation of the SDCard driver.
+
+The driver runs against the SD card emulator (sd_emulator.py), timed by
+the emulator's simulated clock. A multi-block write entering a new
+allocation unit without pre-erase shows up as a long block write.
+
+run with : python3 stats_test.py
+"""
+
+from sdcard import SDCard
+from sd_emulator import SDEmulator
+
+card = SDEmulator(num_blocks=4096, au_blocks=256, program_us=800, multi_program_us=150, erase_us=5000)
+sd = SDCard(card, card.cs, baudrate=25_000_000, pre_erase=False)
+sd.init_card()
+plain_cmd = SDCard.cmd
+
+stats = sd.enable_stats(ticks=lambda: int(card.time_us))
+buf = bytearray(512)
+for block in range(16):
+    sd.writeblocks(block, buf)
+sd.writeblocks(256, bytearray(8 * 512))
+sd.readblocks(0, buf)
+sd.ioctl(3, 0)
+stats.dump()
+
+s = stats.summary()
+assert s['commands'] == {'CMD24': 16, 'CMD25': 1, 'CMD17': 1}, s['commands']
+assert s['writes'] == 16 + 8 and sum(s['write_hist']) == s['writes']
+# single-block writes wait for programming, the first block of the new AU for the erase
+assert s['write_max_us'] >= 5000 and s['busy_max_us'] >= 5000
+assert s['busy_us'] >= 16 * 800
+
+# ACMD23 is counted as application command
+sd.pre_erase = True
+stats.reset()
+sd.writeblocks(512, bytearray(4 * 512))
+assert stats.summary()['commands'] == {'CMD55': 1, 'ACMD23': 1, 'CMD25': 1}
+
+# without stats the plain methods are used again
+sd.disable_stats()
+assert sd.stats is None and sd.cmd.__func__ is plain_cmd
+sd.writeblocks(0, buf)
+print('passed.')
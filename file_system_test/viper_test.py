@@ -0,0 +1,72 @@
+"""
+Host-side check of the viper and native code generator functions.
+
+On the host the @micropython.viper and @micropython.native decorators are
+replaced by plain Python fallbacks, so the tests of the modules never see
+what the MicroPython compiler rejects. Every such function of the driver
+and logging modules must take at most 4 positional arguments (the viper
+limit of older firmware). With mpy-cross installed (pip install mpy-cross)
+the modules are also compiled for the Cortex-M0+ code emitter (-march=armv6m),
+which catches the viper type errors, otherwise this part is skipped.
+
+run with : python3 viper_test.py
+"""
+
+import ast
+import glob
+import os
+import shutil
+import subprocess
+import tempfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+MODULES = sorted(glob.glob(os.path.join(HERE, '*.py')) +
+                 glob.glob(os.path.join(HERE, '..', 'imu_ekf_dev', '*.py')))
+
+
+def emitter_functions(path):
+    """ names and positional argument counts of the viper/native functions of a module """
+    with open(path) as f:
+        tree = ast.parse(f.read(), path)
+    for node in ast.walk(tree):
+        if isinstance(node, ast.FunctionDef):
+            for decorator in node.decorator_list:
+                if (isinstance(decorator, ast.Attribute) and decorator.attr in ('viper', 'native')
+                        and isinstance(decorator.value, ast.Name) and decorator.value.id == 'micropython'):
+                    yield decorator.attr, node.name, len(node.args.args)
+
+
+def mpy_cross_command():
+    """ command running mpy-cross, None if it is not installed """
+    try:
+        import mpy_cross
+        return [mpy_cross.mpy_cross]
+    except (ImportError, SystemExit):
+        path = shutil.which('mpy-cross')
+        return [path] if path else None
+
+
+compiled = []
+for path in MODULES:
+    functions = list(emitter_functions(path))
+    for emitter, name, nargs in functions:
+        if emitter == 'viper':
+            assert nargs <= 4, f'{os.path.basename(path)} : viper function {name}() takes {nargs} arguments'
+    if functions:
+        compiled.append(path)
+print(f'{len(compiled)} modules with viper/native functions : '
+      f'{", ".join(os.path.relpath(p, HERE) for p in compiled)}')
+assert any(path.endswith('sdcard.py') for path in compiled)
+assert any(path.endswith('imulog.py') for path in compiled)
+
+command = mpy_cross_command()
+if command is None:
+    print('mpy-cross not installed, compilation skipped.')
+else:
+    out = os.path.join(tempfile.mkdtemp(), 'out.mpy')
+    for path in compiled:
+        result = subprocess.run(command + ['-march=armv6m', '-o', out, path],
+                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        assert result.returncode == 0, f'mpy-cross {path} :\n{result.stdout.decode()}'
+    print(f'compiled with {os.path.basename(command[0])} -march=armv6m')
+print('passed.')
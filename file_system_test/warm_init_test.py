@@ -0,0 +1,63 @@
+"""
+Host-side test of the warm start of the SDCard driver.
+
+The emulated card (sd_emulator.py) is initialized once with the full sequence
+and the card state is stored. After a simulated power cycle warm_init() must
+bring the card up without reading the CSD, querying CMD6 or tuning the clock,
+and in less bus time. A different card in the slot falls back to init_card().
+
+run with : python3 warm_init_test.py
+"""
+
+import os
+import tempfile
+from sdcard import SDCard
+from sd_emulator import SDEmulator
+
+tmp = tempfile.mkdtemp()
+state_file = os.path.join(tmp, 'state.json')
+card = SDEmulator(num_blocks=2048, log_commands=True)
+card.data[512:1024] = bytes(range(256)) * 2
+
+
+def boot(card, baudrate=None):
+    """ power cycle and warm start, returns the driver, the result and the commands sent """
+    card.power_up()
+    card.reset_counters()
+    sd = SDCard(card, card.cs, baudrate=baudrate)
+    warm = sd.warm_init(state_file)
+    return sd, warm, [cmd for cmd, arg in card.log]
+
+
+# first boot : no stored state, full initialization with tuning
+cwd = os.getcwd()
+os.chdir(tmp)
+sd, warm, commands = boot(card)
+os.chdir(cwd)
+full_us = card.time_us
+print(f'full initialization : {full_us:.0f} us bus time, {len(commands)} commands')
+assert not warm and 'CMD9' in commands and os.path.exists(state_file)
+assert sd.hs_mode and sd.baudrate == 50_000_000
+
+# second boot : warm start from the stored state
+sd, warm, commands = boot(card)
+print(f'warm start : {card.time_us:.0f} us bus time, {commands}')
+assert warm
+assert 'CMD9' not in commands and 'CMD17' not in commands and 'CMD18' not in commands
+assert [arg for cmd, arg in card.log if cmd == 'CMD6'] == [0x80FFFFF1]
+assert card.hs_mode and card.baudrate == 50_000_000 and sd.baudrate == 50_000_000
+assert sd.sectors == 2048 and sd.erase_group == 128
+assert card.time_us < full_us / 4
+buf = bytearray(512)
+sd.readblocks(1, buf)
+assert buf == card.data[512:1024]
+
+# another card in the slot : the CID does not match
+other = SDEmulator(num_blocks=4096, serial=0x0BADCAFE, high_speed=False, log_commands=True)
+sd, warm, commands = boot(other, baudrate=20_000_000)
+print(f'other card : warm start {warm}, {sd.sectors} sectors')
+assert not warm and 'CMD9' in commands and sd.sectors == 4096 and not sd.hs_mode
+# the state of the new card has been stored
+sd, warm, commands = boot(other)
+assert warm and 'CMD6' not in commands and sd.baudrate == 20_000_000
+print('passed.')
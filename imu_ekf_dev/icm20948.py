@@ -229,6 +229,7 @@ class ICM20948(I2C_Device):
         Args:
             config (AccelConfig): configuration dictionary
         """
+        self.accConfig = config
         self._bank = 2
         # ACCEL_SMPLRT_DIV_1/ACCEL_SMPLRT_DIV_2 forming a 12-bit register
         reg = (config['SampleRateDiv'] >> 8) & 0x0f
@@ -267,6 +268,7 @@ class ICM20948(I2C_Device):
         Args:
             config (GyroConfig): configuration dictionary
         """
+        self.gyrConfig = config
         self._bank = 2
         reg = config['SampleRateDiv'] & 0xff
         if self.debug:
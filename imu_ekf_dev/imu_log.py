@@ -2,8 +2,11 @@ import utime
 from machine import I2C, Pin, SPI
 from icm20948 import ICM20948, AccelConfig, GyroConfig
 import sdcard
+import spibus
 import vfs
-import struct
+import imulog
+from logpipeline import LogPipeline
+from monotonic import MonotonicClock
 
 print('logging ICM-20948 data')
 print('----------------------')
@@ -34,11 +37,16 @@ spi = SPI(0,
           sck=Pin(18),   # GPIO 18
           mosi=Pin(19),  # GPIO 19
           miso=Pin(16))  # GPIO 16
-sd = sdcard.SDCard(spi, cs)
+# SPI0 is shared with the SSD1331 display, the card gets its own handle on the bus
+bus = spibus.SPIBus(spi)
+sd_spi = bus.device(cs, baudrate=25_000_000)
+# baudrate=None : the SPI clock is tuned for the card (stored in sdcard_tune.json)
+sd = sdcard.SDCard(sd_spi, sd_spi.cs, baudrate=None, nonblocking=True)
 # initialize and mount the card
 card_try_counter = 0
 try:
-    sd.init_card()
+    # reuses the card state stored on the previous run, full initialization otherwise
+    sd.warm_init()
     fs = vfs.VfsLfs2(sd, readsize=512, progsize=512, lookahead=512)
     vfs.mount(fs, "/sd")
 except Exception as e:
@@ -52,6 +60,8 @@ except Exception as e:
 print('LittleFS filesystem on SD card mounted.')
 print(fs)
 print()
+# count commands and time the card's busy periods while logging
+sd_stats = sd.enable_stats()
 
 start = utime.ticks_us()
 imu._bank=0
@@ -72,22 +82,68 @@ print(f'scaled accel values [g]: ', imu.get_accel())
 print('opening file imu_log.dat')
 f = fs.open("imu_log.dat", "wb")
 
+# delta encoded samples (format version 3) fit about twice as many per block,
+# off by default : the time per sample of the encoder on the Pico2 is not yet
+# measured (imulog_benchmark.py), raw records (version 2) are the proven path
+DELTA = False
+# the header describes the raw records (schema, scales, ODR, DLPF, sensor),
+# it fills whole blocks so the records stay block-aligned
+# every block starts with a 64-bit timestamp, the records store the offset to it
+f.write(imulog.make_header(imu, blocks=True, delta=DELTA))
+clock = MonotonicClock()
+clock.start_timer()
+# core 0 samples on schedule and packs the records into a preallocated
+# ring of 2 kB buffers, core 1 writes the complete buffers to the file,
+# so the busy periods of the card do not delay the sampling
+if DELTA:
+    # the encoder commits whole blocks
+    pipe = LogPipeline('512s', num_slots=8, slot_blocks=4)
+    encoder = imulog.DeltaEncoder(pipe, clock)
+else:
+    pipe = LogPipeline(imulog.RECORD_FORMAT, num_slots=8, slot_blocks=4)
+pipe.start(f.write)
+# sample at the ODR of the accelerometer
+PERIOD_US = int(1_000_000 / (1125 / (1 + imu.accConfig['SampleRateDiv'])))
+
 start = utime.ticks_ms()
 deadline = utime.ticks_add(start,10000)
-# loop as fast as we can
-while utime.ticks_ms() < deadline:
-    # time stamp as 32-bit integer
-    # it seems to reset to 0 when reaching 1e9
+next_sample = utime.ticks_us()
+block_number = 0
+while utime.ticks_diff(deadline, utime.ticks_ms()) > 0:
+    while utime.ticks_diff(next_sample, utime.ticks_us()) > 0:
+        pass
+    # ticks_us() wraps around after 2**30 us
     timestamp = utime.ticks_us()
     imu.read_AccelGyro()
-    acc = imu.get_accel()
-    gyro = imu.get_gyro()
-    block = struct.pack('iffffff', timestamp, acc[0], acc[1], acc[2], gyro[0], gyro[1], gyro[2])
-    f.write(block)
+    # raw counts, scaled by the host tools
+    if DELTA:
+        encoder.add(timestamp, imu.acc_gyro_buf)
+    else:
+        if pipe.fill % 512 == 0:
+            # start of a block : 64-bit time of the clock
+            epoch = timestamp
+            imulog.pack_block_header(pipe.buf, pipe.fill, clock.ticks_to_us(epoch), block_number)
+            pipe.commit()
+            block_number += 1
+        imulog.pack_record(pipe.buf, pipe.fill, utime.ticks_diff(timestamp, epoch), imu.acc_gyro_buf)
+        pipe.commit()
+    next_sample = utime.ticks_add(next_sample, PERIOD_US)
+if DELTA:
+    encoder.flush()
+    block_number = encoder.blocks
+    samples = encoder.samples
+else:
+    samples = pipe.records - block_number
+# writes the last partial buffer and waits for core 1
+pipe.close()
+clock.stop_timer()
+print(f'{samples} samples in {block_number} blocks, {pipe.written} writes, {pipe.overruns} overruns, up to {pipe.peak} buffers waiting')
 
 print('closing file imu_log.dat')
 f.close()
 print()
+sd_stats.dump()
+print()
 
 print('listdir')
 print(list(fs.ilistdir()))
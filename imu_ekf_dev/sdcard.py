@@ -1,9 +1,81 @@
 """
 MicroPython driver for SD cards using SPI bus.
 
+for further information see:
+    http://elm-chan.org/docs/mmc/mmc_e.html
+    https://www.it-sd.com/articles/secure-digital-card-registers/
+
 Requires an SPI bus and a CS pin.  Provides readblocks and writeblocks
 methods so the device can be mounted as a filesystem.
 
+For logging sequential data a streaming write session can be used, which keeps
+the card in multi-block write mode (CMD25) across calls:
+
+    sd.stream_open(first_block)
+    sd.stream_write(buf)    # any multiple of 512 bytes, as often as needed
+    sd.stream_close()
+
+If the number of blocks of a multi-block write is known (always in writeblocks(),
+optionally via sd.stream_open(first_block, count)), the card is told in advance
+with ACMD23, so it can pre-erase the blocks (disable with pre_erase=False).
+
+With SDCard(..., nonblocking=True) the write functions return as soon as the
+data is clocked out. The card programs the data internally while the caller
+continues; sd.busy() tells when the next block can be issued without waiting.
+
+With SDCard(..., readahead=N) single-block reads in ascending order trigger
+a CMD18 prefetch of the next N blocks, which are then served from RAM
+(counters sd.ra_hits and sd.ra_misses, depth changed by sd.set_readahead()).
+
+Erase requests of the filesystem (ioctl op 6) are collected into contiguous
+ranges and erased with CMD32/CMD33/CMD38 in units of the card's erase group
+(CSD SECTOR_SIZE), sd.erase() erases a range directly. Ranges shorter than
+an erase group (or SDCard(..., erase_min=n) blocks) are dropped, as are
+pending erases of blocks written next: an erase costs a full busy period,
+programming the block does not need it.
+
+With SDCard(..., baudrate=None) the SPI clock is tuned after initialization:
+rates up to the card's TRAN_SPEED are checked by reading (and optionally
+writing) test blocks, the fastest reliable rate is used and stored together
+with the card ID in sdcard_tune.json, so the next boot skips the sweep.
+
+Cards supporting high-speed mode are switched to it with CMD6 during
+init_card() (disable with SDCard(..., high_speed=False)), raising the
+TRAN_SPEED limit used by the baud rate tuning from 25 to 50 MHz.
+
+sd.save_state() stores what init_card() found out about the card (CID, CSD,
+addressing, high-speed mode, tuned SPI clock) in sdcard_state.json. On the next
+boot sd.warm_init() only resets the card and checks its CID before reusing the
+stored state, falling back to the full init_card() if anything does not match.
+
+For raw logging sd.au_region(start, nblocks) returns a region aligned to the
+card's allocation units (AU size from the SD status, sd.read_sd_status()).
+
+sd.enable_stats() attaches latency instrumentation (SDStats): per-command
+counters, cumulative and maximum busy-wait time and a histogram of block-write
+latencies, queried with sd.stats.summary() or written out with sd.stats.dump().
+Without it the driver runs its uninstrumented methods, so it costs nothing.
+
+Failed block transfers raise SDError (an OSError) with the error classified
+from the R1 response, the data response or the data error token. readblocks()
+and writeblocks() retry them (SDCard(..., retries=3)) after a CMD13 status check,
+continuing with the first block not transferred, and re-initialize the card only
+when all retries fail (disable with reinit=False). The counters sd.io_errors
+(per kind), sd.io_retries and sd.io_reinits tell how often this happened.
+
+With SDCard(..., crc=True) the card checks the CRC7 of commands and the CRC16
+of data blocks (CMD59), the driver sends them and checks the CRC16 of the blocks
+read. A mismatch is an SDError of kind 'crc' and retried like other errors.
+The CRCs are computed with 256-entry tables, CRC16 in a viper function.
+
+An exception escaping readblocks(), writeblocks(), ioctl(), the stream and
+erase methods or init_card() leaves the card deselected, a shared SPI bus
+(spibus.py) is not kept locked by it.
+
+sd.spi_calls counts the SPI transfers made on the read path (commands, data
+tokens, blocks), the difference around a readblocks() call gives the number
+of transfers per block.
+
 Example usage on pyboard:
 
     import pyb, sdcard, os
@@ -20,47 +92,380 @@ Example usage on ESP8266:
 
 """
 
-from micropython import const
 import time
-
+import json
+from array import array
+try:
+    from machine import Pin
+    import micropython
+    from micropython import const
+    sleep_ms = time.sleep_ms
+    ticks_us = time.ticks_us
+    ticks_diff = time.ticks_diff
+except ImportError:
+    # running on a host computer against a simulated card
+    class micropython:
+        @staticmethod
+        def viper(f):
+            return f
+    def ptr8(buf):
+        return buf
+    def ptr16(buf):
+        return buf
+    def const(x):
+        return x
+    def sleep_ms(ms):
+        time.sleep(ms / 1000)
+    def ticks_us():
+        return time.perf_counter_ns() // 1000
+    def ticks_diff(a, b):
+        return a - b
+from util import *
 
 _CMD_TIMEOUT = const(100)
+_CMD_BURST = const(8)      # bytes read at once while waiting for a command response
+_TOKEN_BURST = const(16)   # bytes read at once while waiting for a data token
+_TOKEN_SPIN = const(16)    # token bursts read before sleeping between tries
+_SAFE_BAUDRATE = const(1_000_000)
+# longest busy period after a block written (SDXC, 250 ms for SDHC),
+# a card busy for longer has been removed or locked up
+_BUSY_TIMEOUT_MS = const(500)
+
+# candidate SPI clock rates for tune_baudrate(), fastest first
+_TUNE_BAUDRATES = (50_000_000, 37_500_000, 30_000_000, 25_000_000, 20_000_000,
+                   15_000_000, 12_500_000, 10_000_000, 8_000_000, 4_000_000, 2_000_000)
+# AU_SIZE (SD status) in units of 512-byte blocks
+_AU_BLOCKS = (0, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384,
+              24576, 32768, 49152, 65536, 131072)
+# TRAN_SPEED (CSD byte 3) : rate unit (bits 2:0, 4..7 reserved) and time value (bits 6:3) times 10
+_TRAN_SPEED_UNIT = (100_000, 1_000_000, 10_000_000, 100_000_000, 0, 0, 0, 0)
+_TRAN_SPEED_VALUE = (0, 10, 12, 13, 15, 20, 25, 30, 35, 40, 45, 50, 55, 60, 70, 80)
 
 _R1_IDLE_STATE = const(1 << 0)
 # R1_ERASE_RESET = const(1 << 1)
 _R1_ILLEGAL_COMMAND = const(1 << 2)
-# R1_COM_CRC_ERROR = const(1 << 3)
+_R1_COM_CRC_ERROR = const(1 << 3)
 # R1_ERASE_SEQUENCE_ERROR = const(1 << 4)
-# R1_ADDRESS_ERROR = const(1 << 5)
-# R1_PARAMETER_ERROR = const(1 << 6)
+_R1_ADDRESS_ERROR = const(1 << 5)
+_R1_PARAMETER_ERROR = const(1 << 6)
 _TOKEN_CMD25 = const(0xFC)
 _TOKEN_STOP_TRAN = const(0xFD)
 _TOKEN_DATA = const(0xFE)
+# data response token (lower 5 bits) after a block written
+_DATA_ACCEPTED = const(0x05)
+_DATA_CRC_ERROR = const(0x0B)
+_DATA_WRITE_ERROR = const(0x0D)
+# not a token : the card accepted the block but did not finish programming in time
+_DATA_BUSY_TIMEOUT = const(0x00)
+# data error token sent instead of the data token of a read
+_ERR_TOKEN_OUT_OF_RANGE = const(1 << 3)
+_ERR_TOKEN_ECC_FAILED = const(1 << 2)
+_ERR_TOKEN_CC_ERROR = const(1 << 1)
+# CRC7 of commands (in the position of the command's last byte)
+# and CRC16-CCITT of data blocks, one table entry per byte value
+def _make_crc_tables():
+    crc7_table = bytearray(256)
+    crc16_table = array('H', bytes(2 * 256))
+    for i in range(256):
+        c = i
+        for j in range(8):
+            c = (c << 1) ^ 0x12 if c & 0x80 else c << 1
+        crc7_table[i] = c & 0xFF
+        c = i << 8
+        for j in range(8):
+            c = (c << 1) ^ 0x1021 if c & 0x8000 else c << 1
+        crc16_table[i] = c & 0xFFFF
+    return crc7_table, crc16_table
+_CRC7_TABLE, _CRC16_TABLE = _make_crc_tables()
+# block I/O retries : backoff doubles from 1 ms up to _RETRY_MAX_MS
+_RETRY_MAX_MS = const(16)
+# errors caused by the request itself, not retried
+_FATAL_ERRORS = ('address', 'parameter', 'range')
+
+
+class SDError(OSError):
+    """
+    Failed SD card transfer.
+
+    attributes :
+        kind (str) : classification of the error, see r1_error(), data_error() and token_error()
+        block (int) : first block not transferred, None if unknown
+    """
+    def __init__(self, message, kind='error', block=None):
+        super().__init__(message)
+        self.kind = kind
+        self.block = block
+
+
+def crc7(buf, n):
+    """
+    CRC7 of the first n bytes of buf, returned as the last byte of a command (with end bit).
+    """
+    table = _CRC7_TABLE
+    crc = 0
+    for i in range(n):
+        crc = table[crc ^ buf[i]]
+    return crc | 1
+
+
+@micropython.viper
+def crc16(buf) -> int:
+    """
+    CRC16-CCITT (polynomial 0x1021, initial value 0) of a data block.
+    """
+    data = ptr8(buf)
+    table = ptr16(_CRC16_TABLE)
+    n = int(len(buf))
+    crc = 0
+    for i in range(n):
+        crc = ((crc << 8) ^ table[((crc >> 8) ^ data[i]) & 0xFF]) & 0xFFFF
+    return crc
+
+
+def r1_error(response):
+    """
+    Classify an R1 command response other than 0 (-1 : no response).
+    """
+    if response < 0:
+        return 'timeout'
+    if response & _R1_COM_CRC_ERROR:
+        return 'crc'
+    if response & _R1_ADDRESS_ERROR:
+        return 'address'
+    if response & _R1_PARAMETER_ERROR:
+        return 'parameter'
+    if response & _R1_ILLEGAL_COMMAND:
+        return 'illegal'
+    if response & _R1_IDLE_STATE:
+        return 'idle'
+    return 'error'
+
+
+def data_error(response):
+    """
+    Classify a data response token other than 'data accepted'.
+    """
+    if response == _DATA_CRC_ERROR:
+        return 'crc'
+    if response == _DATA_WRITE_ERROR:
+        return 'write'
+    if response == _DATA_BUSY_TIMEOUT:
+        return 'timeout'
+    return 'response'
+
+
+def token_error(token):
+    """
+    Classify a data error token received instead of the data token of a read.
+    """
+    if token & _ERR_TOKEN_OUT_OF_RANGE:
+        return 'range'
+    if token & _ERR_TOKEN_ECC_FAILED:
+        return 'ecc'
+    if token & _ERR_TOKEN_CC_ERROR:
+        return 'cc'
+    return 'error'
+
+
+def deselect_on_error(method):
+    """
+    Decorator of the SDCard methods driving CS : any exception (e.g. KeyboardInterrupt)
+    leaves the card deselected, so that a shared SPI bus (spibus.py) is released.
+    """
+    def wrapper(self, *args, **kwargs):
+        try:
+            return method(self, *args, **kwargs)
+        except BaseException:
+            self.cs(1)
+            raise
+    return wrapper
+
+
+class SDStats:
+    """
+    Latency instrumentation of an SDCard, created by SDCard.enable_stats().
+    All memory is allocated when the object is created.
+
+    counters :
+        cmd_count (array) : number of commands sent, index = command number,
+            application commands (following CMD55) at command number + 64
+        busy_waits : number of times the driver waited for the card to finish programming
+        busy_us, busy_max_us : cumulative and maximum time spent waiting
+        writes : number of block writes
+        write_max_us : longest block write
+        write_hist (array) : block-write latencies, bin 0 counts writes shorter
+            than bin_us, bin i those from bin_us * 2**(i-1) to bin_us * 2**i,
+            the last bin everything longer
+    A block write is timed from the data token to the end of programming,
+    with non-blocking writes only until the data is clocked out.
+    """
+    def __init__(self, bins=16, bin_us=64, ticks=None):
+        self.bins = bins
+        self.bin_us = bin_us
+        self.ticks = ticks or ticks_us
+        self.cmd_count = array('I', bytes(4 * 128))
+        self.write_hist = array('I', bytes(4 * bins))
+        self.reset()
+
+    def reset(self):
+        for i in range(128):
+            self.cmd_count[i] = 0
+        for i in range(self.bins):
+            self.write_hist[i] = 0
+        self.app_cmd = False
+        self.busy_waits = 0
+        self.busy_us = 0
+        self.busy_max_us = 0
+        self.writes = 0
+        self.write_max_us = 0
+
+    def add_cmd(self, cmd):
+        self.cmd_count[cmd + 64 if self.app_cmd else cmd] += 1
+        self.app_cmd = (cmd == 55)
+
+    def add_busy(self, us):
+        self.busy_waits += 1
+        self.busy_us += us
+        if us > self.busy_max_us:
+            self.busy_max_us = us
+
+    def add_write(self, us):
+        self.writes += 1
+        if us > self.write_max_us:
+            self.write_max_us = us
+        i = 0
+        n = us // self.bin_us
+        while n and i < self.bins - 1:
+            n >>= 1
+            i += 1
+        self.write_hist[i] += 1
+
+    def summary(self):
+        """
+        Returns:
+            (dict): the counters, commands as 'CMDn' / 'ACMDn' -> count
+        """
+        commands = {}
+        for i in range(128):
+            if self.cmd_count[i]:
+                name = f'ACMD{i - 64}' if i >= 64 else f'CMD{i}'
+                commands[name] = self.cmd_count[i]
+        return {
+            'commands': commands,
+            'busy_waits': self.busy_waits,
+            'busy_us': self.busy_us,
+            'busy_max_us': self.busy_max_us,
+            'writes': self.writes,
+            'write_max_us': self.write_max_us,
+            'write_hist': list(self.write_hist),
+        }
+
+    def dump(self, file=None):
+        """
+        Print the counters, e.g. into a log file opened for writing.
+        """
+        s = self.summary()
+        print('[SDCard] commands : ' + ' '.join(f'{k}={v}' for k, v in s['commands'].items()), file=file)
+        print(f"[SDCard] busy : {s['busy_waits']} waits, {s['busy_us']} us total, {s['busy_max_us']} us max", file=file)
+        print(f"[SDCard] block writes : {s['writes']}, {s['write_max_us']} us max", file=file)
+        low = 0
+        high = self.bin_us
+        for i in range(self.bins):
+            if self.write_hist[i]:
+                upper = f'{high} us' if i < self.bins - 1 else '...'
+                print(f'[SDCard]   {low} us - {upper} : {self.write_hist[i]}', file=file)
+            low = high
+            high *= 2
 
 
 class SDCard:
-    def __init__(self, spi, cs, baudrate=1320000, debug=False):
+    def __init__(self, spi, cs, baudrate=1_000_000, debug=False, nonblocking=False, readahead=0,
+                 high_speed=True, pre_erase=True, retries=3, reinit=True, crc=False, erase_min=None):
         self.spi = spi
         self.cs = cs
         self.baudrate = baudrate
         self.debug = debug
+        # failed block transfers are repeated up to retries times, then the card
+        # is re-initialized (if reinit is set) and the transfer tried once more
+        self.retries = retries
+        self.reinit = reinit
+        # error counters : io_errors maps the error kind to the number of occurrences
+        self.io_errors = {}
+        self.io_retries = 0
+        self.io_reinits = 0
+        # SPI clock last set with init_spi()
+        self.spi_baudrate = 0
+        # last data response token (lower 5 bits) of a block written
+        self.data_response = _DATA_ACCEPTED
+        # CRC protection of commands and data blocks (CMD59), enabled by init_card()
+        self.crc = crc
+        self.crcbuf = bytearray(2)
+        # switch capable cards to high-speed mode (50 MHz) during init_card()
+        self.high_speed = high_speed
+        # announce the length of multi-block writes with ACMD23
+        self.pre_erase = pre_erase
+        # with nonblocking writes the data transfer functions return as soon as
+        # the data is clocked out; busy() tells whether the card is still programming
+        self.nonblocking = nonblocking
+        self.busy_pending = False
+        # waiting for the card to finish programming gives up after busy_timeout_ms,
+        # raised for the busy period of an erase
+        self.busy_timeout_ms = _BUSY_TIMEOUT_MS
+        if self.debug:
+            self.trigger = Pin(20, Pin.OUT, value=0)
         self.cmdbuf = bytearray(6)
         self.dummybuf = bytearray(512)
         self.tokenbuf = bytearray(1)
         for i in range(512):
             self.dummybuf[i] = 0xFF
         self.dummybuf_memoryview = memoryview(self.dummybuf)
+        self.csd = bytearray(16)
+        self.cid = bytearray(16)
+        # found out by init_card(), stored with save_state() for warm_init()
+        self.v2 = True
+        self.cdv = 1
+        self.hs_mode = False
+        # responses and tokens are read in bursts, the bytes received after them
+        # are kept in burstbuf[burst_pos:burst_end] for the following transfer
+        self.burstbuf = bytearray(_TOKEN_BURST)
+        self.burst_mv = memoryview(self.burstbuf)
+        self.cmdburst_mv = self.burst_mv[:_CMD_BURST]
+        self.burst_pos = 0
+        self.burst_end = 0
+        # number of SPI transfers made on the read path, for benchmarking
+        self.spi_calls = 0
+        # next block of an open CMD25 write stream, None if no stream is open
+        self.stream_block = None
+        # sequential readahead, see set_readahead()
+        self.set_readahead(readahead)
+        # erase geometry (from the CSD) and pending batched erase requests,
+        # ranges shorter than erase_min blocks (default one erase group) are not erased
+        self.erase_threshold = erase_min
+        self.erase_blk_en = 0
+        self.erase_group = 1
+        self.erase_min = 1
+        self.erase_first = 0
+        self.erase_count = 0
+        # SD status (ACMD13), read by read_sd_status()
+        self.sd_status = bytearray(64)
+        self.au_blocks = 0
+        # latency instrumentation, see enable_stats()
+        self.stats = None
 
     def init_spi(self, baudrate):
+        self.spi_baudrate = baudrate
         try:
             master = self.spi.MASTER
         except AttributeError:
-            # on ESP8266
+            # on ESP8266 and RPi2
+            if self.debug:
+                print(f'setting baud rate to {baudrate}.')
             self.spi.init(baudrate=baudrate, phase=0, polarity=0)
         else:
             # on pyboard
             self.spi.init(master, baudrate=baudrate, phase=0, polarity=0)
 
+    @deselect_on_error
     def init_card(self):
         if self.debug:
             print('[SDcard] init_card()')
@@ -81,7 +486,7 @@ class SDCard:
             response = self.cmd(0, 0, 0x95)
             if response == _R1_IDLE_STATE:
                 break
-            time.sleep_ms(50)
+            sleep_ms(50)
         if response != _R1_IDLE_STATE:
             raise OSError(f"no SD card - CMD(0) responds {response}")
         if self.debug:
@@ -89,6 +494,10 @@ class SDCard:
 
         # CMD8: determine card version
         r = self.cmd(8, 0x01AA, 0x87, 4)
+        self.v2 = r == _R1_IDLE_STATE
+        # CMD59: let the card check the CRC of commands and data blocks
+        if self.crc and self.cmd(59, 1, 0) != _R1_IDLE_STATE:
+            raise OSError("can't enable CRC checking")
         if r == _R1_IDLE_STATE:
             if self.debug:
                 print(f'CMD(8) responds {r} -> V2.x card.')
@@ -101,47 +510,192 @@ class SDCard:
             raise OSError("couldn't determine SD card version")
 
         # get the number of sectors
+        # CMD9: read card-specific data
         # CMD9: response R2 (R1 byte + 16-byte block read)
         response = self.cmd(9, 0, 0, 0, False)
         if self.debug:
             print(f'CMD(9) responds {response}')
         if response != 0:
             raise OSError("no response from SD card")
-        csd = bytearray(16)
-        self.readinto(csd)
+        self.readinto(self.csd)
         if self.debug:
-            print('CSD: '+' '.join(f'{byte:02x}' for byte in csd))
-        if csd[0] & 0xC0 == 0x40:  # CSD version 2.0
-            self.sectors = ((csd[8] << 8 | csd[9]) + 1) * 1024
-        elif csd[0] & 0xC0 == 0x00:  # CSD version 1.0 (old, <=2GB)
-            c_size = (csd[6] & 0b11) << 10 | csd[7] << 2 | csd[8] >> 6
-            c_size_mult = (csd[9] & 0b11) << 1 | csd[10] >> 7
-            read_bl_len = csd[5] & 0b1111
-            capacity = (c_size + 1) * (2 ** (c_size_mult + 2)) * (2**read_bl_len)
-            self.sectors = capacity // 512
-        else:
-            raise OSError("SD card CSD format not supported")
-        # print('sectors', self.sectors)
+            print('CSD: '+' '.join(f'{byte:02x}' for byte in self.csd))
+        self.parse_csd()
+
+        # CMD10: read card identification, identifies the card for stored settings
+        response = self.cmd(10, 0, 0, 0, False)
+        if response != 0:
+            raise OSError("no response from SD card")
+        self.readinto(self.cid)
+        if self.debug:
+            print('CID: '+' '.join(f'{byte:02x}' for byte in self.cid))
 
         # CMD16: set block length to 512 bytes
         if self.cmd(16, 512, 0) != 0:
             raise OSError("can't set 512 block size")
 
+        # CMD6: switch to high-speed mode, raises TRAN_SPEED to 50 MHz
+        self.hs_mode = self.high_speed and self.switch_high_speed()
+        if self.hs_mode and self.debug:
+            print(f'[SDCard] high-speed mode, max. {self.get_tran_speed()} Hz')
+
         # set to high data rate now that it's initialised
-        self.init_spi(self.baudrate)
+        # with baudrate=None the rate is tuned after the first read
+        self.init_spi(self.baudrate or _SAFE_BAUDRATE)
 
         # perform one dummy block read
+        # (not into dummybuf, which must stay all 0xFF as it is clocked out during reads)
         try:
-            self.readblocks(0, self.dummybuf)
+            self.readblocks(0, bytearray(512))
         except Exception as e:
             print(e)
             print('READ ERROR on first block read.')
         print()
 
+        if self.baudrate is None:
+            self.tune_baudrate()
+
+
+    def parse_csd(self):
+        """
+        Decode the capacity and the erase geometry from the CSD.
+        """
+        if self.csd[0] & 0xC0 == 0x40:  # CSD version 2.0
+            self.sectors = ((self.csd[8] << 8 | self.csd[9]) + 1) * 1024
+        elif self.csd[0] & 0xC0 == 0x00:  # CSD version 1.0 (old, <=2GB)
+            c_size = (self.csd[6] & 0b11) << 10 | self.csd[7] << 2 | self.csd[8] >> 6
+            c_size_mult = (self.csd[9] & 0b11) << 1 | self.csd[10] >> 7
+            read_bl_len = self.csd[5] & 0b1111
+            capacity = (c_size + 1) * (2 ** (c_size_mult + 2)) * (2**read_bl_len)
+            self.sectors = capacity // 512
+        else:
+            raise OSError("SD card CSD format not supported")
+        # erase geometry: the card erases groups of SECTOR_SIZE+1 blocks,
+        # with ERASE_BLK_EN set (every SDHC/SDXC card) also any range of single blocks.
+        # An erase keeps the card busy for a full erase period, so by default only
+        # ranges of at least one erase group are passed on, not the single-block
+        # erases a file system issues before programming a block
+        self.erase_blk_en = extract_bit_field(self.csd, 46, 1)
+        self.erase_group = extract_bit_field(self.csd, 39, 7) + 1
+        self.erase_min = self.erase_threshold or self.erase_group
+        if not self.erase_blk_en:
+            self.erase_min = max(self.erase_min, self.erase_group)
+
+    def save_state(self, state_file='sdcard_state.json'):
+        """
+        Store what init_card() found out about the card (CID, CSD, version,
+        addressing, high-speed mode and SPI clock), used by warm_init() on the next boot.
+        """
+        state = {
+            'cid': ''.join(f'{byte:02x}' for byte in self.cid),
+            'csd': ''.join(f'{byte:02x}' for byte in self.csd),
+            'v2': self.v2,
+            'cdv': self.cdv,
+            'hs_mode': bool(self.hs_mode),
+            'baudrate': self.baudrate or _SAFE_BAUDRATE}
+        try:
+            with open(state_file, 'w') as f:
+                json.dump(state, f)
+        except OSError:
+            print(f'[SDCard] cannot store card state in {state_file}')
+
+    def warm_init(self, state_file='sdcard_state.json'):
+        """
+        Initialize the card using the state stored by save_state().
+        The card still has to be reset (CMD0) and brought out of the idle state (ACMD41),
+        but this is done at 400 kHz, polling ACMD41 without the 50 ms sleeps.
+        Reading the CSD, the high-speed query, the dummy block read and the
+        baud rate tuning are skipped. The CID is read to make sure it is the same card.
+        With high_speed=False the card stays in default speed, the clock is limited
+        to its TRAN_SPEED.
+        Without a stored state, or if anything does not match,
+        the full init_card() is run and its result stored.
+        Returns True if the warm start succeeded.
+        """
+        try:
+            with open(state_file) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            state = None
+        if state is not None:
+            try:
+                if self.warm_init_card(state):
+                    return True
+            except (OSError, KeyError, ValueError) as e:
+                if self.debug:
+                    print(f'[SDCard] warm_init() : {e}')
+            self.cs(1)
+            self.burst_pos = self.burst_end = 0
+        if self.debug:
+            print('[SDCard] warm_init() : full initialization')
+        self.init_card()
+        self.save_state(state_file)
+        return False
+
+    def warm_init_card(self, state):
+        """
+        Initialization sequence of warm_init(), returns False on a mismatch with the stored state.
+        """
+        self.cs.init(self.cs.OUT, value=1)
+        self.init_spi(400_000)
+        self.spi.write(self.dummybuf_memoryview[:16])
+        for _ in range(5):
+            response = self.cmd(0, 0, 0x95)
+            if response == _R1_IDLE_STATE:
+                break
+            sleep_ms(1)
+        if response != _R1_IDLE_STATE:
+            return False
+        v2 = state['v2']
+        if v2 and self.cmd(8, 0x01AA, 0x87, 4) != _R1_IDLE_STATE:
+            return False
+        if self.crc and self.cmd(59, 1, 0) != _R1_IDLE_STATE:
+            return False
+        # ACMD41 usually needs a few tries, the card is polled every millisecond
+        for i in range(_CMD_TIMEOUT * 50):
+            self.cmd(55, 0, 0)
+            if self.cmd(41, 0x40000000 if v2 else 0, 0) == 0:
+                break
+            sleep_ms(1)
+        else:
+            return False
+        # CMD10: the card must be the one the state was stored for
+        if self.cmd(10, 0, 0, 0, False) != 0:
+            return False
+        self.readinto(self.cid)
+        if ''.join(f'{byte:02x}' for byte in self.cid) != state['cid']:
+            return False
+        self.v2 = v2
+        self.cdv = state['cdv']
+        self.csd[:] = bytes.fromhex(state['csd'])
+        self.parse_csd()
+        if self.cmd(16, 512, 0) != 0:
+            return False
+        # the card starts in default speed after a reset, CMD6 mode 1 switches directly
+        self.hs_mode = False
+        if state['hs_mode'] and self.high_speed:
+            status = bytearray(64)
+            if self.cmd(6, 0x80FFFFF1, 0, 0, False) != 0:
+                return False
+            self.readinto(status)
+            if status[16] & 0x0F != 1:
+                return False
+            self.spi.write(b"\xff")
+            self.hs_mode = True
+        self.baudrate = state['baudrate']
+        if state['hs_mode'] and not self.hs_mode:
+            # high-speed mode disabled : the stored CSD and clock are those of high-speed mode,
+            # CMD9 reads the default-speed TRAN_SPEED, which limits the clock
+            if self.cmd(9, 0, 0, 0, False) != 0:
+                return False
+            self.readinto(self.csd)
+            self.baudrate = min(self.baudrate, self.get_tran_speed())
+        self.init_spi(self.baudrate)
+        return True
 
     def init_card_v1(self):
         for i in range(_CMD_TIMEOUT):
-            time.sleep_ms(50)
+            sleep_ms(50)
             self.cmd(55, 0, 0)
             if self.cmd(41, 0, 0) == 0:
                 # SDSC card, uses byte addressing in read/write/erase commands
@@ -152,7 +706,7 @@ class SDCard:
 
     def init_card_v2(self):
         for i in range(_CMD_TIMEOUT):
-            time.sleep_ms(50)
+            sleep_ms(50)
             self.cmd(58, 0, 0, 4)
             self.cmd(55, 0, 0)
             if self.cmd(41, 0x40000000, 0) == 0:
@@ -169,112 +723,329 @@ class SDCard:
         raise OSError("timeout waiting for v2 card")
 
     def cmd(self, cmd, arg, crc, final=0, release=True, skip1=False):
+        if self.busy_pending and not self.wait_ready():
+            # a card holding MISO low would seem to answer every command
+            return -1
         self.cs(0)
 
         # create and send the command
         buf = self.cmdbuf
         buf[0] = 0x40 | cmd
-        buf[1] = arg >> 24
-        buf[2] = arg >> 16
-        buf[3] = arg >> 8
-        buf[4] = arg
-        buf[5] = crc
+        buf[1] = (arg >> 24) & 0xFF
+        buf[2] = (arg >> 16) & 0xFF
+        buf[3] = (arg >> 8) & 0xFF
+        buf[4] = arg & 0xFF
+        buf[5] = crc7(buf, 5) if self.crc else crc
         self.spi.write(buf)
-
-        if skip1:
-            self.spi.readinto(self.tokenbuf, 0xFF)
+        calls = 1
 
         # wait for the response (response[7] == 0)
-        for i in range(_CMD_TIMEOUT):
-            self.spi.readinto(self.tokenbuf, 0xFF)
-            response = self.tokenbuf[0]
-            if not (response & 0x80):
-                # this could be a big-endian integer that we are getting here
-                # if final<0 then store the first byte to tokenbuf and discard the rest
-                if final < 0:
-                    self.spi.readinto(self.tokenbuf, 0xFF)
-                    final = -1 - final
-                for j in range(final):
-                    self.spi.write(b"\xff")
-                if release:
-                    self.cs(1)
-                    self.spi.write(b"\xff")
-                return response
+        # the card is read in bursts, bytes following the response are kept in burstbuf
+        burst = self.burstbuf
+        pos = 1 if skip1 else 0
+        for i in range((_CMD_TIMEOUT + _CMD_BURST - 1) // _CMD_BURST):
+            self.spi.readinto(self.cmdburst_mv, 0xFF)
+            calls += 1
+            while pos < _CMD_BURST:
+                response = burst[pos]
+                pos += 1
+                if not (response & 0x80):
+                    self.burst_pos = pos
+                    self.burst_end = _CMD_BURST
+                    # this could be a big-endian integer that we are getting here
+                    # if final<0 then store the first byte to tokenbuf and discard the rest
+                    if final < 0:
+                        if pos < _CMD_BURST:
+                            self.tokenbuf[0] = burst[pos]
+                            self.burst_pos = pos + 1
+                        else:
+                            self.spi.readinto(self.tokenbuf, 0xFF)
+                            calls += 1
+                        final = -1 - final
+                    if final:
+                        calls += self.skip(final)
+                    if release:
+                        self.burst_pos = self.burst_end = 0
+                        self.cs(1)
+                        self.spi.write(b"\xff")
+                        calls += 1
+                    self.spi_calls += calls
+                    return response
+            pos = 0
 
         # timeout
+        self.burst_pos = self.burst_end = 0
         self.cs(1)
         self.spi.write(b"\xff")
+        self.spi_calls += calls + 1
         return -1
 
-    def readinto(self, buf):
-        self.cs(0)
+    def skip(self, n):
+        """
+        Discard the next n bytes received from the card.
+        Bytes left over from the last burst are used first.
+        Returns the number of SPI transfers needed.
+        """
+        carried = self.burst_end - self.burst_pos
+        if n <= carried:
+            self.burst_pos += n
+            return 0
+        self.burst_pos = self.burst_end
+        self.spi.write(self.dummybuf_memoryview[: n - carried])
+        return 1
 
+    def readinto(self, buf, release=True):
+        self.cs(0)
+        if self.debug:
+            print(f'sdcard.readinto size {len(buf)}')
+            self.trigger.high()
         # read until start byte (0xfe)
+        # bytes left over from the command response are scanned first, then bursts are read
+        burst = self.burstbuf
+        pos = self.burst_pos
+        end = self.burst_end
+        calls = 0
         for i in range(_CMD_TIMEOUT):
-            self.spi.readinto(self.tokenbuf, 0xFF)
-            if self.tokenbuf[0] == _TOKEN_DATA:
-                break
-            time.sleep_ms(1)
+            while pos < end and burst[pos] == 0xFF:
+                pos += 1
+            if pos < end:
+                if burst[pos] == _TOKEN_DATA:
+                    break
+                # a data error token instead of the data
+                token = burst[pos]
+                self.burst_pos = self.burst_end = 0
+                self.cs(1)
+                if self.debug:
+                    self.trigger.low()
+                self.spi.write(b"\xff")
+                self.spi_calls += calls + 1
+                raise SDError(f'[SDCard] readinto() error token {token:02x}', token_error(token))
+            if i > _TOKEN_SPIN:
+                sleep_ms(1)
+            self.spi.readinto(burst, 0xFF)
+            calls += 1
+            pos = 0
+            end = _TOKEN_BURST
         else:
+            self.burst_pos = self.burst_end = 0
             self.cs(1)
-            raise OSError("timeout in readinto() waiting for DATA token")
+            if self.debug:
+                self.trigger.low()
+            self.spi_calls += calls
+            raise SDError("timeout in readinto() waiting for DATA token", 'timeout')
 
-        # read data
-        mv = self.dummybuf_memoryview
-        if len(buf) != len(mv):
-            mv = mv[: len(buf)]
-        self.spi.write_readinto(mv, buf)
+        # data bytes received in the same burst as the token
+        pos += 1
+        n = len(buf)
+        carried = min(end - pos, n)
+        if carried > 0:
+            buf[:carried] = self.burst_mv[pos : pos + carried]
+            pos += carried
+        else:
+            carried = 0
 
-        # read checksum
-        self.spi.write(b"\xff")
-        self.spi.write(b"\xff")
+        # read the remaining data
+        if carried < n:
+            self.spi.write_readinto(self.dummybuf_memoryview[: n - carried], memoryview(buf)[carried:])
+            calls += 1
+
+        # read checksum, unless already received within the burst
+        crc = 2 - (end - pos)
+        check = self.crc
+        received = 0
+        if check:
+            for i in range(pos, min(pos + 2, end)):
+                received = received << 8 | burst[i]
+        if not release:
+            # keep the card selected for the next block of a CMD18 transfer,
+            # missing checksum bytes are read with the first burst of that block
+            if crc > 0:
+                self.spi.readinto(burst, 0xFF)
+                calls += 1
+                self.burst_pos = crc
+                self.burst_end = _TOKEN_BURST
+                if check:
+                    for i in range(crc):
+                        received = received << 8 | burst[i]
+            else:
+                self.burst_pos = pos + 2
+                self.burst_end = end
+            if self.debug:
+                self.trigger.low()
+            self.spi_calls += calls
+            if check and received != crc16(buf):
+                self.burst_pos = self.burst_end = 0
+                raise SDError('[SDCard] readinto() data CRC error', 'crc')
+            return
+        if crc > 0:
+            if check:
+                # the missing checksum bytes
+                tail = self.crcbuf if crc == 2 else self.tokenbuf
+                self.spi.readinto(tail, 0xFF)
+                for i in range(crc):
+                    received = received << 8 | tail[i]
+            else:
+                self.spi.write(self.dummybuf_memoryview[:crc])
+            calls += 1
 
+        self.burst_pos = self.burst_end = 0
         self.cs(1)
+        if self.debug:
+            self.trigger.low()
         self.spi.write(b"\xff")
+        self.spi_calls += calls + 1
+        if check and received != crc16(buf):
+            raise SDError('[SDCard] readinto() data CRC error', 'crc')
 
-    def write(self, token, buf):
+    def write(self, token, buf, wait=True):
+        if self.busy_pending and not self.wait_ready():
+            self.data_response = _DATA_BUSY_TIMEOUT
+            return False
         self.cs(0)
+        if self.debug:
+            self.trigger.high()
 
         # send: start of block, data, checksum
         self.spi.read(1, token)
         self.spi.write(buf)
-        self.spi.write(b"\xff")
-        self.spi.write(b"\xff")
+        if self.crc:
+            crc = crc16(buf)
+            self.crcbuf[0] = crc >> 8
+            self.crcbuf[1] = crc & 0xFF
+            self.spi.write(self.crcbuf)
+        else:
+            self.spi.write(b"\xff")
+            self.spi.write(b"\xff")
 
         # check the response
-        if (self.spi.read(1, 0xFF)[0] & 0x1F) != 0x05:
+        response = self.spi.read(1, 0xFF)[0] & 0x1F
+        if response != _DATA_ACCEPTED:
+            self.data_response = response
+            if self.debug:
+                self.trigger.low()
             self.cs(1)
             self.spi.write(b"\xff")
-            return
+            return False
 
-        # wait for write to finish
-        while self.spi.read(1, 0xFF)[0] == 0:
-            pass
+        ready = True
+        if wait:
+            # wait for write to finish
+            ready = self.wait_busy()
+            if not ready:
+                self.data_response = _DATA_BUSY_TIMEOUT
+        else:
+            # the card signals busy while programming, checked by busy()
+            self.busy_pending = True
 
         self.cs(1)
         self.spi.write(b"\xff")
+        if self.debug:
+            self.trigger.low()
+        return ready
 
-    def write_token(self, token):
+    def write_token(self, token, wait=True):
+        if self.busy_pending:
+            self.wait_ready()
         self.cs(0)
         self.spi.read(1, token)
         self.spi.write(b"\xff")
-        # wait for write to finish
+        if wait:
+            # wait for write to finish, a card still busy fails the next command
+            self.wait_busy()
+        else:
+            self.busy_pending = True
+
+        self.cs(1)
+        self.spi.write(b"\xff")
+
+    def busy(self):
+        """
+        Query whether the card is still programming data of a previous
+        non-blocking write. Returns True while the card holds MISO low.
+        This costs a single byte transfer and never blocks.
+        """
+        if not self.busy_pending:
+            return False
+        self.cs(0)
+        self.spi.readinto(self.tokenbuf, 0xFF)
+        self.cs(1)
+        self.spi.write(b"\xff")
+        if self.tokenbuf[0] == 0x00:
+            return True
+        self.busy_pending = False
+        return False
+
+    def wait_busy(self):
+        """
+        Read from the selected card until it releases MISO (end of programming).
+        Returns False if it is still busy after busy_timeout_ms.
+        """
+        if self.spi.read(1, 0xFF)[0] != 0x00:
+            return True
+        start = ticks_us()
+        timeout_us = self.busy_timeout_ms * 1000
         while self.spi.read(1, 0xFF)[0] == 0x00:
-            pass
+            if ticks_diff(ticks_us(), start) > timeout_us:
+                return False
+        return True
 
+    def wait_ready(self):
+        """
+        Block until the card has finished programming, at most busy_timeout_ms.
+        Returns False if the card is still busy then (removed or locked up).
+        """
+        self.cs(0)
+        ready = self.wait_busy()
         self.cs(1)
         self.spi.write(b"\xff")
+        self.busy_pending = False
+        self.busy_timeout_ms = _BUSY_TIMEOUT_MS
+        return ready
 
+    @deselect_on_error
     def readblocks(self, block_num, buf, offset=0):
         if self.debug:
             print(f'[SDCard] readblocks() : block={block_num}')
         if offset != 0:
              raise OSError(f'[SDCard] readblocks() offset={offset} not supported')
+        # reading interrupts an open write stream
+        if self.stream_block is not None:
+            self.stream_close()
+        if self.erase_count:
+            self.flush_erase()
+        nblocks = len(buf) // 512
+        assert nblocks and not len(buf) % 512, "Buffer length is invalid"
+        if self.ra_depth:
+            if nblocks == 1 and self.ra_first <= block_num < self.ra_first + self.ra_count:
+                # served from the readahead buffer
+                i = (block_num - self.ra_first) * 512
+                buf[:] = self.ra_mv[i : i + 512]
+                self.ra_next = block_num + 1
+                self.ra_hits += 1
+                return
+            self.ra_misses += 1
+            sequential = (block_num == self.ra_next)
+            self.ra_next = block_num + nblocks
+            if nblocks == 1 and sequential:
+                # prefetch this and the following blocks with one CMD18
+                count = min(self.ra_depth, self.sectors - block_num)
+                self.ra_count = 0
+                self.io_retry(self.read_card, block_num, self.ra_mv[: count * 512])
+                self.ra_first = block_num
+                self.ra_count = count
+                buf[:] = self.ra_mv[:512]
+                return
+        self.io_retry(self.read_card, block_num, buf)
+
+    def read_card(self, block_num, buf):
+        """
+        Read len(buf)//512 blocks from the card with CMD17 or CMD18.
+        """
         # workaround for shared bus, required for (at least) some Kingston
         # devices, ensure MOSI is high before starting transaction
         self.spi.write(b"\xff")
+        self.spi_calls += 2
         nblocks = len(buf) // 512
-        assert nblocks and not len(buf) % 512, "Buffer length is invalid"
         if nblocks == 1:
             # CMD17: set read address for single block
             response = self.cmd(17, block_num * self.cdv, 0, release=False)
@@ -282,7 +1053,7 @@ class SDCard:
                 # release the card
                 self.cs(1)
                 self.spi.write(b"\xff")
-                raise OSError(f'[SDCard] readblocks() CMD(17) responds {response}')
+                raise SDError(f'[SDCard] readblocks() CMD(17) responds {response}', r1_error(response), block_num)
             # receive the data
             self.readinto(buf)
         else:
@@ -292,65 +1063,631 @@ class SDCard:
                 # release the card
                 self.cs(1)
                 self.spi.write(b"\xff")
-                raise OSError(f'[SDCard] readblocks() CMD(18) responds {response}')
+                raise SDError(f'[SDCard] readblocks() CMD(18) responds {response}', r1_error(response), block_num)
             offset = 0
             mv = memoryview(buf)
             while nblocks:
-                # receive the data and release card
-                self.readinto(mv[offset : offset + 512])
+                # receive the data, the card stays selected for the whole transfer
+                try:
+                    self.readinto(mv[offset : offset + 512], release=False)
+                except SDError as e:
+                    # stop the transfer, the blocks received so far are kept
+                    self.cmd(12, 0, 0xFF, skip1=True)
+                    self.busy_pending = True
+                    e.block = block_num + offset // 512
+                    raise
                 offset += 512
                 nblocks -= 1
+            # CMD12: stop the transfer, sent while the card already streams the next block
             response = self.cmd(12, 0, 0xFF, skip1=True)
             if response != 0:
                 # release the card
                 self.cs(1)
                 self.spi.write(b"\xff")
-                raise OSError(f'[SDCard] readblocks() CMD(12) responds {response}')
+                raise SDError(f'[SDCard] readblocks() CMD(12) responds {response}', r1_error(response))
+            # CMD12 has an R1b response, the next access waits for the end of busy
+            self.busy_pending = True
         # release the card
         self.cs(1)
         self.spi.write(b"\xff")
 
+    @deselect_on_error
     def writeblocks(self, block_num, buf, offset=0):
         if self.debug:
             print(f'[SDCard] writeblocks() : block={block_num}')
         if offset != 0:
              raise OSError(f'[SDCard] writeblocks() offset={offset} not supported')
+        self.invalidate_readahead(block_num, len(buf) // 512)
+        if self.erase_count:
+            self.flush_erase(block_num, len(buf) // 512)
+        if self.stream_block is not None:
+            # a write continuing an open stream is just appended to it
+            if block_num == self.stream_block:
+                self.stream_write(buf)
+                return
+            self.stream_close()
+        nblocks, err = divmod(len(buf), 512)
+        assert nblocks and not err, "Buffer length is invalid"
+        self.io_retry(self.write_card, block_num, buf)
+
+    def write_card(self, block_num, buf):
+        """
+        Write len(buf)//512 blocks to the card with CMD24 or CMD25.
+        Raises SDError if the card rejects a command or a data block.
+        """
         # workaround for shared bus, required for (at least) some Kingston
         # devices, ensure MOSI is high before starting transaction
         self.spi.write(b"\xff")
-        nblocks, err = divmod(len(buf), 512)
-        assert nblocks and not err, "Buffer length is invalid"
+        nblocks = len(buf) // 512
         if nblocks == 1:
             # CMD24: set write address for single block
             response = self.cmd(24, block_num * self.cdv, 0)
             if response != 0:
-                raise OSError(f'[SDCard] writeblocks() CMD(24) responds {response}')
+                raise SDError(f'[SDCard] writeblocks() CMD(24) responds {response}', r1_error(response), block_num)
             # send the data
-            self.write(_TOKEN_DATA, buf)
+            if not self.write(_TOKEN_DATA, buf, not self.nonblocking):
+                raise SDError(f'[SDCard] writeblocks() block={block_num} rejected {self.data_response:02x}',
+                              data_error(self.data_response), block_num)
         else:
+            # ACMD23: the number of blocks is known, let the card pre-erase them
+            if self.pre_erase:
+                self.set_wr_blk_erase_count(nblocks)
             # CMD25: set write address for first block
             response = self.cmd(25, block_num * self.cdv, 0)
             if response != 0:
-                raise OSError(f'[SDCard] writeblocks() CMD(25) responds {response}')
+                raise SDError(f'[SDCard] writeblocks() CMD(25) responds {response}', r1_error(response), block_num)
             # send the data
             offset = 0
             mv = memoryview(buf)
             while nblocks:
-                self.write(_TOKEN_CMD25, mv[offset : offset + 512])
+                if not self.write(_TOKEN_CMD25, mv[offset : offset + 512], not self.nonblocking):
+                    # the card rejected the data, terminate the transfer
+                    self.write_token(_TOKEN_STOP_TRAN, not self.nonblocking)
+                    failed = block_num + offset // 512
+                    raise SDError(f'[SDCard] writeblocks() block={failed} rejected {self.data_response:02x}',
+                                  data_error(self.data_response), failed)
                 offset += 512
                 nblocks -= 1
-            self.write_token(_TOKEN_STOP_TRAN)
+            self.write_token(_TOKEN_STOP_TRAN, not self.nonblocking)
         # release the card
         self.cs(1)
         self.spi.write(b"\xff")
 
+    def io_retry(self, transfer, block_num, buf):
+        """
+        Run a block transfer (read_card or write_card), repeating it on errors.
+        After a failure the card is brought back into a defined state by recover()
+        and the transfer continues with the first block not transferred,
+        waiting 1, 2, 4 ... up to 16 ms between the tries. When all retries
+        fail the card is re-initialized and the transfer tried a last time.
+        Errors caused by the request (address or parameter out of range) are not retried.
+        """
+        try:
+            return transfer(block_num, buf)
+        except SDError as e:
+            error = e
+        first = block_num
+        mv = memoryview(buf)
+        delay = 1
+        for attempt in range(self.retries + 1):
+            kind = error.kind
+            self.io_errors[kind] = self.io_errors.get(kind, 0) + 1
+            if self.debug:
+                print(f'[SDCard] io_retry() : {error}')
+            if kind in _FATAL_ERRORS:
+                raise error
+            if error.block is not None and error.block > block_num:
+                # continue behind the blocks already transferred
+                block_num = error.block
+                mv = memoryview(buf)[(block_num - first) * 512 :]
+            if attempt == self.retries:
+                break
+            sleep_ms(delay)
+            delay = min(2 * delay, _RETRY_MAX_MS)
+            self.io_retries += 1
+            if not self.recover():
+                break
+            try:
+                return transfer(block_num, mv)
+            except SDError as e:
+                error = e
+        if not self.reinit:
+            raise error
+        # last resort : initialize the card again
+        self.io_reinits += 1
+        self.recover()
+        self.init_card()
+        return transfer(block_num, mv)
+
+    def recover(self):
+        """
+        Bring the card back into the transfer state after a failed transfer:
+        release it, wait until it is no longer busy and check its status with CMD13.
+        Returns False if the card stays busy, does not respond or has been reset
+        (idle state), then only a re-initialization helps.
+        """
+        self.burst_pos = self.burst_end = 0
+        self.stream_block = None
+        self.cs(1)
+        self.spi.write(b"\xff")
+        if not self.wait_ready():
+            if self.debug:
+                print('[SDCard] recover() : card stays busy')
+            return False
+        # CMD13: SEND_STATUS, R2 response (R1 and a second status byte)
+        response = self.cmd(13, 0, 0, -1)
+        if self.debug:
+            print(f'[SDCard] recover() : CMD(13) responds {response} {self.tokenbuf[0]:02x}')
+        return response == 0 or (response > 0 and not response & _R1_IDLE_STATE)
+
+    def switch_high_speed(self):
+        """
+        Switch the card to high-speed mode with CMD6 (SWITCH_FUNC).
+        The card must support command class 10 (CCC in the CSD).
+        First the support of function 1 (high-speed) in function group 1
+        is queried (mode 0), then the function is selected (mode 1).
+        Both return a 64-byte status data block. Afterwards the CSD is
+        read again, now reporting a TRAN_SPEED of 50 MHz.
+        Returns True if the card is in high-speed mode.
+        """
+        if not extract_bit_field(self.csd, 84, 12) & (1 << 10):
+            return False
+        status = bytearray(64)
+        # CMD6 mode 0 : check function, group 1 function 1
+        if self.cmd(6, 0x00FFFFF1, 0, 0, False) != 0:
+            return False
+        self.readinto(status)
+        # support bits of group 1 : status bits 415:400, function 1 is bit 401
+        if not status[13] & 0x02:
+            return False
+        # CMD6 mode 1 : switch function, group 1 function 1
+        if self.cmd(6, 0x80FFFFF1, 0, 0, False) != 0:
+            return False
+        self.readinto(status)
+        # function selected in group 1 : status bits 379:376
+        if status[16] & 0x0F != 1:
+            return False
+        # the new timing is valid after 8 clock cycles
+        self.spi.write(b"\xff")
+        # CMD9: read the card-specific data again
+        if self.cmd(9, 0, 0, 0, False) != 0:
+            raise OSError("no response from SD card")
+        self.readinto(self.csd)
+        return True
+
+    def get_tran_speed(self):
+        """
+        Maximum data transfer rate of the card in Hz,
+        decoded from TRAN_SPEED in the CSD (e.g. 0x32 : 25 MHz, 0x5a : 50 MHz),
+        0 for a reserved unit.
+        """
+        tran_speed = self.csd[3]
+        return _TRAN_SPEED_UNIT[tran_speed & 0x07] * _TRAN_SPEED_VALUE[(tran_speed >> 3) & 0x0F] // 10
+
+    def check_baudrate(self, baudrate, ref, block, repeats=4, write_block=None):
+        """
+        Check whether the card works reliably at the given SPI clock.
+        The blocks in ref (read before at a safe clock) are read repeatedly
+        with single-block and multi-block reads and compared.
+        If write_block is given, that block is used as scratch space:
+        a test pattern is written, read back and compared.
+        The transfers are not retried, a retry ending in init_card() would
+        continue at the safe clock and accept the rate.
+        Returns True if all transfers were correct at the given clock.
+        """
+        self.init_spi(baudrate)
+        reinits = self.io_reinits
+        buf = bytearray(len(ref))
+        single = bytearray(512)
+        try:
+            for i in range(repeats):
+                self.read_card(block, buf)
+                if buf != ref:
+                    return False
+                self.read_card(block, single)
+                if single != ref[:512]:
+                    return False
+            if write_block is not None:
+                pattern = bytearray((i * 7 + baudrate) & 0xFF for i in range(512))
+                self.invalidate_readahead(write_block, 1)
+                self.write_card(write_block, pattern)
+                self.read_card(write_block, single)
+                if single != pattern:
+                    return False
+        except OSError:
+            return False
+        finally:
+            self.burst_pos = self.burst_end = 0
+            self.cs(1)
+            self.spi.write(b"\xff")
+        # the card must not have been re-initialized or the clock changed meanwhile
+        return self.io_reinits == reinits and self.spi_baudrate == baudrate
+
+    def tune_baudrate(self, max_baudrate=None, block=0, repeats=4, write_block=None,
+                      tune_file='sdcard_tune.json'):
+        """
+        Select the fastest reliable SPI clock for this card.
+        A result stored in tune_file for the CID of the card is used directly.
+        Otherwise the candidate rates up to max_baudrate (default: TRAN_SPEED
+        from the CSD) are checked with check_baudrate(), fastest first.
+        The first reliable rate is selected, stored in tune_file and returned.
+        """
+        key = ''.join(f'{byte:02x}' for byte in self.cid)
+        try:
+            with open(tune_file) as f:
+                tuning = json.load(f)
+        except (OSError, ValueError):
+            tuning = {}
+        if max_baudrate is None:
+            max_baudrate = self.get_tran_speed()
+        if key in tuning and tuning[key] <= max_baudrate:
+            self.baudrate = tuning[key]
+            self.init_spi(self.baudrate)
+            if self.debug:
+                print(f'[SDCard] tune_baudrate() : stored {self.baudrate} Hz')
+            return self.baudrate
+        # reference data read at a safe clock
+        self.init_spi(_SAFE_BAUDRATE)
+        ref = bytearray(4 * 512)
+        self.read_card(block, ref)
+        self.baudrate = _SAFE_BAUDRATE
+        for baudrate in _TUNE_BAUDRATES:
+            if baudrate > max_baudrate:
+                continue
+            if self.check_baudrate(baudrate, ref, block, repeats, write_block):
+                self.baudrate = baudrate
+                break
+            if self.debug:
+                print(f'[SDCard] tune_baudrate() : {baudrate} Hz failed')
+        self.init_spi(self.baudrate)
+        if self.debug:
+            print(f'[SDCard] tune_baudrate() : selected {self.baudrate} Hz')
+        tuning[key] = self.baudrate
+        try:
+            with open(tune_file, 'w') as f:
+                json.dump(tuning, f)
+        except OSError:
+            print(f'[SDCard] cannot store tuning in {tune_file}')
+        return self.baudrate
+
+    def set_readahead(self, depth):
+        """
+        Configure sequential readahead.
+        When single blocks are read in ascending order, the next depth blocks
+        are prefetched with one CMD18 and later reads are served from RAM.
+        depth=0 disables readahead and frees the buffer.
+        The hit/miss counters ra_hits and ra_misses are reset.
+        """
+        self.ra_depth = depth
+        self.ra_buf = bytearray(depth * 512) if depth else None
+        self.ra_mv = memoryview(self.ra_buf) if depth else None
+        self.ra_first = 0
+        self.ra_count = 0
+        self.ra_next = -1
+        self.ra_hits = 0
+        self.ra_misses = 0
+
+    def invalidate_readahead(self, block_num, nblocks):
+        """
+        Drop prefetched data if it overlaps the given range of blocks.
+        """
+        if self.ra_count and block_num < self.ra_first + self.ra_count and self.ra_first < block_num + nblocks:
+            self.ra_count = 0
+
+    def enable_stats(self, bins=16, bin_us=64, ticks=None):
+        """
+        Attach latency instrumentation to the driver.
+        The command, write and wait methods are replaced on this instance by
+        wrappers that count and time the calls, the class methods stay untouched,
+        so a driver without instrumentation carries no overhead.
+        With stats enabled blocking writes release the card before waiting
+        for the end of programming, to time the busy period separately.
+
+        Args:
+            bins (int): number of bins of the block-write latency histogram
+            bin_us (int): upper limit of the first bin, the limits double from bin to bin
+            ticks (function): time source in microseconds, defaults to time.ticks_us
+
+        Returns:
+            (SDStats): the counters, also available as sd.stats
+        """
+        if self.stats is not None:
+            self.disable_stats()
+        stats = SDStats(bins, bin_us, ticks)
+        clock = stats.ticks
+        cmd = self.cmd
+        write = self.write
+        write_token = self.write_token
+        wait_ready = self.wait_ready
+
+        def timed_wait_ready():
+            t = clock()
+            ready = wait_ready()
+            stats.add_busy(ticks_diff(clock(), t))
+            return ready
+
+        def counted_cmd(cmd_num, arg, crc, final=0, release=True, skip1=False):
+            stats.add_cmd(cmd_num)
+            return cmd(cmd_num, arg, crc, final, release, skip1)
+
+        def timed_write(token, buf, wait=True):
+            if self.busy_pending:
+                timed_wait_ready()
+            t = clock()
+            ok = write(token, buf, False)
+            if ok and wait and not timed_wait_ready():
+                self.data_response = _DATA_BUSY_TIMEOUT
+                ok = False
+            stats.add_write(ticks_diff(clock(), t))
+            return ok
+
+        def timed_write_token(token, wait=True):
+            write_token(token, False)
+            if wait:
+                timed_wait_ready()
+
+        self.cmd = counted_cmd
+        self.write = timed_write
+        self.write_token = timed_write_token
+        self.wait_ready = timed_wait_ready
+        self.stats = stats
+        return stats
+
+    def disable_stats(self):
+        """
+        Remove the instrumentation, the driver runs its plain methods again.
+        """
+        if self.stats is None:
+            return
+        del self.cmd
+        del self.write
+        del self.write_token
+        del self.wait_ready
+        self.stats = None
+
+    def read_sd_status(self):
+        """
+        Read the 64-byte SD status register with ACMD13 (response R2 followed
+        by a data block) and decode the fields relevant for logging:
+            speed_class : speed class (0, 2, 4, 6, 10)
+            au_size : size of the allocation unit (AU) in bytes
+            erase_size : number of AUs erased at once for the timeout values
+            erase_timeout : timeout in seconds for erasing erase_size AUs
+            erase_offset : timeout offset in seconds
+        The AU size in blocks is kept in au_blocks.
+        """
+        self.cmd(55, 0, 0)
+        response = self.cmd(13, 0, 0, 1, False)
+        if response != 0:
+            raise OSError(f'[SDCard] read_sd_status() ACMD(13) responds {response}')
+        self.readinto(self.sd_status)
+        status = self.sd_status
+        speed_class = extract_bit_field(status, 440, 8)
+        self.au_blocks = _AU_BLOCKS[extract_bit_field(status, 428, 4)]
+        val = dict({'raw_data':status})
+        val.update({'speed_class':(0, 2, 4, 6, 10)[speed_class] if speed_class < 5 else 0})
+        val.update({'au_size':self.au_blocks * 512})
+        val.update({'erase_size':extract_bit_field(status, 408, 16)})
+        val.update({'erase_timeout':extract_bit_field(status, 402, 6)})
+        val.update({'erase_offset':extract_bit_field(status, 400, 2)})
+        return val
+
+    def erase_timeout_ms(self, nblocks):
+        """
+        Maximum time the card may be busy for erasing nblocks blocks,
+        computed from the SD status as ERASE_TIMEOUT/ERASE_SIZE per AU
+        plus ERASE_OFFSET. Returns 250 ms per AU if the card gives no values.
+        """
+        status = self.sd_status
+        erase_size = extract_bit_field(status, 408, 16)
+        erase_timeout = extract_bit_field(status, 402, 6)
+        erase_offset = extract_bit_field(status, 400, 2)
+        num_au = (nblocks + self.au_blocks - 1) // self.au_blocks if self.au_blocks else 1
+        if erase_size == 0 or erase_timeout == 0:
+            return 250 * num_au
+        return (1000 * erase_timeout * num_au) // erase_size + 1000 * erase_offset
+
+    def au_region(self, start_block, nblocks):
+        """
+        Allocate a region for raw logging aligned to allocation units (AUs).
+        Cards write fastest when sequential writes fill whole AUs, a region
+        straddling AU boundaries causes write stalls.
+        The region begins at the first AU boundary at or after start_block
+        and is nblocks rounded up to whole AUs long (clipped to the card size).
+        The SD status is read on first use.
+        Returns a tuple (first_block, nblocks).
+        """
+        if not self.au_blocks:
+            self.read_sd_status()
+        au = self.au_blocks or 1
+        first = (start_block + au - 1) // au * au
+        count = (nblocks + au - 1) // au * au
+        if first + count > self.sectors:
+            count = (self.sectors - first) // au * au
+        if count <= 0:
+            raise OSError(f'[SDCard] au_region() no space for {nblocks} blocks after {start_block}')
+        return first, count
+
+    def set_wr_blk_erase_count(self, count):
+        """
+        ACMD23 (SET_WR_BLK_ERASE_COUNT): tell the card how many blocks the
+        next CMD25 will write, so it can pre-erase them instead of erasing
+        lazily during the transfer. This is only a hint, a card rejecting
+        the command is ignored. Returns the R1 response.
+        """
+        self.cmd(55, 0, 0)
+        return self.cmd(23, count & 0x7FFFFF, 0)
+
+    @deselect_on_error
+    def stream_open(self, block_num, count=None):
+        """
+        Open a streaming write session starting at block_num.
+        The card is put into multi-block write mode (CMD25) and stays there
+        across any number of stream_write() calls. STOP_TRAN is only sent
+        by stream_close() or when the stream is interrupted by another access.
+        If the length of the stream is known, count blocks are pre-erased
+        with ACMD23. Blocks of that range not written before the stream
+        is closed have undefined content afterwards.
+        """
+        if self.debug:
+            print(f'[SDCard] stream_open() : block={block_num}')
+        if self.stream_block is not None:
+            self.stream_close()
+        if self.erase_count:
+            self.flush_erase(block_num, count or 1)
+        # workaround for shared bus, required for (at least) some Kingston
+        # devices, ensure MOSI is high before starting transaction
+        self.spi.write(b"\xff")
+        # ACMD23: pre-erase the blocks of a stream of known length
+        if count and self.pre_erase:
+            self.set_wr_blk_erase_count(count)
+        # CMD25: set write address for first block
+        response = self.cmd(25, block_num * self.cdv, 0)
+        if response != 0:
+            raise OSError(f'[SDCard] stream_open() CMD(25) responds {response}')
+        self.stream_block = block_num
+
+    @deselect_on_error
+    def stream_write(self, buf):
+        """
+        Append the data of buf (a multiple of 512 bytes) to the open write stream.
+        """
+        if self.stream_block is None:
+            raise OSError('[SDCard] stream_write() no write stream open')
+        nblocks, err = divmod(len(buf), 512)
+        assert nblocks and not err, "Buffer length is invalid"
+        self.invalidate_readahead(self.stream_block, nblocks)
+        offset = 0
+        mv = memoryview(buf)
+        while nblocks:
+            if not self.write(_TOKEN_CMD25, mv[offset : offset + 512], not self.nonblocking):
+                # the card rejected the data, terminate the transfer
+                block_num = self.stream_block
+                self.stream_close()
+                raise SDError(f'[SDCard] stream_write() block={block_num} rejected {self.data_response:02x}',
+                              data_error(self.data_response), block_num)
+            offset += 512
+            nblocks -= 1
+            self.stream_block += 1
+
+    @deselect_on_error
+    def stream_close(self):
+        """
+        Terminate the open write stream (if any) by sending STOP_TRAN.
+        """
+        if self.stream_block is None:
+            return
+        if self.debug:
+            print(f'[SDCard] stream_close() : next block={self.stream_block}')
+        self.stream_block = None
+        self.write_token(_TOKEN_STOP_TRAN, not self.nonblocking)
+
+    @deselect_on_error
+    def erase(self, block_num, count):
+        """
+        Erase a range of blocks with CMD32/CMD33/CMD38.
+        Unless the card can erase single blocks (ERASE_BLK_EN) the range is
+        reduced to the whole erase groups it contains. Ranges shorter than
+        erase_min blocks (one erase group unless configured) are not erased,
+        as an erase is only a hint for the card controller.
+        The card is busy after the erase, the next access waits for it.
+        Returns the number of blocks erased.
+        """
+        if not self.erase_blk_en:
+            group = self.erase_group
+            end = (block_num + count) // group * group
+            block_num = (block_num + group - 1) // group * group
+            count = end - block_num
+        if count < self.erase_min or count <= 0:
+            return 0
+        if self.debug:
+            print(f'[SDCard] erase() : block={block_num} count={count}')
+        if self.stream_block is not None:
+            self.stream_close()
+        self.invalidate_readahead(block_num, count)
+        # CMD32/CMD33: first and last block to be erased
+        response = self.cmd(32, block_num * self.cdv, 0)
+        if response != 0:
+            raise OSError(f'[SDCard] erase() CMD(32) responds {response}')
+        response = self.cmd(33, (block_num + count - 1) * self.cdv, 0)
+        if response != 0:
+            raise OSError(f'[SDCard] erase() CMD(33) responds {response}')
+        # CMD38: erase, R1b response
+        response = self.cmd(38, 0, 0)
+        if response != 0:
+            raise OSError(f'[SDCard] erase() CMD(38) responds {response}')
+        self.busy_pending = True
+        self.busy_timeout_ms = _BUSY_TIMEOUT_MS + self.erase_timeout_ms(count)
+        return count
+
+    def flush_erase(self, block_num=0, count=0):
+        """
+        Erase the range collected from ioctl(6) requests, except the count
+        blocks from block_num on which are about to be written.
+        """
+        first = self.erase_first
+        end = first + self.erase_count
+        self.erase_count = 0
+        if count and block_num < end and first < block_num + count:
+            # the blocks written are programmed anyway, erasing them first only costs time
+            if first < block_num:
+                self.erase(first, block_num - first)
+            if block_num + count < end:
+                self.erase(block_num + count, end - block_num - count)
+        elif end > first:
+            self.erase(first, end - first)
+
+    @deselect_on_error
     def ioctl(self, op, arg):
+        if op == 3:  # sync - commit an open write stream
+            if self.erase_count:
+                self.flush_erase()
+            self.stream_close()
+            if self.busy_pending:
+                self.wait_ready()
+            return 0
         if op == 4:  # get number of blocks
             return self.sectors
         if op == 5:  # get block size in bytes
             return 512
-        if op == 6:  # erase block
-            if self.debug:
-                print(f'[SDCard] ioctl(6) explicit erase not supported')
+        if op == 6:  # erase block - contiguous requests are batched into one range erase
+            if self.erase_count and arg == self.erase_first + self.erase_count:
+                self.erase_count += 1
+            else:
+                self.flush_erase()
+                self.erase_first = arg
+                self.erase_count = 1
+            # a batch is erased at the latest when it reaches the end of an erase group
+            if (self.erase_first + self.erase_count) % self.erase_group == 0:
+                self.flush_erase()
             return 0
         return 0     # default
+
+    def get_CSD(self):
+        """
+        get the card-specific data from CMD9
+        128-bit register, MSB first
+
+        content by byte (Version 2.0):
+        """
+        val = dict({'raw_data':self.csd})
+        structure = extract_bit_field(self.csd,126,2)
+        if structure == 1:
+            val.update(version='2.0')
+            size = extract_bit_field(self.csd,48,22)
+            val.update(num_blocks=size+1)
+        elif structure == 0:
+            val.update({'version':'1.0'})
+            c_size = extract_bit_field(self.csd,62,12)
+            c_mult = extract_bit_field(self.csd,47,3)
+            read_bl_len = extract_bit_field(self.csd,80,4)
+            val.update({'block_size':2**read_bl_len})
+            val.update({'num_blocks':(c_size + 1) * (2 ** (c_mult + 2))})
+        else:
+            val.update({'version':'unknown'})
+        # both versions identical
+        val.update({'tran_speed':self.get_tran_speed()})
+        size = extract_bit_field(self.csd,39,7)
+        val.update({'erase_size':size})
+        val.update({'erase_blk_en':extract_bit_field(self.csd,46,1)})
+        return val
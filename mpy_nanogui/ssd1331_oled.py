@@ -14,6 +14,7 @@ PIN_RST = 20
 PIN_DC = 21
 
 from drivers.ssd1331.ssd1331 import SSD1331 as SSD
+from spibus import SPIBus
 
 pin_cs = Pin(PIN_CS, Pin.OUT, value=1)
 pin_dc = Pin(PIN_DC, Pin.OUT, value=0)
@@ -29,5 +30,9 @@ spi = SPI(
     mosi=Pin(PIN_MOSI),
     sck=Pin(PIN_SCLK))
 print(spi)
+# the bus may be shared with the SD card (with its own CS pin),
+# further devices are added with bus.device()
+bus = SPIBus(spi)
+oled_spi = bus.device(pin_cs, baudrate=24_000_000)
 gc.collect()  # Precaution before instantiating framebuf
-oled = SSD(spi, pin_cs, pin_dc, pin_rst)
+oled = SSD(oled_spi, oled_spi.cs, pin_dc, pin_rst)